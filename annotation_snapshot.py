@@ -0,0 +1,344 @@
+# ---------------------- annotation snapshot ---------------------------------
+# Versioned, memory mapped columnar snapshot of the genes, transcripts and
+# exons of an annotation. Children are stored contiguously behind their
+# parent (offset arrays, like a CSR matrix) and gene/transcript attributes
+# are dictionary encoded, so loading a snapshot is a single mmap and a small
+# json header instead of walking a gffutils db.
+# ----------------------------------------------------------------------------
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+
+import numpy as np
+
+import array_store
+import gtf_reader
+import metrics
+from intron_table import STRANDS, STRAND_CODES
+
+MAGIC = b"ANNSNAP\x01"
+# Bump when the array layout changes
+VERSION = 2
+LEVELS = ("gene", "transcript")
+
+
+class _Builder(object):
+    """
+    Collects genes, transcripts and exons in file order. Genes and transcripts only named by
+    another feature (no gene/transcript line) get a row as well, flagged as not having a feature.
+    """
+
+    def __init__(self):
+        self.chroms = dict()
+        self.rows = {level: dict() for level in LEVELS}
+        self.columns = {level: {"chrom": [], "start": [], "end": [], "strand": [], "has_feature": [],
+                                "attributes": []} for level in LEVELS}
+        self.transcript_gene = list()
+        # Every gene a transcript was named with, for the create_introns walk
+        self.transcript_genes = dict()
+        self.exons = {"chrom": [], "start": [], "end": [], "strand": [], "gene": [], "transcript": []}
+
+    def row(self, level, feature_id):
+        if feature_id is None:
+            return -1
+        rows = self.rows[level]
+        if feature_id not in rows:
+            rows[feature_id] = len(rows)
+            columns = self.columns[level]
+            for column, value in (("chrom", -1), ("start", -1), ("end", -1), ("strand", STRAND_CODES["."]),
+                                  ("has_feature", False), ("attributes", {})):
+                columns[column].append(value)
+            if level == "transcript":
+                self.transcript_gene.append(-1)
+        return rows[feature_id]
+
+    def add(self, featuretype, chrom, start, end, strand, attributes):
+        """
+        :param attributes: dict of attribute to list of values
+        """
+        gene_id = attributes.get("gene_id", [None])[0]
+        transcript_id = attributes.get("transcript_id", [None])[0]
+        gene = self.row("gene", gene_id)
+        transcript = self.row("transcript", transcript_id)
+        if transcript >= 0 and gene >= 0:
+            self.transcript_genes.setdefault(transcript, set()).add(gene)
+            if self.transcript_gene[transcript] < 0:
+                self.transcript_gene[transcript] = gene
+        chrom = self.chroms.setdefault(chrom, len(self.chroms))
+        strand = STRAND_CODES.get(strand, STRAND_CODES["."])
+        if featuretype == "exon":
+            for column, value in (("chrom", chrom), ("start", start), ("end", end), ("strand", strand),
+                                  ("gene", gene), ("transcript", transcript)):
+                self.exons[column].append(value)
+        elif featuretype in LEVELS and (gene if featuretype == "gene" else transcript) >= 0:
+            row = gene if featuretype == "gene" else transcript
+            columns = self.columns[featuretype]
+            for column, value in (("chrom", chrom), ("start", start), ("end", end), ("strand", strand),
+                                  ("has_feature", True), ("attributes", attributes)):
+                columns[column][row] = value
+            if featuretype == "transcript" and gene >= 0:
+                self.transcript_gene[transcript] = gene
+
+    def walked_from_lines(self):
+        """
+        Transcripts create_introns walks in a db made from these lines: with a transcript line
+        and named together with a gene that has a gene line
+        """
+        has_gene = self.columns["gene"]["has_feature"]
+        return set(transcript_id for transcript_id, row in self.rows["transcript"].items()
+                   if self.columns["transcript"]["has_feature"][row]
+                   and any(has_gene[gene] for gene in self.transcript_genes.get(row, ())))
+
+    def build(self, walked):
+        """
+        :param walked: set of transcript ids gffutils create_introns would walk
+        :return: AnnotationSnapshot
+        """
+        arrays, meta = dict(), {"chroms": list(self.chroms), "attributes": dict()}
+        for level in LEVELS:
+            columns = self.columns[level]
+            ids = list(self.rows[level])
+            arrays["{}_id_blob".format(level)], arrays["{}_id_offsets".format(level)] = array_store.pack_strings(ids)
+            arrays["{}_chrom".format(level)] = np.array(columns["chrom"], dtype=np.int32)
+            arrays["{}_start".format(level)] = np.array(columns["start"], dtype=np.int64)
+            arrays["{}_end".format(level)] = np.array(columns["end"], dtype=np.int64)
+            arrays["{}_strand".format(level)] = np.array(columns["strand"], dtype=np.int8)
+            arrays["{}_has_feature".format(level)] = np.array(columns["has_feature"], dtype=np.uint8)
+            # Dictionary encode every attribute: its first value per row, and all values of a repeated tag
+            # behind offsets
+            keys = list(dict.fromkeys(key for attributes in columns["attributes"] for key in attributes))
+            meta["attributes"][level] = keys
+            for key in keys:
+                vocabulary, codes = dict(), np.full(len(ids), -1, dtype=np.int32)
+                value_codes, value_counts = list(), np.zeros(len(ids), dtype=np.int64)
+                for row, attributes in enumerate(columns["attributes"]):
+                    values = attributes.get(key)
+                    if values:
+                        value_codes.extend(vocabulary.setdefault(value, len(vocabulary)) for value in values)
+                        value_counts[row] = len(values)
+                        codes[row] = value_codes[-len(values)]
+                prefix = "{}_attr_{}".format(level, key)
+                arrays[prefix + "_codes"] = codes
+                arrays[prefix + "_value_codes"] = np.array(value_codes, dtype=np.int32)
+                arrays[prefix + "_value_offsets"] = np.concatenate(([0], np.cumsum(value_counts)))
+                arrays[prefix + "_blob"], arrays[prefix + "_offsets"] = array_store.pack_strings(list(vocabulary))
+
+        # Transcripts grouped behind their gene, exons behind their transcript (by start, file order on ties)
+        transcript_gene = np.array(self.transcript_gene, dtype=np.int64)
+        arrays["transcript_gene"] = transcript_gene
+        arrays["transcript_walked"] = np.array([transcript_id in walked for transcript_id in self.rows["transcript"]],
+                                               dtype=np.uint8)
+        n_genes = len(self.rows["gene"])
+        order = np.argsort(np.where(transcript_gene < 0, n_genes, transcript_gene), kind="stable")
+        arrays["gene_transcripts"] = order
+        arrays["gene_transcript_offsets"] = np.concatenate(
+            ([0], np.cumsum(np.bincount(transcript_gene[transcript_gene >= 0], minlength=n_genes))))
+
+        exons = {column: np.array(values, dtype=np.int64) for column, values in self.exons.items()}
+        n_transcripts = len(self.rows["transcript"])
+        order = np.lexsort((exons["start"], np.where(exons["transcript"] < 0, n_transcripts, exons["transcript"])))
+        for column, dtype in (("chrom", np.int32), ("start", np.int64), ("end", np.int64), ("strand", np.int8),
+                              ("gene", np.int64), ("transcript", np.int64)):
+            arrays["exon_{}".format(column)] = exons[column][order].astype(dtype)
+        arrays["transcript_exon_offsets"] = np.concatenate(
+            ([0], np.cumsum(np.bincount(exons["transcript"][exons["transcript"] >= 0], minlength=n_transcripts))))
+        return AnnotationSnapshot(meta, arrays)
+
+
+class AnnotationSnapshot(object):
+    """
+    Genes, transcripts and exons as memory mapped arrays. Coordinates are one based like the gtf.
+    Per level (gene/transcript): {level}_chrom/start/end/strand/has_feature, ids and dictionary
+    encoded attributes. transcript_gene links a transcript to its gene row,
+    gene_transcripts[gene_transcript_offsets[g]:gene_transcript_offsets[g + 1]] are the transcripts
+    of gene g and exon rows transcript_exon_offsets[t]:transcript_exon_offsets[t + 1] the exons of
+    transcript t, sorted by start. Exons without a transcript come last.
+    """
+
+    def __init__(self, meta, arrays, buffer=None):
+        self.meta = meta
+        self.arrays = arrays
+        self.buffer = buffer
+        self.chroms = meta["chroms"]
+        self._ids = dict()
+
+    @classmethod
+    def from_gtf(cls, gtf):
+        """
+        Build a snapshot from a gtf in a single pass
+        """
+        builder = _Builder()
+        for chrom, _, featuretype, start, end, _, strand, _, attributes in gtf_reader.iter_gtf(gtf):
+            if featuretype in ("gene", "transcript", "exon"):
+                builder.add(featuretype, chrom, start, end, strand, gtf_reader.parse_attributes(attributes))
+        return builder.build(builder.walked_from_lines())
+
+    @classmethod
+    def from_db(cls, db):
+        """
+        Build a snapshot from a gffutils db, features in insertion order
+        """
+        builder = _Builder()
+        conn = sqlite3.connect(db)
+        try:
+            for featuretype, chrom, start, end, strand, attributes in conn.execute(
+                    "SELECT featuretype, seqid, start, end, strand, attributes FROM features "
+                    "WHERE featuretype IN ('gene', 'transcript', 'exon') ORDER BY rowid"):
+                builder.add(featuretype, chrom, start, end, strand, json.loads(attributes))
+            walked = gtf_reader.db_walked_transcripts(conn)
+        finally:
+            conn.close()
+        return builder.build(walked)
+
+    @classmethod
+    def from_annotation(cls, path):
+        """
+        Build a snapshot from a gffutils db or a gtf, decided by the file content
+        """
+        return cls.from_db(path) if gtf_reader.is_sqlite(path) else cls.from_gtf(path)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory map a snapshot written by save
+        """
+        meta, arrays, buffer = array_store.open_arrays(path, MAGIC, VERSION)
+        return cls(meta, arrays, buffer)
+
+    @staticmethod
+    def is_snapshot(path):
+        return array_store.has_magic(path, MAGIC)
+
+    def save(self, path):
+        array_store.write_arrays(path, MAGIC, VERSION, self.meta, self.arrays)
+
+    def close(self):
+        if self.buffer is not None:
+            self.arrays = dict()
+            self.buffer.close()
+            self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.arrays["exon_start"])
+
+    def ids(self, level):
+        """
+        Gene or transcript ids, in row order
+        """
+        if level not in self._ids:
+            self._ids[level] = array_store.unpack_strings(self.arrays["{}_id_blob".format(level)],
+                                                          self.arrays["{}_id_offsets".format(level)])
+        return self._ids[level]
+
+    def attribute_codes(self, level, key):
+        """
+        Dictionary encoded first value of an attribute
+        :return: tuple of int32 codes per row (-1 when missing) and the list of values
+        """
+        prefix = "{}_attr_{}".format(level, key)
+        if prefix + "_codes" not in self.arrays:
+            raise KeyError("No {} attribute {} in the snapshot".format(level, key))
+        return (self.arrays[prefix + "_codes"],
+                array_store.unpack_strings(self.arrays[prefix + "_blob"], self.arrays[prefix + "_offsets"]))
+
+    def attribute_value_codes(self, level, key):
+        """
+        Dictionary encoded values of an attribute, all of them when the tag is repeated
+        :return: tuple of offsets, codes and the list of values, the codes of row r are codes[offsets[r]:offsets[r + 1]]
+        """
+        prefix = "{}_attr_{}".format(level, key)
+        if prefix + "_value_codes" not in self.arrays:
+            raise KeyError("No {} attribute {} in the snapshot".format(level, key))
+        return (self.arrays[prefix + "_value_offsets"], self.arrays[prefix + "_value_codes"],
+                array_store.unpack_strings(self.arrays[prefix + "_blob"], self.arrays[prefix + "_offsets"]))
+
+    def attribute(self, level, key):
+        """
+        First value of an attribute per row, None when missing
+        """
+        codes, values = self.attribute_codes(level, key)
+        return [values[code] if code >= 0 else None for code in codes.tolist()]
+
+    def transcripts_of_gene(self, gene):
+        offsets = self.arrays["gene_transcript_offsets"]
+        return self.arrays["gene_transcripts"][offsets[gene]:offsets[gene + 1]]
+
+    def exons_of_transcript(self, transcript):
+        """
+        Exon rows of a transcript, as a slice
+        """
+        offsets = self.arrays["transcript_exon_offsets"]
+        return slice(int(offsets[transcript]), int(offsets[transcript + 1]))
+
+    def structure(self):
+        """
+        Same as gtf_reader.read_structure: transcript ids create_introns would walk and
+        the exons as (chrom, start, end, strand, gene_id, transcript_id)
+        """
+        gene_ids, transcript_ids = self.ids("gene") + [None], self.ids("transcript") + [None]
+        walked = np.flatnonzero(self.arrays["transcript_walked"])
+        exons = list(zip(np.asarray(self.chroms, dtype=object)[self.arrays["exon_chrom"]].tolist(),
+                         self.arrays["exon_start"].tolist(), self.arrays["exon_end"].tolist(),
+                         np.asarray(STRANDS, dtype=object)[self.arrays["exon_strand"]].tolist(),
+                         [gene_ids[gene] for gene in self.arrays["exon_gene"].tolist()],
+                         [transcript_ids[transcript] for transcript in self.arrays["exon_transcript"].tolist()]))
+        return set(transcript_ids[transcript] for transcript in walked.tolist()), exons
+
+
+def main(args):
+    logging.info("Annotation: {annotation}, Outfile: {out}".format(annotation=args.annotation, out=args.out))
+    with metrics.stage("build"):
+        snapshot = AnnotationSnapshot.from_annotation(args.annotation)
+    logging.info("Writing {} genes, {} transcripts, {} exons".format(
+        len(snapshot.ids("gene")), len(snapshot.ids("transcript")), len(snapshot)))
+    metrics.count("genes", len(snapshot.ids("gene")))
+    metrics.count("transcripts", len(snapshot.ids("transcript")))
+    metrics.count("exons", len(snapshot))
+    with metrics.stage("write"):
+        snapshot.save(args.out)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s : %(message)s', level=logging.INFO)
+
+
+    def is_valid_file(parser, arg):
+        """ Check if file exists """
+        if not os.path.isfile(arg):
+            parser.error('The file at %s does not exist' % arg)
+        else:
+            return arg
+
+
+    epilog = "EXAMPLE: python " + os.path.basename(__file__) + \
+             " --annotation /path/to/gtf.db  --out /path/to/gtf.snapshot"
+
+    parser = argparse.ArgumentParser(description="Script to build a memory mapped annotation snapshot "
+                                                 "from a gtf or gtf db",
+                                     epilog=epilog)
+
+    required_args_group = parser.add_argument_group('required arguments')
+    required_args_group.add_argument('-a', '--annotation', dest='annotation', required=True,
+                                     help="gtf (may be gzipped) or gffutils db",
+                                     type=lambda x: is_valid_file(parser, x))
+
+    parser.add_argument('-o', '--out', dest='out', help="DEFAULT: {ANNOTATION_BASE}.snapshot")
+
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if not args.out:
+        args.out = "{base}.snapshot".format(base=os.path.splitext(args.annotation)[0])
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
@@ -0,0 +1,94 @@
+# ---------------------- array store -----------------------------------------
+# Tiny single file container for named numpy arrays: an 8 byte magic, a json
+# header and the raw arrays, each 8 byte aligned, so a file can be memory
+# mapped and every array used in place without parsing or copying.
+# ----------------------------------------------------------------------------
+
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+ALIGN = 8
+
+
+def write_arrays(path, magic, version, meta, arrays):
+    """
+    Write named arrays, atomically through a temp file next to path
+    :param path: output file
+    :param magic: 8 byte file type marker
+    :param version: format version of the caller, checked on open
+    :param meta: json serialisable dict stored in the header
+    :param arrays: dict of name to numpy array, stored little endian and flat
+    """
+    layout, offset = dict(), 0
+    arrays = {name: np.ascontiguousarray(array).ravel() for name, array in arrays.items()}
+    for name, array in arrays.items():
+        arrays[name] = array = array.astype(array.dtype.newbyteorder("<"), copy=False)
+        layout[name] = [array.dtype.str, len(array), offset]
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps({"version": version, "meta": meta, "arrays": layout}).encode()
+    header += b" " * (-(len(magic) + 8 + len(header)) % ALIGN)
+
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as out_handle:
+        out_handle.write(magic)
+        out_handle.write(struct.pack("<Q", len(header)))
+        out_handle.write(header)
+        for name, array in arrays.items():
+            data = array.tobytes()
+            out_handle.write(data)
+            out_handle.write(b"\x00" * (-len(data) % ALIGN))
+    os.replace(tmp_path, path)
+
+
+def has_magic(path, magic):
+    """ Check whether a file starts with the given magic """
+    with open(path, "rb") as in_handle:
+        return in_handle.read(len(magic)) == magic
+
+
+def open_arrays(path, magic, version):
+    """
+    Memory map a file written by write_arrays
+    :return: tuple of meta dict, dict of name to read only array backed by the map, the mmap itself
+    """
+    with open(path, "rb") as in_handle:
+        buffer = mmap.mmap(in_handle.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if buffer[:len(magic)] != magic:
+            raise ValueError("{} does not start with the {!r} marker".format(path, magic))
+        header_size = struct.unpack_from("<Q", buffer, len(magic))[0]
+        data_offset = len(magic) + 8 + header_size
+        header = json.loads(buffer[len(magic) + 8:data_offset].decode())
+        if header["version"] != version:
+            raise ValueError("{} has format version {}, expected {}".format(path, header["version"], version))
+    except ValueError:
+        buffer.close()
+        raise
+    arrays = dict()
+    for name, (dtype, length, offset) in header["arrays"].items():
+        arrays[name] = np.frombuffer(buffer, dtype=np.dtype(dtype), count=length, offset=data_offset + offset)
+    return header["meta"], arrays, buffer
+
+
+def pack_strings(strings):
+    """
+    Pack strings into a NUL separated utf-8 blob with start offsets
+    :return: tuple of uint8 blob, int64 offsets of length n + 1
+    """
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) + 1 for string in encoded])
+    return np.frombuffer(b"".join(string + b"\x00" for string in encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(blob, offsets):
+    """
+    All strings of a pack_strings blob as a list
+    """
+    if len(offsets) < 2:
+        return []
+    return [string.decode() for string in blob.tobytes().split(b"\x00")[:len(offsets) - 1]]
@@ -0,0 +1,505 @@
+# ---------------------- benchmark -------------------------------------------
+# Offline benchmark of the pipeline scripts on synthetic data. Annotations
+# (genes x transcripts per gene x introns per transcript), a matching genome
+# fasta, donor/branch pwms and spliced/unspliced bams at chosen depths are
+# generated per scale point, every stage is run as its own process and its
+# wall time, cpu time, peak RSS and throughput are recorded. Results are
+# written as json and can be compared against a saved baseline.
+# ----------------------------------------------------------------------------
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+READ_LENGTH = 76
+LINE_WIDTH = 60
+DONOR_MOTIFS = ("AT_AC_U12", "GT_AG_U12", "GT_AG_U2", "GC_AG_U2")
+BRANCH_MOTIFS = ("AT_AC_U12", "GT_AG_U12")
+# Every n-th transcript is a retained intron transcript, what filter_gtf.py removes
+RETAINED_EVERY = 5
+
+
+def make_structure(genes, transcripts_per_gene, introns_per_transcript, chroms, seed):
+    """
+    Random gene models laid out along the chromosomes
+    :return: tuple of dict of chrom to length, list of genes as dicts with chrom, strand, id and
+             transcripts, every transcript a dict with id, type and a list of (start, end) exons (1 based)
+    """
+    rnd = random.Random(seed)
+    positions = {"chr{}".format(index + 1): 1000 for index in range(chroms)}
+    models = list()
+    for gene_index in range(genes):
+        chrom = "chr{}".format(gene_index * chroms // max(genes, 1) + 1)
+        start = positions[chrom] + rnd.randint(1000, 5000)
+        exons, position = list(), start
+        for exon_index in range(introns_per_transcript + 1):
+            length = rnd.randint(80, 300)
+            exons.append((position, position + length - 1))
+            position += length + rnd.randint(200, 3000)
+        positions[chrom] = exons[-1][1]
+        transcripts = list()
+        for transcript_index in range(transcripts_per_gene):
+            transcript_exons = list(exons)
+            # Skip one inner exon in the alternative transcripts
+            if transcript_index and len(exons) > 2:
+                del transcript_exons[1 + (transcript_index - 1) % (len(exons) - 2)]
+            serial = gene_index * transcripts_per_gene + transcript_index
+            transcripts.append({"id": "T{:07d}.1".format(serial),
+                                "type": "retained_intron" if serial % RETAINED_EVERY == RETAINED_EVERY - 1
+                                else "protein_coding",
+                                "exons": transcript_exons})
+        models.append({"id": "G{:07d}.1".format(gene_index), "chrom": chrom, "strand": rnd.choice("+-"),
+                       "transcripts": transcripts})
+    sizes = {chrom: position + 5000 for chrom, position in positions.items()}
+    return sizes, models
+
+
+def write_gtf(models, out):
+    """
+    Write gene, transcript and exon lines for the gene models
+    :return: number of features written
+    """
+    features = 0
+    with open(out, "w") as out_handle:
+        for gene in models:
+            gene_attributes = 'gene_id "{id}"; gene_type "protein_coding"; gene_name "{id}";'.format(id=gene["id"])
+            starts = [transcript["exons"][0][0] for transcript in gene["transcripts"]]
+            ends = [transcript["exons"][-1][1] for transcript in gene["transcripts"]]
+            fields = [gene["chrom"], "BENCH", "gene", str(min(starts)), str(max(ends)), ".", gene["strand"], "."]
+            out_handle.write("\t".join(fields + [gene_attributes]) + "\n")
+            for transcript in gene["transcripts"]:
+                attributes = gene_attributes + ' transcript_id "{id}"; transcript_type "{type}";'.format(
+                    **transcript)
+                exons = transcript["exons"] if gene["strand"] == "+" else transcript["exons"][::-1]
+                fields[2:5] = "transcript", str(transcript["exons"][0][0]), str(transcript["exons"][-1][1])
+                out_handle.write("\t".join(fields + [attributes]) + "\n")
+                for number, (start, end) in enumerate(exons, 1):
+                    fields[2:5] = "exon", str(start), str(end)
+                    out_handle.write("\t".join(fields + [attributes + " exon_number {};".format(number)]) + "\n")
+                features += 1 + len(exons)
+            features += 1
+    return features
+
+
+def make_genome(sizes, models, seed):
+    """
+    Random chromosome sequences with GT..AG (or CT..AC on the minus strand) at every intron
+    :return: dict of chrom to uint8 sequence array
+    """
+    rng = np.random.default_rng(seed)
+    genome = {chrom: np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, size)].copy()
+              for chrom, size in sizes.items()}
+    for gene in models:
+        sequence = genome[gene["chrom"]]
+        donor, acceptor = (b"GT", b"AG") if gene["strand"] == "+" else (b"CT", b"AC")
+        for transcript in gene["transcripts"]:
+            for (_, last_end), (next_start, _) in zip(transcript["exons"], transcript["exons"][1:]):
+                # Intron is last_end + 1 .. next_start - 1, 1 based
+                sequence[last_end:last_end + 2] = np.frombuffer(donor, dtype=np.uint8)
+                sequence[next_start - 3:next_start - 1] = np.frombuffer(acceptor, dtype=np.uint8)
+    return genome
+
+
+def write_genome(genome, fasta, gsizes):
+    """ Write the genome as a fasta plus a genome sizes file """
+    with open(fasta, "wb") as out_handle:
+        for chrom, sequence in genome.items():
+            out_handle.write(">{}\n".format(chrom).encode())
+            data = sequence.tobytes()
+            out_handle.write(b"".join(data[begin:begin + LINE_WIDTH] + b"\n"
+                                      for begin in range(0, len(data), LINE_WIDTH)))
+    with open(gsizes, "w") as out_handle:
+        for chrom, sequence in genome.items():
+            out_handle.write("{}\t{}\n".format(chrom, len(sequence)))
+
+
+def write_pwms(motif_ids, length, seed, out):
+    """ Random position weight matrices, one per motif id """
+    rng = np.random.default_rng(seed)
+    with open(out, "w") as out_handle:
+        for motif_id in motif_ids:
+            out_handle.write(">{}\n".format(motif_id))
+            for row in rng.dirichlet([0.5] * 4, size=length):
+                out_handle.write("\t".join("{:.6f}".format(value) for value in row) + "\n")
+
+
+def make_reads(genome, models, depth, retention, seed):
+    """
+    Simulated reads per intron: depth spliced reads across the junction plus
+    depth * retention unspliced reads across a random boundary of the intron
+    :return: list of (chrom, start, cigar) with 0 based starts
+    """
+    rng = random.Random(seed)
+    reads = list()
+    for gene in models:
+        seen = set()
+        for transcript in gene["transcripts"]:
+            for (_, last_end), (next_start, _) in zip(transcript["exons"], transcript["exons"][1:]):
+                # Intron in 0 based half open coordinates
+                start, end = last_end, next_start - 1
+                if (start, end) in seen:
+                    continue
+                seen.add((start, end))
+                for _ in range(depth):
+                    left = rng.randint(8, READ_LENGTH - 8)
+                    reads.append((gene["chrom"], start - left,
+                                  ((0, left), (3, end - start), (0, READ_LENGTH - left))))
+                for _ in range(int(round(depth * retention))):
+                    boundary = rng.choice((start, end))
+                    reads.append((gene["chrom"], boundary - rng.randint(8, READ_LENGTH - 8),
+                                  ((0, READ_LENGTH),)))
+    reads.sort(key=lambda read: (read[0], read[1]))
+    return reads
+
+
+def write_bam(genome, reads, out):
+    """ Write the reads as a coordinate sorted, indexed bam """
+    import pysam
+
+    chroms = list(genome)
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+              "SQ": [{"SN": chrom, "LN": len(genome[chrom])} for chrom in chroms]}
+    chrom_ids = {chrom: index for index, chrom in enumerate(chroms)}
+    reads.sort(key=lambda read: (chrom_ids[read[0]], read[1]))
+    with pysam.AlignmentFile(out, "wb", header=header) as out_handle:
+        for number, (chrom, start, cigar) in enumerate(reads):
+            segment = pysam.AlignedSegment(out_handle.header)
+            segment.query_name = "r{}".format(number)
+            segment.reference_id = chrom_ids[chrom]
+            segment.reference_start = start
+            segment.cigartuples = cigar
+            sequence, position = b"", start
+            for operation, length in cigar:
+                if operation == 0:
+                    sequence += genome[chrom][position:position + length].tobytes()
+                position += length
+            segment.query_sequence = sequence.decode()
+            segment.query_qualities = pysam.qualitystring_to_array("I" * len(sequence))
+            segment.mapping_quality = 60
+            out_handle.write(segment)
+    pysam.index(out)
+
+
+class Workspace(object):
+    """
+    Synthetic inputs of one scale point, generated on first use
+    """
+
+    def __init__(self, root, genes, transcripts, introns, chroms, retention, seed):
+        self.root = root
+        self.params = {"genes": genes, "transcripts": transcripts, "introns": introns, "chroms": chroms}
+        self.retention = retention
+        self.seed = seed
+        self.counts = dict()
+        self.paths = dict()
+        self._genome = None
+        self._models = None
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def models(self):
+        if self._models is None:
+            self.sizes, self._models = make_structure(self.params["genes"], self.params["transcripts"],
+                                                      self.params["introns"], self.params["chroms"], self.seed)
+        return self._models
+
+    def genome(self):
+        if self._genome is None:
+            models = self.models()
+            self._genome = make_genome(self.sizes, models, self.seed)
+        return self._genome
+
+    def get(self, name, depth=None):
+        """
+        Path of an input, built when missing: gtf, genome, gsizes, don_pwm, branch_pwm, db, introns, bam
+        """
+        key = name if depth is None else "{}_{}".format(name, depth)
+        if key in self.paths:
+            return self.paths[key]
+        if name == "gtf":
+            path = self.path("annotation.gtf")
+            self.counts["features"] = write_gtf(self.models(), path)
+            self.counts["genes"] = len(self.models())
+        elif name in ("genome", "gsizes"):
+            write_genome(self.genome(), self.path("genome.fa"), self.path("genome.sizes"))
+            self.paths["genome"], self.paths["gsizes"] = self.path("genome.fa"), self.path("genome.sizes")
+            return self.paths[name]
+        elif name in ("don_pwm", "branch_pwm"):
+            path = self.path("{}.pwm".format(name.split("_")[0]))
+            motif_ids, length = (DONOR_MOTIFS, 13) if name == "don_pwm" else (BRANCH_MOTIFS, 12)
+            write_pwms(motif_ids, length, self.seed, path)
+        elif name == "db":
+            import gtf_to_db
+            path = self.path("annotation.db")
+            gtf_to_db.bulk_create_db(self.get("gtf"), path)
+        elif name == "introns":
+            import get_introns
+            path = self.path("introns.bed")
+            get_introns.write_final_introns(get_introns.get_final_introns_direct(self.get("gtf"), 3), path)
+            with open(path) as in_handle:
+                self.counts["introns"] = sum(1 for _ in in_handle)
+        elif name == "bam":
+            path = self.path("reads_d{}.bam".format(depth))
+            reads = make_reads(self.genome(), self.models(), depth, self.retention, self.seed)
+            self.counts["reads_{}".format(depth)] = len(reads)
+            write_bam(self.genome(), reads, path)
+        else:
+            raise ValueError("Unknown input {}".format(name))
+        self.paths[key] = path
+        return path
+
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPT_DIR, name)]
+
+
+# Stage name to (function building the command line from a workspace and an output path, count unit, per depth)
+STAGES = {
+    "gtf_to_db": (lambda ws, out, depth: script("gtf_to_db.py") + ["-g", ws.get("gtf"), "-d", out],
+                  "features", False),
+    "gtf_to_db_fast": (lambda ws, out, depth: script("gtf_to_db.py") + ["-g", ws.get("gtf"), "-d", out, "--fast"],
+                       "features", False),
+    "filter_gtf": (lambda ws, out, depth: script("filter_gtf.py") + ["-g", ws.get("db"), "-t", "retained_intron",
+                                                                     "-o", out],
+                   "genes", False),
+    "filter_gtf_sql": (lambda ws, out, depth: script("filter_gtf.py") + ["-g", ws.get("db"), "-t", "retained_intron",
+                                                                         "-o", out, "-e", "sql"],
+                       "genes", False),
+    "get_introns": (lambda ws, out, depth: script("get_introns.py") + ["-d", ws.get("db"), "-o", out],
+                    "introns", False),
+    "get_introns_direct": (lambda ws, out, depth: script("get_introns.py") + ["-g", ws.get("gtf"), "-o", out],
+                           "introns", False),
+    "get_intron_type": (lambda ws, out, depth: script("get_intron_type.py") + [
+        "-i", ws.get("introns"), "-b", ws.get("branch_pwm"), "-d", ws.get("don_pwm"), "-g", ws.get("genome"),
+        "-s", "numpy", "-o", out], "introns", False),
+    "get_msi": (lambda ws, out, depth: script("get_msi.py") + [
+        "-i", ws.get("introns"), "-b", ws.get("bam", depth), "-g", ws.get("gsizes"), "-o", out],
+        "introns", True),
+    "get_msi_sweep": (lambda ws, out, depth: script("get_msi.py") + [
+        "-i", ws.get("introns"), "-b", ws.get("bam", depth), "-g", ws.get("gsizes"), "-o", out, "-e", "sweep"],
+        "introns", True),
+}
+
+
+# Stages are started from this small launcher process. A child inherits the peak RSS of the
+# process it was forked from, so forking from the benchmark itself (holding the generated
+# genome and reads) would inflate every measurement.
+LAUNCHER = """
+import json, os, subprocess, sys, tempfile, time
+for line in sys.stdin:
+    argv, cwd = json.loads(line)
+    with tempfile.TemporaryFile() as stderr:
+        begin = time.perf_counter()
+        process = subprocess.Popen(argv, cwd=cwd, stdout=subprocess.DEVNULL, stderr=stderr)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - begin
+        stderr.seek(0)
+        tail = stderr.read().decode(errors="replace").strip().splitlines()[-3:]
+    print(json.dumps([wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss, os.waitstatus_to_exitcode(status),
+                      tail]), flush=True)
+"""
+
+
+class Launcher(object):
+    """
+    Runs stage commands from a separate, lightweight process
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, "-c", LAUNCHER], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, universal_newlines=True)
+
+    def run(self, argv, cwd):
+        """
+        Run one stage as a child process
+        :return: dict of wall and cpu seconds, peak RSS in bytes, exit status and the end of stderr
+        """
+        self.process.stdin.write(json.dumps([argv, cwd]) + "\n")
+        self.process.stdin.flush()
+        wall, cpu, max_rss, returncode, tail = json.loads(self.process.stdout.readline())
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        max_rss *= 1 if sys.platform == "darwin" else 1024
+        return {"wall": wall, "cpu": cpu, "max_rss": max_rss,
+                "status": "ok" if returncode == 0 else "failed ({})".format(returncode),
+                "error": "" if returncode == 0 else "\n".join(tail)}
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def run_stage(launcher, workspace, stage, depth, repeat):
+    """
+    Run one stage on a workspace, repeat times
+    :return: result dict of the fastest run, with the peak RSS over all runs
+    """
+    command, unit, _ = STAGES[stage]
+    out = workspace.path("{}{}.out".format(stage, "" if depth is None else "_d{}".format(depth)))
+    argv = command(workspace, out, depth)
+    logging.info("Running {stage} with {genes} genes{depth}".format(
+        stage=stage, genes=workspace.params["genes"], depth="" if depth is None else " at depth {}".format(depth)))
+    runs = [launcher.run(argv, workspace.root) for _ in range(repeat)]
+    if unit not in workspace.counts:
+        # Count the units the stage processes from the generated inputs
+        workspace.get("gtf" if unit in ("features", "genes") else "introns")
+    result = dict(stage=stage, depth=depth, items=workspace.counts[unit], unit=unit, **workspace.params)
+    result.update(min(runs, key=lambda run: run["wall"]))
+    result["max_rss"] = max(run["max_rss"] for run in runs)
+    result["throughput"] = result["items"] / result["wall"] if result["wall"] else None
+    if depth is not None:
+        result["reads"] = workspace.counts["reads_{}".format(depth)]
+    logging.info("{stage}: {wall:.2f}s wall, {cpu:.2f}s cpu, {rss:.0f} MB peak RSS, {status}".format(
+        rss=result["max_rss"] / 2 ** 20, **result))
+    return result
+
+
+def run_benchmark(stages, scales, depths, transcripts, introns, chroms, retention, repeat, workdir, seed):
+    """
+    Run the stages at every scale point (and depth, for the bam stages)
+    :return: list of result dicts
+    """
+    results = list()
+    launcher = Launcher()
+    try:
+        for genes in scales:
+            workspace = Workspace(os.path.join(workdir, "genes{}".format(genes)), genes, transcripts, introns,
+                                  chroms, retention, seed)
+            for stage in stages:
+                for depth in (depths if STAGES[stage][2] else [None]):
+                    results.append(run_stage(launcher, workspace, stage, depth, repeat))
+    finally:
+        launcher.close()
+    return results
+
+
+def result_key(result):
+    return result["stage"], result["genes"], result["transcripts"], result["introns"], result["depth"]
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Compare results to a baseline run
+    :param tolerance: allowed relative slowdown (or memory growth) before a stage counts as a regression
+    :return: list of (result, baseline result, wall ratio, rss ratio, regressed)
+    """
+    previous = {result_key(result): result for result in baseline["results"]}
+    rows = list()
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None or result["status"] != "ok" or old["status"] != "ok":
+            continue
+        wall_ratio = result["wall"] / old["wall"] if old["wall"] else float("inf")
+        rss_ratio = result["max_rss"] / old["max_rss"] if old["max_rss"] else float("inf")
+        rows.append((result, old, wall_ratio, rss_ratio, wall_ratio > 1 + tolerance or rss_ratio > 1 + tolerance))
+    return rows
+
+
+def main(args):
+    logging.info("Received the following args: \n {}".format(args))
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ir_benchmark_")
+    try:
+        results = run_benchmark(args.stages, args.scales, args.depths, args.transcripts, args.introns, args.chroms,
+                                args.retention, args.repeat, workdir, args.seed)
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"meta": {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+                       "python": platform.python_version(), "platform": platform.platform(),
+                       "cpus": os.cpu_count(), "seed": args.seed, "retention": args.retention,
+                       "repeat": args.repeat},
+              "results": results}
+    if args.out:
+        with open(args.out, "w") as out_handle:
+            json.dump(report, out_handle, indent=1)
+        logging.info("Results written to {}".format(args.out))
+
+    print("\t".join(["stage", "genes", "depth", "items", "wall_s", "cpu_s", "max_rss_mb", "per_s", "status"]))
+    for result in results:
+        print("\t".join(str(field) for field in (
+            result["stage"], result["genes"], "" if result["depth"] is None else result["depth"], result["items"],
+            "{:.3f}".format(result["wall"]), "{:.3f}".format(result["cpu"]),
+            "{:.1f}".format(result["max_rss"] / 2 ** 20),
+            "" if result["throughput"] is None else "{:.1f}".format(result["throughput"]), result["status"])))
+
+    if args.compare:
+        with open(args.compare) as in_handle:
+            baseline = json.load(in_handle)
+        rows = compare_results(results, baseline, args.tolerance)
+        print("\n" + "\t".join(["stage", "genes", "depth", "wall_s", "baseline_wall_s", "wall_ratio", "rss_ratio",
+                                "verdict"]))
+        for result, old, wall_ratio, rss_ratio, regressed in rows:
+            print("\t".join(str(field) for field in (
+                result["stage"], result["genes"], "" if result["depth"] is None else result["depth"],
+                "{:.3f}".format(result["wall"]), "{:.3f}".format(old["wall"]), "{:.2f}".format(wall_ratio),
+                "{:.2f}".format(rss_ratio), "REGRESSION" if regressed else "ok")))
+        if any(row[-1] for row in rows):
+            logging.error("Regressions above {:.0%} against {}".format(args.tolerance, args.compare))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s : %(message)s', level=logging.INFO)
+
+
+    def is_valid_file(parser, arg):
+        """ Check if file exists """
+        if not os.path.isfile(arg):
+            parser.error('The file at %s does not exist' % arg)
+        else:
+            return arg
+
+
+    def int_list(arg):
+        return [int(value) for value in arg.split(",")]
+
+
+    epilog = "EXAMPLE: python " + os.path.basename(__file__) + \
+             " --scales 100,1000,10000 --depths 10,50 --out bench.json --compare baseline.json"
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline scripts on synthetic data", epilog=epilog)
+
+    parser.add_argument('-s', '--stages', dest='stages', nargs="+", choices=sorted(STAGES),
+                        default=sorted(STAGES), help="DEFAULT: all stages")
+    parser.add_argument('--scales', dest='scales', type=int_list, default=[100, 1000],
+                        help="Comma separated numbers of genes, one scale point each. DEFAULT: 100,1000")
+    parser.add_argument('--transcripts', dest='transcripts', type=int, default=3,
+                        help="Transcripts per gene. DEFAULT: 3")
+    parser.add_argument('--introns', dest='introns', type=int, default=6,
+                        help="Introns per transcript. DEFAULT: 6")
+    parser.add_argument('--chroms', dest='chroms', type=int, default=4, help="DEFAULT: 4")
+    parser.add_argument('--depths', dest='depths', type=int_list, default=[20],
+                        help="Comma separated spliced reads per intron for the bam stages. DEFAULT: 20")
+    parser.add_argument('--retention', dest='retention', type=float, default=0.2,
+                        help="Unspliced reads per intron boundary, as a fraction of the depth. DEFAULT: 0.2")
+    parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=1,
+                        help="Runs per stage, the fastest is reported. DEFAULT: 1")
+    parser.add_argument('--seed', dest='seed', type=int, default=1)
+    parser.add_argument('-w', '--workdir', dest='workdir',
+                        help="Keep the generated inputs and outputs here. DEFAULT: a temp dir, removed afterwards")
+    parser.add_argument('--keep', dest='keep', action='store_true', help="Keep the temp dir")
+    parser.add_argument('-o', '--out', dest='out', help="Write the results as json, e.g. as a new baseline")
+    parser.add_argument('-c', '--compare', dest='compare', type=lambda x: is_valid_file(parser, x),
+                        help="Baseline json to compare against, exits with 1 on regressions")
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float, default=0.2,
+                        help="Relative slowdown or memory growth counted as a regression. DEFAULT: 0.2")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,152 @@
+# ---------------------- checkpoint ------------------------------------------
+# Resumable runs of get_msi.py and get_intron_type.py. The work of a run is
+# split into shards (regions of the intron table), and every finished shard
+# is written to the checkpoint directory as its own compressed .npz, moved in
+# place once complete. manifest.json records the run key and the finished
+# shards, and is rewritten the same way after every shard. A restarted run with
+# the same key computes only the shards missing from the manifest. Only files
+# listed in a manifest of the same key are ever deleted: a checkpoint of
+# another run, or a directory holding other files, is refused instead.
+# ----------------------------------------------------------------------------
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import numpy as np
+
+FORMAT = "intron-retention-checkpoint"
+MANIFEST = "manifest.json"
+# Bump when the shard layout changes
+CHECKPOINT_VERSION = 1
+
+
+def atomic_write_json(obj, path):
+    """ Write json next to path and move it in place """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    with os.fdopen(fd, "w") as out_handle:
+        json.dump(obj, out_handle)
+    os.replace(tmp_path, path)
+
+
+def file_stamp(path):
+    """ Identity of an input file that changes when the file is replaced or rewritten """
+    stat = os.stat(path)
+    return os.path.realpath(path), stat.st_size, stat.st_mtime_ns
+
+
+def run_key(**parts):
+    """
+    Key of a run from json serialisable parts, numpy arrays are hashed by content
+    """
+    description = {"version": CHECKPOINT_VERSION}
+    for name, part in parts.items():
+        if isinstance(part, np.ndarray):
+            part = hashlib.blake2b(np.ascontiguousarray(part).tobytes(), digest_size=16).hexdigest()
+        description[name] = part
+    return hashlib.blake2b(json.dumps(description, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def shard_name(shard):
+    return "shard_{}.npz".format(shard)
+
+
+def read_manifest(directory):
+    """
+    Manifest of a checkpoint directory
+    :return: dict with key and shards, None when the directory has no manifest written by this module
+    """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as in_handle:
+            manifest = json.load(in_handle)
+    except ValueError:
+        return None
+    if not isinstance(manifest, dict) or manifest.get("format") != FORMAT:
+        return None
+    return manifest
+
+
+class Checkpoint(object):
+    """
+    Checkpoint directory of one run: a shard file per finished shard and the manifest listing them
+    """
+
+    def __init__(self, directory, key):
+        """
+        :param directory: checkpoint directory, created when missing, otherwise empty or a checkpoint of the same key
+        :param key: run_key of the run
+        """
+        self.directory = directory
+        self.key = key
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        manifest = read_manifest(directory)
+        if manifest is None:
+            if os.listdir(directory):
+                raise ValueError("{} is not empty and holds no checkpoint, pick an empty or new "
+                                 "checkpoint directory".format(directory))
+            self.finished = set()
+            self.write_manifest()
+        elif manifest["key"] != key:
+            raise ValueError("{} holds the checkpoint of another run (other inputs or parameters), remove it or "
+                             "pick another checkpoint directory".format(directory))
+        else:
+            self.finished = set(manifest["shards"])
+            logging.info("Resuming from checkpoint {dir}: {n} shards finished".format(dir=directory,
+                                                                                      n=len(self.finished)))
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def __contains__(self, shard):
+        return shard in self.finished
+
+    def write_manifest(self):
+        atomic_write_json({"format": FORMAT, "key": self.key, "shards": sorted(self.finished)},
+                          self.path(MANIFEST))
+
+    def save(self, shard, arrays):
+        """
+        Write a finished shard, then record it in the manifest
+        :param shard: shard number
+        :param arrays: dict of name to array, without python objects
+        """
+        # A fixed temp name, a write cut short is replaced when the shard is written again
+        tmp_path = self.path(shard_name(shard) + ".tmp")
+        with open(tmp_path, "wb") as out_handle:
+            np.savez_compressed(out_handle, **arrays)
+        os.replace(tmp_path, self.path(shard_name(shard)))
+        self.finished.add(shard)
+        self.write_manifest()
+
+    def load(self, shard):
+        """
+        Arrays of a finished shard
+        :return: dict of name to array
+        """
+        with np.load(self.path(shard_name(shard)), allow_pickle=False) as shard_arrays:
+            return {name: shard_arrays[name] for name in shard_arrays.files}
+
+
+def remove(directory, key):
+    """
+    Remove a checkpoint once the run wrote its output: the shards its manifest lists and the manifest, the
+    directory too when nothing else is left in it. Nothing is removed when the manifest is of another key.
+    """
+    manifest = read_manifest(directory) if os.path.isdir(directory) else None
+    if manifest is None:
+        return
+    if manifest["key"] != key:
+        logging.warning("Not removing {}, it holds the checkpoint of another run".format(directory))
+        return
+    for shard in manifest["shards"]:
+        path = os.path.join(directory, shard_name(shard))
+        if os.path.isfile(path):
+            os.remove(path)
+    os.remove(os.path.join(directory, MANIFEST))
+    if not os.listdir(directory):
+        os.rmdir(directory)
@@ -0,0 +1,195 @@
+# ---------------------- columnar --------------------------------------------
+# Binary columnar form of the MSI and intron type tables: a compressed numpy
+# .npz with typed columns, written by get_msi.py and get_intron_type.py with
+# --format columnar and read back with ColumnTable. Layout of the .npz:
+#   meta           json string: format, version, kind ("msi" or "types"),
+#                  chroms (names of the chrom codes) and columns (name, type)
+#   chrom          int32 chromosome codes into meta chroms
+#   start, end     int64 bed style coordinates
+#   strand         int8 codes into "+", "-", "."
+#   col_{name}     one array per column: int32 counts, float64 values, or
+#                  int16 codes for categorical columns ...
+#   cat_{name}     ... with their categories as a unicode array
+# No pickled objects are stored, numpy.load works with allow_pickle=False.
+# ----------------------------------------------------------------------------
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+
+import metrics
+from intron_table import IntronTable
+
+FORMAT = "intron-retention-columns"
+VERSION = 1
+# Suffix of columnar outputs named by the scripts, e.g. {SAMPLE}_msi.npz
+SUFFIX = ".npz"
+
+
+def is_columnar(path):
+    """ Whether a file is a columnar table rather than a text table """
+    with open(path, "rb") as in_handle:
+        # .npz files are zip archives
+        return in_handle.read(4) == b"PK\x03\x04"
+
+
+def write_columns(path, kind, table, columns):
+    """
+    Write a table, atomically through a temp file next to path
+    :param path: output file, written as is without numpy adding .npz
+    :param kind: "msi" or "types"
+    :param table: IntronTable of the rows
+    :param columns: list of (name, array) in output order. Integer arrays are
+                    stored as int32 counts, floats as float64, strings or
+                    objects as categorical codes
+    """
+    arrays = {"chrom": table.chrom.astype(np.int32), "start": table.start.astype(np.int64),
+              "end": table.end.astype(np.int64), "strand": table.strand.astype(np.int8)}
+    schema = list()
+    for name, values in columns:
+        values = np.asarray(values)
+        if values.dtype.kind in "iub":
+            schema.append((name, "int"))
+            arrays["col_" + name] = values.astype(np.int32)
+        elif values.dtype.kind == "f":
+            schema.append((name, "float"))
+            arrays["col_" + name] = values.astype(np.float64)
+        else:
+            schema.append((name, "category"))
+            categories, codes = np.unique(values.astype(str), return_inverse=True)
+            arrays["col_" + name] = codes.astype(np.int16)
+            arrays["cat_" + name] = categories
+    meta = {"format": FORMAT, "version": VERSION, "kind": kind, "chroms": list(table.chroms), "columns": schema}
+    arrays["meta"] = np.array(json.dumps(meta))
+
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, "wb") as out_handle:
+        np.savez_compressed(out_handle, **arrays)
+    os.replace(tmp_path, path)
+
+
+class ColumnTable(object):
+    """
+    Reader of a columnar table. Columns are decompressed when first used.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: file written by write_columns
+        """
+        self.path = path
+        self._npz = np.load(path, allow_pickle=False)
+        meta = json.loads(str(self._npz["meta"]))
+        if meta.get("format") != FORMAT:
+            self._npz.close()
+            raise ValueError("{} is not a columnar intron table".format(path))
+        if meta["version"] != VERSION:
+            self._npz.close()
+            raise ValueError("{} has format version {}, expected {}".format(path, meta["version"], VERSION))
+        self.kind = meta["kind"]
+        self.columns = [name for name, _ in meta["columns"]]
+        self.types = dict((name, column_type) for name, column_type in meta["columns"])
+        self.table = IntronTable(meta["chroms"], self._npz["chrom"], self._npz["start"], self._npz["end"],
+                                 self._npz["strand"])
+        self._cache = dict()
+
+    def close(self):
+        self._npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.table)
+
+    def codes(self, name):
+        """
+        Codes and categories of a categorical column
+        :return: tuple of int16 code array, array of category strings
+        """
+        return self._npz["col_" + name], self._npz["cat_" + name]
+
+    def __getitem__(self, name):
+        """
+        A column as an array: int32 or float64, categorical columns decoded to an object array of strings
+        """
+        if name not in self._cache:
+            if name not in self.types:
+                raise KeyError("{} has no column {}".format(self.path, name))
+            if self.types[name] == "category":
+                codes, categories = self.codes(name)
+                self._cache[name] = categories.astype(object)[codes]
+            else:
+                self._cache[name] = self._npz["col_" + name]
+        return self._cache[name]
+
+    def text_lines(self):
+        """
+        The table as the lines of the text table the scripts write otherwise
+        :return: generator of lines including the header
+        """
+        columns = [self[name].tolist() for name in self.columns]
+        if self.kind == "msi":
+            # Introns without any reads are written with an MSI of 0, see get_msi.write_msi_rows
+            msi = self.columns.index("MSI")
+            no_reads = ((self["A1"] == 0) & (self["A2"] == 0) & (self["Exon"] == 0)).tolist()
+            columns[msi] = [0 if empty else value for value, empty in zip(columns[msi], no_reads)]
+            yield "\t".join(["ID"] + self.columns) + "\n"
+            for intron_id, row in zip(self.table.ids(), zip(*columns)):
+                yield "\t".join((intron_id,) + tuple(str(field) for field in row)) + "\n"
+        else:
+            yield "\t".join(["Chrom", "Start", "End", "Strand"] + self.columns) + "\n"
+            for record, row in zip(self.table.records(), zip(*columns)):
+                yield "\t".join(str(field) for field in record + row) + "\n"
+
+    def write_text(self, out):
+        """ Write the table as text, identical to the text output of the script that wrote it """
+        with open(out, "w") as out_handle:
+            out_handle.writelines(self.text_lines())
+
+
+def main(args):
+    logging.info("Columnar table: {path}, Outfile: {out}".format(path=args.path, out=args.out))
+    with ColumnTable(args.path) as columns:
+        logging.info("{kind} table of {n} introns, columns: {columns}".format(kind=columns.kind, n=len(columns),
+                                                                             columns=", ".join(columns.columns)))
+        metrics.count("introns", len(columns))
+        with metrics.stage("write"):
+            columns.write_text(args.out)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s : %(message)s', level=logging.INFO)
+
+
+    def is_valid_file(parser, arg):
+        """ Check if file exists """
+        if not os.path.isfile(arg):
+            parser.error('The file at %s does not exist' % arg)
+        else:
+            return arg
+
+
+    epilog = "EXAMPLE: python " + os.path.basename(__file__) + \
+             " --columns /path/to/sample_msi.npz  --out /path/to/sample_msi.xls"
+
+    parser = argparse.ArgumentParser(description="Script to convert a columnar MSI or intron type table to text",
+                                     epilog=epilog)
+
+    required_args_group = parser.add_argument_group('required arguments')
+    required_args_group.add_argument('-c', '--columns', dest='path', required=True,
+                                     type=lambda x: is_valid_file(parser, x))
+    required_args_group.add_argument('-o', '--out', dest='out', required=True)
+
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
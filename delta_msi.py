@@ -0,0 +1,327 @@
+# ---------------------- delta msi -------------------------------------------
+# Python port of deltaMSI.R for many treatment/control pairs at once. All
+# MSI tables are read once, their ids are turned into integer intron keys
+# shared by every table, and the QC filters, DeltaMSI, Fisher's exact test
+# and the Holm adjustment run on whole pair x intron arrays. The output per
+# pair has the layout of deltaMSI.R.
+# ----------------------------------------------------------------------------
+import argparse
+import logging
+import os
+
+import numpy as np
+
+import columnar
+import metrics
+
+# Columns every MSI table needs, see get_msi.MSI_HEADER
+REQUIRED_COLUMNS = ("A1", "A2", "Exon", "CovFrac", "MSI")
+# Output column groups after the coordinates, like the starts_with selection of deltaMSI.R
+OUTPUT_PREFIXES = ("MSI", "A1", "A2", "Exon", "CovFrac")
+# Two sided Fisher p-values add up the tables at most this much more likely than the observed one, as in R
+RELATIVE_ERROR = 1 + 1e-7
+# Support elements of the Fisher test handled per vectorised chunk
+FISHER_CHUNK = 1 << 22
+
+
+def read_msi(path):
+    """
+    Read an MSI table of get_msi.py, text or columnar
+    :return: tuple of (list of ids, dict of column name to float array)
+    """
+    if columnar.is_columnar(path):
+        with columnar.ColumnTable(path) as table:
+            return table.table.ids(), {column: table[column].astype(np.float64) for column in table.columns}
+    with open(path) as in_handle:
+        columns = next(in_handle).rstrip("\n").split("\t")
+        rows = [line.rstrip("\n").split("\t") for line in in_handle if line.strip()]
+    ids = [row[0] for row in rows]
+    values = np.array([row[1:] for row in rows], dtype=np.float64).reshape(len(rows), len(columns) - 1)
+    return ids, {column: values[:, k] for k, column in enumerate(columns[1:])}
+
+
+class MSITables(object):
+    """
+    MSI tables of many samples on shared integer intron keys: every column is
+    a samples x keys array, present marks the introns each table has.
+    """
+
+    def __init__(self, tables):
+        """
+        :param tables: dict of sample name to (ids, columns) from read_msi
+        """
+        self.names = list(tables)
+        self.ids, inverse = np.unique(np.concatenate([np.asarray(ids, dtype=object) for ids, _ in tables.values()]
+                                                     or [np.array([], dtype=object)]), return_inverse=True)
+        # Columns of every table, subsampled tables have the MSI bounds on top of REQUIRED_COLUMNS
+        self.sample_columns = [list(columns) for _, columns in tables.values()]
+        self.columns = list()
+        for name, columns in zip(self.names, self.sample_columns):
+            missing = [column for column in REQUIRED_COLUMNS if column not in columns]
+            if missing:
+                raise ValueError("MSI table of {} has no {} column".format(name, ", ".join(missing)))
+            self.columns.extend(column for column in columns if column not in self.columns)
+        # Keys of every table in its own row order
+        self.keys, offset = list(), 0
+        for ids, _ in tables.values():
+            self.keys.append(inverse[offset:offset + len(ids)])
+            offset += len(ids)
+        shape = (len(self.names), len(self.ids))
+        self.present = np.zeros(shape, dtype=bool)
+        self.values = {column: np.full(shape, np.nan) for column in self.columns}
+        for sample, (keys, (_, columns)) in enumerate(zip(self.keys, tables.values())):
+            self.present[sample, keys] = True
+            for column, values in columns.items():
+                self.values[column][sample, keys] = values
+
+
+def log_factorials(size):
+    """ log(i!) for i in 0..size """
+    return np.concatenate([[0.0], np.cumsum(np.log(np.arange(1, size + 1, dtype=np.float64)))])
+
+
+def fisher_exact(table):
+    """
+    Two sided p-values of Fisher's exact test for many 2x2 tables, computed
+    like R's fisher.test: the conditional hypergeometric probabilities of all
+    tables with the observed margins are summed where they are not larger
+    than the probability of the observed table.
+    :param table: int array of shape (n, 4) holding x11, x21, x12, x22
+                  (matrix(c(x11, x21, x12, x22), nrow = 2) in R)
+    :return: float array of n p-values
+    """
+    table = np.asarray(table, dtype=np.int64).reshape(-1, 4)
+    pvalues = np.ones(len(table))
+    if not len(table):
+        return pvalues
+    # Many introns share their tables, test every distinct table once
+    unique, inverse = np.unique(table, axis=0, return_inverse=True)
+    x = unique[:, 0]
+    m, n, k = unique[:, 0] + unique[:, 1], unique[:, 2] + unique[:, 3], unique[:, 0] + unique[:, 2]
+    lo, hi = np.maximum(0, k - n), np.minimum(k, m)
+    log_fact = log_factorials(int((m + n).max()))
+    unique_pvalues = np.ones(len(unique))
+
+    sizes = hi - lo + 1
+    cum_sizes = np.cumsum(sizes)
+    begin = 0
+    while begin < len(unique):
+        done = cum_sizes[begin - 1] if begin else 0
+        end = max(begin + 1, int(np.searchsorted(cum_sizes, done + FISHER_CHUNK, side="right")))
+        rows = np.arange(begin, min(end, len(unique)))
+        rows = rows[sizes[rows] > 1]
+        begin = end
+        if not len(rows):
+            continue
+        starts = np.concatenate([[0], np.cumsum(sizes[rows])[:-1]])
+        owner = np.repeat(np.arange(len(rows)), sizes[rows])
+        support = lo[rows][owner] + np.arange(len(owner)) - starts[owner]
+        row_m, row_n, row_k = m[rows][owner], n[rows][owner], k[rows][owner]
+        # log dhyper up to a constant per table, it cancels in the normalisation
+        log_d = (-log_fact[support] - log_fact[row_m - support] - log_fact[row_k - support]
+                 - log_fact[row_n - row_k + support])
+        d = np.exp(log_d - np.maximum.reduceat(log_d, starts)[owner])
+        observed = d[starts + x[rows] - lo[rows]]
+        extreme = np.add.reduceat(np.where(d <= observed[owner] * RELATIVE_ERROR, d, 0), starts)
+        unique_pvalues[rows] = np.clip(extreme / np.add.reduceat(d, starts), 0, 1)
+    pvalues[:] = unique_pvalues[inverse.ravel()]
+    return pvalues
+
+
+def holm(pvalues):
+    """
+    Holm adjusted p-values, R's p.adjust default
+    """
+    size = len(pvalues)
+    order = np.argsort(pvalues, kind="stable")
+    adjusted = np.empty(size)
+    adjusted[order] = np.minimum(1, np.maximum.accumulate((size - np.arange(size)) * pvalues[order]))
+    return adjusted
+
+
+def delta_msi(tables, pairs):
+    """
+    Filter, DeltaMSI, p-values and adjusted p-values for many pairs
+    :param tables: MSITables
+    :param pairs: list of (treatment sample, control sample)
+    :return: list per pair of dict with keys (int array, in treatment table order, sorted by padj),
+             delta, pval and padj arrays aligned with the keys
+    """
+    trt = np.array([tables.names.index(pair[0]) for pair in pairs], dtype=np.int64)
+    ctrl = np.array([tables.names.index(pair[1]) for pair in pairs], dtype=np.int64)
+    values = tables.values
+
+    # QC filters of deltaMSI.R on pairs x keys arrays
+    def either(column, threshold):
+        return (values[column][trt] > threshold) | (values[column][ctrl] > threshold)
+
+    junction = values["A1"] + values["A2"]
+    keep = tables.present[trt] & tables.present[ctrl] & either("A1", 1) & either("A2", 1) & \
+        ((junction[trt] > 4) | (junction[ctrl] > 4)) & either("CovFrac", 0.95)
+    delta = values["MSI"][trt] - values["MSI"][ctrl]
+
+    # Fisher tests of all pairs together, matrix(c(Exon_trt, Exon_ctrl, Intron_trt, Intron_ctrl), nrow = 2)
+    pair_rows, key_rows = np.nonzero(keep)
+    counts = np.stack([values["Exon"][trt[pair_rows], key_rows], values["Exon"][ctrl[pair_rows], key_rows],
+                       junction[trt[pair_rows], key_rows], junction[ctrl[pair_rows], key_rows]], axis=1)
+    metrics.count("fisher_tests", len(counts))
+    pvalues = np.ones(keep.shape)
+    pvalues[pair_rows, key_rows] = fisher_exact(np.rint(counts))
+
+    results = list()
+    for pair in range(len(pairs)):
+        # Rows follow the treatment table, like the inner join
+        keys = tables.keys[trt[pair]]
+        keys = keys[keep[pair, keys]]
+        pval = pvalues[pair, keys]
+        padj = holm(pval)
+        order = np.argsort(padj, kind="stable")
+        results.append({"keys": keys[order], "delta": delta[pair, keys][order], "pval": pval[order],
+                        "padj": padj[order]})
+    return results
+
+
+def format_number(value):
+    """
+    Format a number the way R's write.table does: up to 15 significant
+    digits, in scientific notation when that is shorter
+    """
+    if np.isnan(value):
+        return "NA"
+    if np.isinf(value):
+        return "Inf" if value > 0 else "-Inf"
+    if value == 0:
+        return "0"
+    mantissa, exponent = "{:.14e}".format(value).split("e")
+    mantissa = mantissa.rstrip("0").rstrip(".")
+    exponent = int(exponent)
+    digits = len(mantissa.lstrip("-").replace(".", ""))
+    scientific = "{}e{}{:02d}".format(mantissa, "-" if exponent < 0 else "+", abs(exponent))
+    fixed = "{:.{}f}".format(value, max(0, digits - 1 - exponent))
+    return fixed if len(fixed) <= len(scientific) else scientific
+
+
+def write_delta_msi(tables, pair, result, out):
+    """
+    Write the deltaMSI table of one pair in the layout of deltaMSI.R
+    :param tables: MSITables
+    :param pair: (treatment sample, control sample)
+    :param result: dict from delta_msi
+    :param out: output file
+    """
+    trt, ctrl = (tables.names.index(name) for name in pair)
+    # starts_with keeps the order of the joined table: the treatment columns, then the control ones
+    columns = [(column, sample, name) for prefix in OUTPUT_PREFIXES for sample, name in ((trt, pair[0]),
+                                                                                         (ctrl, pair[1]))
+               for column in tables.sample_columns[sample] if column.startswith(prefix)]
+    header = ["Chrom", "Start", "End", "Strand", "DeltaMSI", "pval", "padj"] + \
+        ["{}_{}".format(column, name) for column, _, name in columns]
+    keys = result["keys"]
+    fields = [[format_number(value) for value in result[name].tolist()] for name in ("delta", "pval", "padj")]
+    fields += [[format_number(value) for value in tables.values[column][sample, keys].tolist()]
+               for column, sample, _ in columns]
+    with open(out, "w") as out_handle:
+        out_handle.write("\t".join(header) + "\n")
+        for intron_id, row in zip(tables.ids[keys].tolist(), zip(*fields)):
+            out_handle.write("\t".join(intron_id.split("|") + list(row)) + "\n")
+
+
+def read_pairs(pairs):
+    """
+    Read a tab separated pair sheet of treatment name, treatment MSI table, control name, control MSI table
+    :return: list of (trtname, trt table, cntname, cnt table) tuples
+    """
+    rows = list()
+    with open(pairs) as in_handle:
+        for line in in_handle:
+            if not line.strip() or line.startswith("#"):
+                continue
+            rows.append(tuple(line.rstrip("\n").split("\t")[:4]))
+    return rows
+
+
+def main(args):
+    logging.info("Received the following args: \n {}".format(args))
+
+    if args.pairs:
+        pairs = read_pairs(args.pairs)
+    else:
+        pairs = [(args.trtname, args.trt, args.cntname, args.cnt)]
+    outdir = args.outdir or os.getcwd()
+    if args.pairs and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # A table used by several pairs is read once
+    samples = dict()
+    for trtname, trt, cntname, cnt in pairs:
+        for name, path in ((trtname, trt), (cntname, cnt)):
+            if samples.setdefault(name, path) != path:
+                raise ValueError("Sample {} is given with two MSI tables".format(name))
+    with metrics.stage("read"):
+        tables = MSITables({name: read_msi(path) for name, path in samples.items()})
+    metrics.count("samples", len(samples))
+    metrics.count("introns", len(tables.ids))
+
+    sample_pairs = [(trtname, cntname) for trtname, _, cntname, _ in pairs]
+    logging.info("Comparing {} pairs over {} introns".format(len(sample_pairs), len(tables.ids)))
+    with metrics.stage("delta"):
+        results = delta_msi(tables, sample_pairs)
+    with metrics.stage("write"):
+        for pair, result in zip(sample_pairs, results):
+            out = os.path.join(outdir, "{}_vs_{}_deltaMSI.xls".format(*pair)) if args.pairs else args.out
+            logging.info("Writing {n} introns of {trt} vs {cnt} to {out}".format(n=len(result["keys"]), trt=pair[0],
+                                                                                 cnt=pair[1], out=out))
+            write_delta_msi(tables, pair, result, out)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s : %(message)s', level=logging.INFO)
+
+
+    def is_valid_file(parser, arg):
+        """ Check if file exists """
+        if not os.path.isfile(arg):
+            parser.error('The file at %s does not exist' % arg)
+        else:
+            return arg
+
+
+    epilog = "EXAMPLE: python " + os.path.basename(__file__) + \
+             " --trt /path/to/trt_msi.xls --cnt /path/to/cnt_msi.xls --trtname trt --cntname cnt" \
+             " --out /path/to/deltaMSI.xls"
+
+    parser = argparse.ArgumentParser(description="Calculate deltaMSI of treatment and control MSI tables like "
+                                                 "deltaMSI.R, for one pair or many pairs at once", epilog=epilog)
+
+    parser.add_argument('-t', '--trt', dest='trt', type=lambda x: is_valid_file(parser, x),
+                        help="MSI file for treatment")
+    parser.add_argument('-c', '--cnt', dest='cnt', type=lambda x: is_valid_file(parser, x),
+                        help="MSI file for control")
+    parser.add_argument('-a', '--trtname', dest='trtname', default="trt",
+                        help="Sample name for treatment. DEFAULT: trt")
+    parser.add_argument('-b', '--cntname', dest='cntname', default="ctrl",
+                        help="Sample name for control. DEFAULT: ctrl")
+    parser.add_argument('-o', '--out', dest='out', help="Outfile of a single pair")
+    parser.add_argument('-p', '--pairs', dest='pairs', type=lambda x: is_valid_file(parser, x),
+                        help="Tab separated file of treatment name, treatment MSI file, control name and control "
+                             "MSI file per pair, written to {TRT}_vs_{CNT}_deltaMSI.xls in --outdir")
+    parser.add_argument('--outdir', dest='outdir', help="Directory for the --pairs outputs. DEFAULT: current dir")
+
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.pairs:
+        if args.trt or args.cnt or args.out:
+            parser.error("--pairs can not be combined with --trt, --cnt or --out")
+        for trtname, trt, cntname, cnt in read_pairs(args.pairs):
+            is_valid_file(parser, trt)
+            is_valid_file(parser, cnt)
+    elif not (args.trt and args.cnt and args.out):
+        parser.error("give --trt, --cnt and --out, or --pairs")
+    elif args.trtname == args.cntname:
+        parser.error("--trtname and --cntname have to differ")
+
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
@@ -0,0 +1,186 @@
+# ---------------------- exon index ------------------------------------------
+# Compact on disk interval index over the exons of an annotation. Per
+# chromosome the exon starts are sorted, with the ends and the running
+# maximum of the ends alongside, so "is this interval inside / overlapping
+# any exon" is two binary searches. The file is memory mapped on open.
+# ----------------------------------------------------------------------------
+
+import argparse
+import logging
+import os
+
+import numpy as np
+
+import array_store
+import gtf_reader
+import metrics
+
+MAGIC = b"EXIDX\x00\x00\x01"
+VERSION = 2
+# Arrays stored per index, in this order, each as little endian int64
+FIELDS = ("starts", "ends", "max_ends")
+DTYPE = np.dtype("<i8")
+
+
+class ExonIndex(object):
+    """
+    Exons as sorted per chromosome arrays. Coordinates are stored as given,
+    an interval (start, end) is inside an exon when exon_start <= start and
+    end <= exon_end, like bedtools intersect -f 1 on bed style intervals.
+    """
+
+    def __init__(self, chroms, arrays, buffer=None):
+        """
+        :param chroms: dict of chrom to (offset, count) into the arrays
+        :param arrays: dict of field to int64 array, see FIELDS
+        :param buffer: mmap backing the arrays, if any
+        """
+        self.chroms = chroms
+        self.arrays = arrays
+        self.buffer = buffer
+
+    @classmethod
+    def from_exons(cls, exons):
+        """
+        Build an index from (chrom, start, end, ...) tuples
+        """
+        per_chrom = dict()
+        for exon in exons:
+            per_chrom.setdefault(exon[0], []).append((exon[1], exon[2]))
+        chroms, starts, ends, max_ends = dict(), [], [], []
+        offset = 0
+        for chrom in sorted(per_chrom):
+            intervals = np.array(sorted(per_chrom[chrom]), dtype=np.int64).reshape(-1, 2)
+            chroms[chrom] = (offset, len(intervals))
+            starts.append(intervals[:, 0])
+            ends.append(intervals[:, 1])
+            max_ends.append(np.maximum.accumulate(intervals[:, 1]))
+            offset += len(intervals)
+        arrays = dict()
+        for field, parts in zip(FIELDS, (starts, ends, max_ends)):
+            arrays[field] = np.concatenate(parts).astype(DTYPE) if parts else np.array([], dtype=DTYPE)
+        return cls(chroms, arrays)
+
+    @classmethod
+    def from_annotation(cls, path):
+        """
+        Build an index from the exons of a gffutils db, a gtf or an annotation snapshot
+        """
+        return cls.from_exons(gtf_reader.read_structure(path)[1])
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory map an index written by save
+        """
+        meta, arrays, buffer = array_store.open_arrays(path, MAGIC, VERSION)
+        return cls({chrom: tuple(span) for chrom, span in meta["chroms"].items()}, arrays, buffer)
+
+    def save(self, path):
+        """
+        Write the index
+        """
+        array_store.write_arrays(path, MAGIC, VERSION, {"chroms": self.chroms},
+                                 {field: np.asarray(self.arrays[field], dtype=DTYPE) for field in FIELDS})
+
+    def close(self):
+        if self.buffer is not None:
+            self.arrays = dict()
+            self.buffer.close()
+            self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.arrays["starts"])
+
+    def _chrom_arrays(self, chrom):
+        offset, count = self.chroms[chrom]
+        return tuple(self.arrays[field][offset:offset + count] for field in FIELDS)
+
+    def _any_before(self, chrom, limits, side, reach, strict):
+        """
+        For every query, does any exon starting before the limit end beyond reach
+        """
+        limits, reach = np.atleast_1d(np.asarray(limits, dtype=np.int64)), np.atleast_1d(np.asarray(reach))
+        if chrom not in self.chroms:
+            return np.zeros(len(limits), dtype=bool)
+        starts, _, max_ends = self._chrom_arrays(chrom)
+        last = np.searchsorted(starts, limits, side=side) - 1
+        furthest = max_ends[np.maximum(last, 0)]
+        return (last >= 0) & ((furthest > reach) if strict else (furthest >= reach))
+
+    def contains(self, chrom, starts, ends):
+        """
+        Which intervals lie fully inside at least one exon
+        :param chrom: chromosome of the intervals
+        :param starts: array (or scalar) of interval starts
+        :param ends: array (or scalar) of interval ends
+        :return: boolean array
+        """
+        return self._any_before(chrom, starts, "right", ends, strict=False)
+
+    def overlaps(self, chrom, starts, ends):
+        """
+        Which half open intervals share at least one base with an exon
+        :return: boolean array
+        """
+        return self._any_before(chrom, ends, "left", starts, strict=True)
+
+    def exons(self, chrom):
+        """
+        Exons of a chromosome as (starts, ends) arrays, sorted by start
+        """
+        if chrom not in self.chroms:
+            return np.array([], dtype=DTYPE), np.array([], dtype=DTYPE)
+        return self._chrom_arrays(chrom)[:2]
+
+
+def main(args):
+    logging.info("Annotation: {annotation}, Outfile: {out}".format(annotation=args.annotation, out=args.out))
+    with metrics.stage("build"):
+        index = ExonIndex.from_annotation(args.annotation)
+    logging.info("Writing {} exons over {} chromosomes".format(len(index), len(index.chroms)))
+    metrics.count("exons", len(index))
+    with metrics.stage("write"):
+        index.save(args.out)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s : %(message)s', level=logging.INFO)
+
+
+    def is_valid_file(parser, arg):
+        """ Check if file exists """
+        if not os.path.isfile(arg):
+            parser.error('The file at %s does not exist' % arg)
+        else:
+            return arg
+
+
+    epilog = "EXAMPLE: python " + os.path.basename(__file__) + \
+             " --annotation /path/to/gtf.db  --out /path/to/gtf.exons.idx"
+
+    parser = argparse.ArgumentParser(description="Script to build an on disk exon index from a gtf or gtf db",
+                                     epilog=epilog)
+
+    required_args_group = parser.add_argument_group('required arguments')
+    required_args_group.add_argument('-a', '--annotation', dest='annotation', required=True,
+                                     help="gtf (may be gzipped), gffutils db or annotation snapshot",
+                                     type=lambda x: is_valid_file(parser, x))
+
+    parser.add_argument('-o', '--out', dest='out', help="DEFAULT: {ANNOTATION_BASE}.exons.idx")
+
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if not args.out:
+        args.out = "{base}.exons.idx".format(base=os.path.splitext(args.annotation)[0])
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
@@ -3,45 +3,199 @@
 # It will print the transcript/gene ids to an output file
 # This output file can be then be used in combination with grep to filter the gtf.
 # eg. grep -v -f outfile.txt base.gtf
+# or the filtered gtf can be written directly with --filtered-gtf
 # -------------------------------------------------------------------------------
 
 import argparse
+import gzip
 import logging
 import os
+import re
+import sqlite3
 
 import gffutils
-
-
-def main(args):
-
-    logging.info("GTF:{gtf_db}, Transtypes:{transtypes}, outfile:{out}".format(gtf_db=args.gtf_db,
-                                                                               transtypes=args.transtypes,
-                                                                               out=args.out))
-
+import numpy as np
+
+import gtf_reader
+import metrics
+from annotation_snapshot import AnnotationSnapshot
+
+GENE_ID_RE = re.compile(r'gene_id "([^"]*)"')
+TRANSCRIPT_ID_RE = re.compile(r'transcript_id "([^"]*)"')
+TRANSCRIPT_TYPE_RE = re.compile(r'transcript_type "([^"]*)"')
+
+# Transcripts of every gene with the number of transcripts of that gene, the set based
+# version of the gffutils children walk in get_filtered_ids_gffutils
+FILTER_SQL = """
+WITH gene_transcripts AS (
+    SELECT DISTINCT relations.parent AS gene, relations.child AS transcript
+    FROM relations
+    JOIN features AS genes ON genes.id = relations.parent
+    JOIN features AS transcripts ON transcripts.id = relations.child
+    WHERE genes.featuretype = 'gene' AND transcripts.featuretype = 'transcript'
+),
+transcript_counts AS (
+    SELECT gene, COUNT(*) AS n FROM gene_transcripts GROUP BY gene
+),
+matching AS (
+    SELECT DISTINCT features.id AS transcript
+    FROM features, json_each(features.attributes, '$.transcript_type') AS types
+    WHERE features.featuretype = 'transcript' AND types.value IN ({placeholders})
+)
+SELECT gene_transcripts.gene, gene_transcripts.transcript, transcript_counts.n
+FROM gene_transcripts
+JOIN transcript_counts ON transcript_counts.gene = gene_transcripts.gene
+JOIN matching ON matching.transcript = gene_transcripts.transcript
+"""
+
+
+def get_filtered_ids_gffutils(gtf_db, transtypes):
+    """
+    Walk every gene and its transcripts in the gffutils db
+    :param gtf_db: path to gffutils db
+    :param transtypes: transcript types to filter
+    :return: set of gene/transcript ids
+    """
     filtered_ids = set()
 
     # GTF db to be imported for filtering
-    gtf_db = gffutils.FeatureDB(args.gtf_db)
+    gtf_db = gffutils.FeatureDB(gtf_db)
 
     # Lets go through all the genes in the gtf
     for gene in gtf_db.features_of_type('gene'):
         # For every gene iterate over its transcripts
         for transcript in gtf_db.children(gene, featuretype='transcript'):
             # If it has any of the filtered attributes the process it
-            if set(transcript.attributes['transcript_type']).intersection(args.transtypes):
+            if set(transcript.attributes['transcript_type']).intersection(transtypes):
                 # If it is a single transcript gene we just remove that gene itself
                 if len(list(gtf_db.children(gene, featuretype='transcript'))) == 1:
                     filtered_ids.add(gene.id)
                 # Else remove just the transcripts
                 else:
                     filtered_ids.add(transcript.id)
+    return filtered_ids
+
+
+def get_filtered_ids_sql(gtf_db, transtypes):
+    """
+    Same filter as get_filtered_ids_gffutils, resolved by a single aggregate query
+    """
+    transtypes = sorted(set(transtypes))
+    conn = sqlite3.connect(gtf_db)
+    try:
+        rows = conn.execute(FILTER_SQL.format(placeholders=", ".join("?" * len(transtypes))), transtypes).fetchall()
+    finally:
+        conn.close()
+    # If it is a single transcript gene we just remove that gene itself
+    return set(gene if n_transcripts == 1 else transcript for gene, transcript, n_transcripts in rows)
+
+
+def get_filtered_ids_gtf(gtf, transtypes):
+    """
+    Same filter as get_filtered_ids_gffutils in one streaming pass over the gtf. Genes and transcripts
+    are linked by any line naming both, as in a gffutils db made from the gtf.
+    """
+    genes, transcript_types, gene_transcripts = set(), dict(), dict()
+    for _, _, featuretype, _, _, _, _, _, attributes in gtf_reader.iter_gtf(gtf):
+        gene_id, transcript_id = GENE_ID_RE.search(attributes), TRANSCRIPT_ID_RE.search(attributes)
+        if featuretype == "gene" and gene_id:
+            genes.add(gene_id.group(1))
+        elif featuretype == "transcript" and transcript_id:
+            transcript_types[transcript_id.group(1)] = set(TRANSCRIPT_TYPE_RE.findall(attributes))
+        if gene_id and transcript_id:
+            gene_transcripts.setdefault(gene_id.group(1), set()).add(transcript_id.group(1))
+
+    transtypes = set(transtypes)
+    filtered_ids = set()
+    for gene_id in genes:
+        transcripts = [transcript_id for transcript_id in gene_transcripts.get(gene_id, ())
+                       if transcript_id in transcript_types]
+        for transcript_id in transcripts:
+            if transcript_types[transcript_id] & transtypes:
+                filtered_ids.add(gene_id if len(transcripts) == 1 else transcript_id)
+    return filtered_ids
+
+
+def get_filtered_ids_snapshot(snapshot, transtypes):
+    """
+    Same filter as the gffutils walk in main, on the arrays of an annotation snapshot
+    :param snapshot: AnnotationSnapshot
+    :param transtypes: transcript types to filter
+    :return: set of gene/transcript ids
+    """
+    offsets, codes, values = snapshot.attribute_value_codes("transcript", "transcript_type")
+    matching_codes = np.array([code for code, value in enumerate(values) if value in set(transtypes)], dtype=np.int32)
+    # Transcripts with any matching value of a repeated transcript_type
+    value_rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    matching_rows = np.unique(value_rows[np.isin(codes, matching_codes)])
+
+    # Transcript features of gene features
+    gene = snapshot.arrays["transcript_gene"]
+    gene_has_feature = snapshot.arrays["gene_has_feature"].astype(bool)
+    transcripts = np.flatnonzero(snapshot.arrays["transcript_has_feature"].astype(bool) & (gene >= 0))
+    transcripts = transcripts[gene_has_feature[gene[transcripts]]]
+    n_transcripts = np.bincount(gene[transcripts], minlength=len(gene_has_feature))
+
+    matching = transcripts[np.isin(transcripts, matching_rows)]
+    # Single transcript genes go as a whole
+    single = n_transcripts[gene[matching]] == 1
+    gene_ids, transcript_ids = snapshot.ids("gene"), snapshot.ids("transcript")
+    return (set(gene_ids[row] for row in gene[matching[single]].tolist())
+            | set(transcript_ids[row] for row in matching[~single].tolist()))
+
+
+def main(args):
+
+    logging.info("GTF:{gtf_db}, Transtypes:{transtypes}, outfile:{out}".format(
+        gtf_db=args.gtf_db or args.snapshot or args.base_gtf, transtypes=args.transtypes, out=args.out))
+
+    with metrics.stage("filter"):
+        if args.snapshot:
+            with AnnotationSnapshot.open(args.snapshot) as snapshot:
+                filtered_ids = get_filtered_ids_snapshot(snapshot, args.transtypes)
+        elif args.gtf_db and args.engine == "sql":
+            filtered_ids = get_filtered_ids_sql(args.gtf_db, args.transtypes)
+        elif args.gtf_db:
+            filtered_ids = get_filtered_ids_gffutils(args.gtf_db, args.transtypes)
+        else:
+            filtered_ids = get_filtered_ids_gtf(args.base_gtf, args.transtypes)
+    logging.info("Filtering {} genes/transcripts".format(len(filtered_ids)))
+    metrics.count("filtered_ids", len(filtered_ids))
+
+    with metrics.stage("write"):
+        write_filtered_ids(filtered_ids, args.out)
+    if args.filtered_gtf:
+        logging.info("Writing filtered gtf")
+        with metrics.stage("write_filtered_gtf"):
+            write_filtered_gtf(args.base_gtf, args.filtered_gtf, filtered_ids)
 
+
+def write_filtered_ids(filtered_ids, out):
     # Write the filtered genes/transcripts to an outfile
-    with open(args.out, "w") as out_handle:
+    with open(out, "w") as out_handle:
         for filt_id in sorted(list(filtered_ids)):
             out_handle.write("{}\n".format(filt_id))
 
 
+def write_filtered_gtf(gtf, out, filtered_ids):
+    """
+    Write the gtf without the lines of the filtered genes/transcripts, the exact match
+    version of grep -v -f outfile.txt base.gtf
+    :param gtf: base gtf, may be gzipped
+    :param out: filtered gtf, gzipped when it ends in .gz
+    :param filtered_ids: set of gene/transcript ids
+    """
+    with gtf_reader.open_text(gtf) as in_handle, \
+            (gzip.open(out, "wt") if out.endswith(".gz") else open(out, "w")) as out_handle:
+        for line in in_handle:
+            if not line.startswith("#"):
+                gene_id, transcript_id = GENE_ID_RE.search(line), TRANSCRIPT_ID_RE.search(line)
+                if (gene_id and gene_id.group(1) in filtered_ids) or \
+                        (transcript_id and transcript_id.group(1) in filtered_ids):
+                    continue
+            out_handle.write(line)
+
+
 if __name__ == '__main__':
 
     logging.basicConfig(format='%(asctime)s %(levelname)s : %(message)s', level=logging.INFO)
@@ -63,12 +217,32 @@ if __name__ == '__main__':
                                      epilog=epilog)
 
     required_args_group = parser.add_argument_group('required arguments')
-    required_args_group.add_argument('-g', '--gtfdb', dest='gtf_db', required=True,
-                                     type=lambda x: is_valid_file(parser, x))
+    annotation_args_group = required_args_group.add_mutually_exclusive_group()
+    annotation_args_group.add_argument('-g', '--gtfdb', dest='gtf_db',
+                                       type=lambda x: is_valid_file(parser, x))
+    annotation_args_group.add_argument('-s', '--snapshot', dest='snapshot',
+                                       help="annotation snapshot (annotation_snapshot.py) instead of the gtf db",
+                                       type=lambda x: is_valid_file(parser, x))
+    parser.add_argument('-b', '--base-gtf', dest='base_gtf',
+                        help="gtf the db/snapshot was made from. Needed for --filtered-gtf, "
+                             "without a db/snapshot the filter runs in a single pass over it",
+                        type=lambda x: is_valid_file(parser, x))
+    parser.add_argument('-f', '--filtered-gtf', dest='filtered_gtf',
+                        help="also write the base gtf without the filtered genes/transcripts")
+    parser.add_argument('-e', '--engine', dest='engine', default="gffutils", choices=["gffutils", "sql"],
+                        help="gffutils: walk genes and transcripts of the db, "
+                             "sql: one aggregate query on the db. DEFAULT: gffutils")
     required_args_group.add_argument('-t', '--transtypes', dest='transtypes', required=True, action="append")
     parser.add_argument('-o', '--out', dest='out', help="DEFAULT: {GTF_BASE}_filt.txt")
+    metrics.add_arguments(parser)
+
     args = parser.parse_args()
+    if not (args.gtf_db or args.snapshot or args.base_gtf):
+        parser.error("one of --gtfdb, --snapshot or --base-gtf is required")
+    if args.filtered_gtf and not args.base_gtf:
+        parser.error("--filtered-gtf needs --base-gtf")
     if not args.out:
-        args.out = "{base}_filt.txt".format(base=os.path.splitext(args.gtf_db)[0])
+        args.out = "{base}_filt.txt".format(base=os.path.splitext(args.gtf_db or args.snapshot or args.base_gtf)[0])
 
-    main(args)
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
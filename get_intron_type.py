@@ -6,91 +6,85 @@
 # ----------------------------------------------------------------------------
 import argparse
 import logging
+import multiprocessing
 import os
 
+import numpy as np
 import pybedtools
-from gimmemotifs.fasta import Fasta
-from gimmemotifs.motif import read_motifs
-from gimmemotifs.scanner import Scanner
 
+import checkpoint
+import columnar
+import metrics
+import pwm_scorer
+import type_cache
+from genome_fasta import GenomeFasta, ensure_fai
+from intron_table import IntronTable, STRAND_CODES
 
-class Intron(object):
-    """
-    Class encapsulating the decision logic explicitly
-    """
-    def __init__(self, id):
-        """
-        :param id: Unique id for the intron
-        """
-        self.id = id
-        self.AT_AC_U12_b = None
-        self.GT_AG_U12_b = None
-        self.AT_AC_U12_d = None
-        self.GT_AG_U12_d = None
-        self.GT_AG_U2_d = None
-        self.GC_AG_U2_d = None
-        self.type = None
-        self.subtype = None
-        self.confidence = None
-
-    def get_type(self):
-        """
-        Classify as U12/U2 depending on PSM scores.
-        """
-        # Explicit is better than implicit
-        # Clear decision logic which may be reviewed later.
-        GT_AG_U12_diff = min(self.GT_AG_U12_d - self.GT_AG_U2_d, self.GT_AG_U12_d - self.GC_AG_U2_d)
-        AT_AC_U12_diff = min(self.AT_AC_U12_d - self.GT_AG_U2_d, self.AT_AC_U12_d - self.GC_AG_U2_d)
-        GC_AG_U2_diff = min(self.GC_AG_U2_d - self.GT_AG_U12_d, self.GC_AG_U2_d - self.AT_AC_U12_d)
-        GT_AG_U2_diff = min(self.GT_AG_U2_d - self.GT_AG_U12_d, self.GT_AG_U2_d - self.AT_AC_U12_d)
-
-        if GT_AG_U12_diff >= 25 and self.GT_AG_U12_d > self.AT_AC_U12_d:
-            self.type = "U12"
-            self.subtype = "GT_AG_U12"
-            self.confidence = "High"
-        elif GT_AG_U12_diff >= 10 and self.GT_AG_U12_d > self.AT_AC_U12_d and self.GT_AG_U12_b >= 70:
-            self.type = "U12"
-            self.subtype = "GT_AG_U12"
-            self.confidence = "Mid"
-        elif AT_AC_U12_diff >= 25 and self.AT_AC_U12_d > self.GT_AG_U12_d:
-            self.type = "U12"
-            self.subtype = "AT_AC_U12"
-            self.confidence = "High"
-        elif AT_AC_U12_diff >= 10 and self.AT_AC_U12_d > self.GT_AG_U12_d and self.AT_AC_U12_b >= 70:
-            self.type = "U12"
-            self.subtype = "AT_AC_U12"
-            self.confidence = "Mid"
-        elif GC_AG_U2_diff >= 25 and self.GC_AG_U2_d > self.GT_AG_U2_d:
-            self.type = "U2"
-            self.subtype = "GC_AG_U2"
-            self.confidence = "High"
-        elif GT_AG_U2_diff >= 25 and self.GT_AG_U2_d > self.GC_AG_U2_d:
-            self.type = "U2"
-            self.subtype = "GT_AG_U2"
-            self.confidence = "High"
-        else:
-            self.type = "U2"
-            self.subtype = "GT_AG_U2"
-            self.confidence = "Low"
 
-    def format(self):
-        """
-        Format intron for printing
-        """
-        chrom, start, end, strand = self.id.split("|")
-        return "{}\t{}\t{}\t{}\t{i.type}\t{i.subtype}\t{i.confidence}" \
-               "\t{i.AT_AC_U12_d}\t{i.GT_AG_U12_d}\t{i.GT_AG_U2_d}" \
-               "\t{i.GC_AG_U2_d}\t{i.AT_AC_U12_b}\t{i.GT_AG_U12_b}\n".format(chrom, start, end, strand, i=self)
+MOTIF_COLUMNS = ("AT_AC_U12_d", "GT_AG_U12_d", "GT_AG_U2_d", "GC_AG_U2_d", "AT_AC_U12_b", "GT_AG_U12_b")
+# Fields of get_type, as stored in a checkpoint chunk
+TYPE_FIELDS = ("type", "subtype", "confidence")
+# Introns per chunk of a resumable run, see --checkpoint
+CHECKPOINT_SIZE = 5000
 
 
-def add_unique_id(feature):
+def get_type(scores):
     """
-    Adds a unique id to each feature
-    :param feature: pybedtools feature
-    :return: updated feature with unique id added
+    Classify every intron as U12/U2 depending on PSM scores.
+    :param scores: dict of motif column (e.g. GT_AG_U12_d) to score array
+    :return: type, subtype and confidence arrays
     """
-    feature.name = "{}|{}|{}|{}".format(feature.chrom, feature.start, feature.stop, feature.strand)
-    return feature
+    # Explicit is better than implicit
+    # Clear decision logic which may be reviewed later.
+    AT_AC_U12_d, GT_AG_U12_d = scores["AT_AC_U12_d"], scores["GT_AG_U12_d"]
+    GT_AG_U2_d, GC_AG_U2_d = scores["GT_AG_U2_d"], scores["GC_AG_U2_d"]
+    AT_AC_U12_b, GT_AG_U12_b = scores["AT_AC_U12_b"], scores["GT_AG_U12_b"]
+
+    GT_AG_U12_diff = np.minimum(GT_AG_U12_d - GT_AG_U2_d, GT_AG_U12_d - GC_AG_U2_d)
+    AT_AC_U12_diff = np.minimum(AT_AC_U12_d - GT_AG_U2_d, AT_AC_U12_d - GC_AG_U2_d)
+    GC_AG_U2_diff = np.minimum(GC_AG_U2_d - GT_AG_U12_d, GC_AG_U2_d - AT_AC_U12_d)
+    GT_AG_U2_diff = np.minimum(GT_AG_U2_d - GT_AG_U12_d, GT_AG_U2_d - AT_AC_U12_d)
+
+    # Checked in order, the first rule that matches decides
+    rules = [
+        ((GT_AG_U12_diff >= 25) & (GT_AG_U12_d > AT_AC_U12_d), ("U12", "GT_AG_U12", "High")),
+        ((GT_AG_U12_diff >= 10) & (GT_AG_U12_d > AT_AC_U12_d) & (GT_AG_U12_b >= 70), ("U12", "GT_AG_U12", "Mid")),
+        ((AT_AC_U12_diff >= 25) & (AT_AC_U12_d > GT_AG_U12_d), ("U12", "AT_AC_U12", "High")),
+        ((AT_AC_U12_diff >= 10) & (AT_AC_U12_d > GT_AG_U12_d) & (AT_AC_U12_b >= 70), ("U12", "AT_AC_U12", "Mid")),
+        ((GC_AG_U2_diff >= 25) & (GC_AG_U2_d > GT_AG_U2_d), ("U2", "GC_AG_U2", "High")),
+        ((GT_AG_U2_diff >= 25) & (GT_AG_U2_d > GC_AG_U2_d), ("U2", "GT_AG_U2", "High")),
+    ]
+    default = ("U2", "GT_AG_U2", "Low")
+    conditions = [condition for condition, _ in rules]
+    return tuple(np.select(conditions, [np.full(len(AT_AC_U12_d), call[field], dtype=object) for _, call in rules],
+                           default=default[field])
+                 for field in range(3))
+
+
+def write_types(table, scores, out, types=None, out_format="text"):
+    """
+    Classify and write out the introns, ids are only formatted here
+    :param table: IntronTable
+    :param scores: dict of motif column to score array aligned with the table
+    :param out: output file
+    :param types: type, subtype and confidence arrays when already classified
+    :param out_format: text, or columnar for a columnar.py table
+    """
+    intron_types, intron_subtypes, confidences = types if types is not None else get_type(scores)
+    if out_format == "columnar":
+        columnar.write_columns(out, "types", table,
+                               [("Type", intron_types), ("SubType", intron_subtypes), ("Confidence", confidences)]
+                               + [(column, scores[column]) for column in MOTIF_COLUMNS])
+        return
+    with open(out, "w") as out_handle:
+        out_handle.write("Chrom\tStart\tEnd\tStrand\tType\tSubType\tConfidence"
+                         "\tAT_AC_U12_d\tGT_AG_U12_d\tGT_AG_U2_d\tGC_AG_U2_d\tAT_AC_U12_b\tGT_AG_U12_b\n")
+        columns = [scores[column].tolist() for column in MOTIF_COLUMNS]
+        for record, intron_type, intron_subtype, confidence, row_scores in zip(
+                table.records(), intron_types.tolist(), intron_subtypes.tolist(), confidences.tolist(),
+                zip(*columns)):
+            out_handle.write("\t".join(str(field) for field in record + (intron_type, intron_subtype, confidence)
+                                        + row_scores) + "\n")
 
 
 def adj_don(feature):
@@ -123,25 +117,75 @@ def adj_branch(feature):
     return feature
 
 
-def get_fa(intbed, genomefa, type):
+def get_fa(table, genomefa, type):
     """
     Get fasta sequence for given branch/donor
-    :param intbed: intron coords bed file
+    :param table: IntronTable, sequences are named by their row in the table
     :param genomefa: path to ref genome
     :param type: branch/donor
     :return:
     """
-    bedtool = pybedtools.BedTool(intbed).each(add_unique_id)
+    # Unstranded introns have no donor or branch side and are left unscored
+    bedtool = pybedtools.BedTool((chrom, start, end, str(row), ".", strand)
+                                 for row, (chrom, start, end, strand) in enumerate(table.records())
+                                 if strand in ("+", "-"))
     bedtool_adj = bedtool.each(adj_don) if type == "donor" else bedtool.each(adj_branch)
     return bedtool_adj.sequence(genomefa, name=True)
 
 
+def window_bounds(table, type):
+    """
+    Donor/branch windows of every intron, the adj_don / adj_branch rules on whole arrays
+    :param table: IntronTable
+    :param type: branch/donor
+    :return: start and end arrays, bed style, empty for unstranded introns as get_fa skips them
+    """
+    plus, minus = table.strand == STRAND_CODES["+"], table.strand == STRAND_CODES["-"]
+    start, end = table.start.copy(), table.start.copy()
+    if type == "donor":
+        start[plus], end[plus] = table.start[plus] - 3, table.start[plus] + 10
+        start[minus], end[minus] = table.end[minus] - 10, table.end[minus] + 3
+    else:
+        start[plus], end[plus] = table.end[plus] - 38, table.end[plus] - 8
+        start[minus], end[minus] = table.start[minus] + 8, table.start[minus] + 38
+    return start, end
+
+
+def get_motif_scores_indexed(table, genome, motifs, type):
+    """
+    Slice the donor/branch windows of all introns out of the memory mapped genome and
+    score them with the numpy scorer, same sequences and scores as get_fa + get_motif_scores
+    :param table: IntronTable
+    :param genome: genome_fasta.GenomeFasta
+    :param motifs: list of pwm_scorer.PWM
+    :param type: branch/donor
+    :return: dict of motif id to score array, NaN for introns without sequence
+    """
+    with metrics.stage("extract_{}".format(type)):
+        start, end = window_bounds(table, type)
+        # bedtools sequence is called without s=True, so windows stay on the + strand
+        windows, lengths = genome.fetch_windows(table.chrom_names(), start, end)
+        rows = np.flatnonzero(lengths >= 0)
+        codes = pwm_scorer.encode_windows(windows[rows], lengths[rows])
+    metrics.count("windows", len(rows))
+    with metrics.stage("score_{}".format(type)):
+        scored = pwm_scorer.score_codes(codes, motifs)
+    scores = dict()
+    for motif_id, motif_scores in scored.items():
+        scores[motif_id] = np.full(len(table), np.nan)
+        scores[motif_id][rows] = motif_scores
+    return scores
+
+
 def get_motif(motif_pwm):
     """
     Extract motifs from a pwm file
     :param motif_pwm: pwm file location
     :return: extracted motifs
     """
+    # gimmemotifs is slow to import and only needed by this scorer
+    from gimmemotifs.motif import read_motifs
+
     motifs = read_motifs(motif_pwm)
     for motif in motifs:
         motif.pwm_max_score()
@@ -164,12 +208,16 @@ def rescale(org_score, orig_range, new_range):
 
 
 def get_motif_scores(fa, motifs):
+    from gimmemotifs.fasta import Fasta
+    from gimmemotifs.scanner import Scanner
+
     s = Scanner()
     s.set_motifs(motifs)
     s.set_threshold(threshold=0.0)
     seqs = Fasta(fa.seqfn)
     for i, result in enumerate(s.scan(seqs, nreport=1)):
-        intron_id = seqs.ids[i]
+        # Newer bedtools append "::chrom:start-end" to the name
+        intron_id = int(seqs.ids[i].split("::")[0])
         for m, matches in enumerate(result):
             motif = motifs[m]
             for score, pos, strand in matches:
@@ -180,34 +228,233 @@ def get_motif_scores(fa, motifs):
                 yield (intron_id, motif.id, score_rescaled)
 
 
-def main(args):
-    logging.info("Received the following args: \n {}".format(args))
+def score_introns(table, genomefa, don_motifs, branch_motifs, scorer):
+    """
+    Score the donor and branch windows of all introns of a table
+    :param table: IntronTable
+    :param genomefa: path to ref genome
+    :param don_motifs: donor motifs, as read for the scorer
+    :param branch_motifs: branch motifs, as read for the scorer
+    :param scorer: numpy/gimmemotifs
+    :return: dict of motif column to score array aligned with the table
+    """
+    scores = {column: np.full(len(table), np.nan) for column in MOTIF_COLUMNS}
+    if scorer == "numpy":
+        with GenomeFasta(genomefa) as genome:
+            for suffix, type, motifs in (("d", "donor", don_motifs), ("b", "branch", branch_motifs)):
+                for motif_id, motif_scores in get_motif_scores_indexed(table, genome, motifs, type).items():
+                    scores["{}_{}".format(motif_id, suffix)] = motif_scores
+    else:
+        for suffix, type, motifs in (("d", "donor", don_motifs), ("b", "branch", branch_motifs)):
+            with metrics.stage("extract_{}".format(type)):
+                fa = get_fa(table=table, genomefa=genomefa, type=type)
+            metrics.count("temp_bytes", os.path.getsize(fa.seqfn))
+            for intron_id, motif_id, score_rescaled in get_motif_scores(fa, motifs):
+                scores.setdefault("{}_{}".format(motif_id, suffix),
+                                  np.full(len(table), np.nan))[intron_id] = score_rescaled
+    return scores
+
+
+def plan_chunks(table, size):
+    """
+    Split the introns into chunks of at most size rows, never across chromosomes
+    :return: list of row index arrays
+    """
+    chunks = list()
+    for code in range(len(table.chroms)):
+        rows = np.flatnonzero(table.chrom == code)
+        chunks.extend(rows[begin:begin + size] for begin in range(0, len(rows), size))
+    return chunks
 
-    # Vars
-    intron_dict = dict()
 
-    logging.info("Getting fa seqeunces for donor and branches")
-    don_fa = get_fa(intbed=args.intbed, genomefa=args.genomefa, type="donor")
-    branch_fa = get_fa(intbed=args.intbed, genomefa=args.genomefa, type="branch")
+# Set up once per worker process by init_worker
+_worker_state = dict()
+
 
-    logging.info("Parsing donor and branch pwm files")
-    don_motifs = get_motif(args.donorpwm)
-    branch_motifs = get_motif(args.branchpwm)
+def init_worker(table, genomefa, donorpwm, branchpwm, scorer):
+    """ Share the introns and the parsed motifs with a worker process """
+    read = pwm_scorer.read_pwms if scorer == "numpy" else get_motif
+    _worker_state.update(table=table, genomefa=genomefa, don_motifs=read(donorpwm), branch_motifs=read(branchpwm),
+                         scorer=scorer)
 
-    logging.info("Scoring fa seqeunces for motifs")
-    for intron_id, motif_id, score_rescaled in get_motif_scores(don_fa, don_motifs):
-        intron_dict.setdefault(intron_id, Intron(id=intron_id))
-        setattr(intron_dict[intron_id], "{}_d".format(motif_id), score_rescaled)
-    for intron_id, motif_id, score_rescaled in get_motif_scores(branch_fa, branch_motifs):
-        setattr(intron_dict[intron_id], "{}_b".format(motif_id), score_rescaled)
+
+def type_chunk(rows):
+    """
+    Score and classify a chunk of introns in a worker process
+    :param rows: row index array into the table
+    :return: tuple of rows, dict of motif column to scores, type/subtype/confidence arrays
+    """
+    table = _worker_state["table"].take(rows)
+    scores = score_introns(table, _worker_state["genomefa"], _worker_state["don_motifs"],
+                           _worker_state["branch_motifs"], _worker_state["scorer"])
+    return rows, scores, get_type(scores)
+
+
+def type_introns(rows, worker_args, threads, scores, types, checkpoint_dir=None, checkpoint_size=CHECKPOINT_SIZE):
+    """
+    Score and classify the given rows of the table, in a pool of processes when threads > 1
+    :param rows: row index array into the table
+    :param worker_args: init_worker arguments
+    :param threads: number of processes
+    :param scores: dict of motif column to score array aligned with the table, filled in place
+    :param types: type, subtype and confidence arrays aligned with the table, filled in place
+    :param checkpoint_dir: keep every finished chunk of checkpoint_size introns here, see type_checkpointed
+    :return: run key of the checkpoint, None without checkpoint_dir
+    """
+    def store(chunk_rows, chunk_scores, chunk_types):
+        for column, column_scores in chunk_scores.items():
+            scores.setdefault(column, np.full(len(types[0]), np.nan))[chunk_rows] = column_scores
+        for field, chunk_field in zip(types, chunk_types):
+            field[chunk_rows] = chunk_field
+
+    if checkpoint_dir:
+        return type_checkpointed(rows, worker_args, threads, store, checkpoint_dir, checkpoint_size)
+    if threads > 1:
+        # A few chunks per process keeps the pool busy when chromosomes differ in size
+        chunks = [rows[chunk] for chunk in plan_chunks(worker_args[0].take(rows),
+                                                       max(1, -(-len(rows) // (threads * 4))))]
+        logging.info("Typing {n} introns in {c} chunks with {t} processes".format(n=len(rows), c=len(chunks),
+                                                                                 t=threads))
+        pool = multiprocessing.Pool(threads, initializer=init_worker, initargs=worker_args)
+        try:
+            for chunk_rows, chunk_scores, chunk_types in pool.imap_unordered(type_chunk, chunks):
+                store(chunk_rows, chunk_scores, chunk_types)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        logging.info("Parsing donor and branch pwm files")
+        init_worker(*worker_args)
+        logging.info("Scoring donor and branch seqeunces for motifs")
+        store(*type_chunk(rows))
+
+
+def type_checkpointed(rows, worker_args, threads, store, checkpoint_dir, checkpoint_size):
+    """
+    Score and classify the rows chunk by chunk, every finished chunk is kept
+    in the checkpoint so a restarted run types only the chunks still missing.
+    :param store: called with the rows, scores and types of every chunk
+    :return: run key of the checkpoint
+    """
+    table, genomefa, donorpwm, branchpwm, scorer = worker_args
+    typed = table.take(rows)
+    key = checkpoint.run_key(genome=checkpoint.file_stamp(genomefa),
+                             pwms=type_cache.pwm_digest(donorpwm, branchpwm).hex(), scorer=scorer,
+                             chroms=list(typed.chroms), chrom=typed.chrom, start=typed.start, end=typed.end,
+                             strand=typed.strand, rows=rows, chunk_size=checkpoint_size)
+    resume = checkpoint.Checkpoint(checkpoint_dir, key)
+    chunks = [rows[chunk] for chunk in plan_chunks(typed, checkpoint_size)]
+    missing = list()
+    for number, chunk_rows in enumerate(chunks):
+        if number in resume:
+            finished = resume.load(number)
+            store(finished["rows"], {column: finished[column] for column in MOTIF_COLUMNS},
+                  tuple(finished[field].astype(object) for field in TYPE_FIELDS))
+        else:
+            missing.append(number)
+    logging.info("Typing {n} of {total} chunks".format(n=len(missing), total=len(chunks)))
+
+    def save(number, chunk_rows, chunk_scores, chunk_types):
+        store(chunk_rows, chunk_scores, chunk_types)
+        finished = {"rows": chunk_rows}
+        finished.update((column, chunk_scores[column]) for column in MOTIF_COLUMNS)
+        finished.update((field, chunk_field.astype(str)) for field, chunk_field in zip(TYPE_FIELDS, chunk_types))
+        resume.save(number, finished)
+
+    if threads > 1 and len(missing) > 1:
+        pool = multiprocessing.Pool(threads, initializer=init_worker, initargs=worker_args)
+        try:
+            for number, finished in zip(missing, pool.imap(type_chunk, [chunks[number] for number in missing])):
+                save(number, *finished)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_worker(*worker_args)
+        for number in missing:
+            save(number, *type_chunk(chunks[number]))
+    return key
+
+
+def window_keys(table, genomefa, digest):
+    """
+    Type cache keys of all introns, from their encoded donor and branch windows
+    :param table: IntronTable
+    :param genomefa: path to ref genome
+    :param digest: type_cache.pwm_digest of the donor and branch pwm files
+    :return: array of keys aligned with the table
+    """
+    windows = list()
+    with GenomeFasta(genomefa) as genome:
+        for type in ("donor", "branch"):
+            start, end = window_bounds(table, type)
+            window_bytes, lengths = genome.fetch_windows(table.chrom_names(), start, end)
+            windows.append((pwm_scorer.encode_windows(window_bytes, lengths), lengths))
+    return type_cache.call_keys(digest, windows)
+
+
+def main(args):
+    logging.info("Received the following args: \n {}".format(args))
+
+    # Vars
+    with metrics.stage("read_introns"):
+        table = IntronTable.from_bed(args.intbed)
+    metrics.count("introns", len(table))
+    if args.scorer == "numpy":
+        # Built once here, not by every worker at the same time
+        ensure_fai(args.genomefa)
+    worker_args = (table, args.genomefa, args.donorpwm, args.branchpwm, args.scorer)
+    scores = {column: np.full(len(table), np.nan) for column in MOTIF_COLUMNS}
+    types = tuple(np.empty(len(table), dtype=object) for _ in range(3))
+    checkpoint_key = None
+
+    if not args.cache:
+        with metrics.stage("type"):
+            checkpoint_key = type_introns(np.arange(len(table)), worker_args, args.threads, scores, types,
+                                          args.checkpoint, args.checkpoint_size)
+    else:
+        logging.info("Looking up donor and branch seqeunces in the type cache {}".format(args.cache))
+        with metrics.stage("cache_keys"):
+            keys = window_keys(table, args.genomefa, type_cache.pwm_digest(args.donorpwm, args.branchpwm))
+            # Introns sharing both windows are typed once
+            unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        with type_cache.TypeCache(args.cache, MOTIF_COLUMNS) as cache:
+            with metrics.stage("cache_lookup"):
+                cached = cache.lookup(unique_keys)
+            hit = np.array([key in cached for key in unique_keys.tolist()], dtype=bool)
+            for position in np.flatnonzero(hit):
+                call_scores, intron_type, intron_subtype, confidence = cached[unique_keys[position]]
+                for column, score in zip(MOTIF_COLUMNS, call_scores):
+                    scores[column][first[position]] = score
+                for field, value in zip(types, (intron_type, intron_subtype, confidence)):
+                    field[first[position]] = value
+
+            missing = first[~hit]
+            metrics.count("cache_hits", int(hit.sum()))
+            metrics.count("cache_misses", len(missing))
+            if len(missing):
+                with metrics.stage("type"):
+                    checkpoint_key = type_introns(missing, worker_args, args.threads, scores, types,
+                                                  args.checkpoint, args.checkpoint_size)
+                with metrics.stage("cache_store"):
+                    cache.store(unique_keys[~hit], {column: scores[column][missing] for column in MOTIF_COLUMNS},
+                                tuple(field[missing] for field in types))
+            logging.info("Type cache: {hits} of {n} distinct donor/branch pairs cached ({rate:.1%} hit rate), "
+                         "{new} scored".format(hits=int(hit.sum()), n=len(unique_keys), rate=cache.hit_rate(),
+                                               new=len(missing)))
+            if args.cache_max_mb is not None:
+                cache.evict(args.cache_max_mb * 1024 * 1024)
+
+        for column in MOTIF_COLUMNS:
+            scores[column] = scores[column][first][inverse]
+        types = tuple(field[first][inverse] for field in types)
 
     logging.info("Writing output")
-    with open(args.out, "w") as out_handle:
-        out_handle.write("Chrom\tStart\tEnd\tStrand\tType\tSubType\tConfidence"
-                         "\tAT_AC_U12_d\tGT_AG_U12_d\tGT_AG_U2_d\tGC_AG_U2_d\tAT_AC_U12_b\tGT_AG_U12_b\n")
-        for intron in intron_dict:
-            intron_dict[intron].get_type()
-            out_handle.write(intron_dict[intron].format())
+    with metrics.stage("write"):
+        write_types(table, scores, args.out, types, args.out_format)
+    # Kept until the output is written, a restart then only merges the finished chunks again
+    if checkpoint_key is not None:
+        checkpoint.remove(args.checkpoint, checkpoint_key)
 
 
 if __name__ == '__main__':
@@ -261,6 +508,61 @@ if __name__ == '__main__':
                         help="Out file for intron types",
                         default="inttype.xls")
 
+    parser.add_argument('--format',
+                        dest='out_format',
+                        default="text",
+                        choices=["text", "columnar"],
+                        help="text: tab separated table, columnar: compressed typed columns, convert it back "
+                             "with columnar.py. DEFAULT: text")
+
+    parser.add_argument('-s', '--scorer',
+                        dest='scorer',
+                        choices=["numpy", "gimmemotifs"],
+                        help="numpy: built in vectorised pwm scorer on windows sliced from the memory mapped, "
+                             ".fai indexed genome (the index is built when missing), gimmemotifs: "
+                             "gimmemotifs Scanner on bedtools sequences. DEFAULT: gimmemotifs",
+                        default="gimmemotifs")
+
+    parser.add_argument('-t', '--threads',
+                        dest='threads',
+                        type=int,
+                        help="Split the introns into chunks by chromosome and size and type them in this many "
+                             "processes, the output keeps the input order. DEFAULT: 1",
+                        default=1)
+
+    parser.add_argument('-c', '--cache',
+                        dest='cache',
+                        help="sqlite type cache keyed by the donor and branch sequences and the pwm files. "
+                             "Only introns with sequences not in the cache are scored, new calls are added. "
+                             "Needs the numpy scorer")
+
+    parser.add_argument('--cache-max-mb',
+                        dest='cache_max_mb',
+                        type=float,
+                        help="Evict the least recently used calls when the type cache grows past this size")
+
+    parser.add_argument('--checkpoint',
+                        dest='checkpoint',
+                        help="Keep every finished chunk of introns in this directory, a restarted run only types "
+                             "the missing chunks")
+
+    parser.add_argument('--checkpoint-size',
+                        dest='checkpoint_size',
+                        type=int,
+                        default=CHECKPOINT_SIZE,
+                        help="Introns per checkpoint chunk, chunks never span chromosomes. "
+                             "DEFAULT: {}".format(CHECKPOINT_SIZE))
+
+    metrics.add_arguments(parser)
+
     args = parser.parse_args()
 
-    main(args)
+    if args.cache and args.scorer != "numpy":
+        parser.error("--cache needs --scorer numpy")
+    if args.cache_max_mb is not None and not args.cache:
+        parser.error("--cache-max-mb needs --cache")
+    if args.checkpoint_size < 1:
+        parser.error("--checkpoint-size has to be at least 1")
+
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
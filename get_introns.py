@@ -8,8 +8,13 @@ import os
 import tempfile
 
 import gffutils
+import numpy as np
 import pybedtools
 
+import gtf_reader
+import metrics
+from exon_index import ExonIndex
+
 
 def get_exons(db):
     def gen():
@@ -40,10 +45,239 @@ def get_final_intron_bedtools(final_intron_dict):
     return pybedtools.BedTool(gen())
 
 
+def derive_introns(transcripts, exons):
+    """
+    Derive introns between consecutive exons of every transcript, following
+    gffutils create_introns: exons ordered by start, intron from one past the
+    previous exon end to one before the next exon start, overlapping exons
+    give no intron and a strand mismatch gives "."
+    :param transcripts: set of transcript ids to walk
+    :param exons: list of (chrom, start, end, strand, gene_id, transcript_id), one based
+    :return: generator of (transcript_id, gene_id, chrom, start, end, strand)
+    """
+    exons_per_transcript = dict()
+    for exon in exons:
+        if exon[5] in transcripts:
+            exons_per_transcript.setdefault(exon[5], []).append(exon)
+
+    for transcript_id, transcript_exons in exons_per_transcript.items():
+        transcript_exons.sort(key=lambda exon: exon[1])
+        for last, exon in zip(transcript_exons, transcript_exons[1:]):
+            if last[0] != exon[0] or last[2] + 1 > exon[1] - 1:
+                continue
+            # Merged attributes are sorted, so the intron takes the smaller gene id
+            gene_ids = [gene_id for gene_id in (last[4], exon[4]) if gene_id is not None]
+            yield (transcript_id, min(gene_ids) if gene_ids else None, exon[0], last[2] + 1, exon[1] - 1,
+                   exon[3] if last[3] == exon[3] else ".")
+
+
+def collapse_introns(introns, index, window_size):
+    """
+    Drop introns with either flank sitting inside any exon and merge the rest by position
+    :param introns: list of derive_introns tuples
+    :param index: ExonIndex over all exons of the annotation
+    :param window_size: size of the flanks which may not sit inside an exon
+    :return: dict of (chrom, start, end, strand) to set of gene ids, one based
+    """
+    actual_window = window_size - 1
+
+    overlapping = np.zeros(len(introns), dtype=bool)
+    chroms = np.array([intron[2] for intron in introns], dtype=object)
+    starts = np.array([intron[3] for intron in introns], dtype=np.int64)
+    ends = np.array([intron[4] for intron in introns], dtype=np.int64)
+    for chrom in set(chroms.tolist()):
+        rows = np.flatnonzero(chroms == chrom)
+        overlapping[rows] = (index.contains(chrom, starts[rows], starts[rows] + actual_window)
+                             | index.contains(chrom, ends[rows] - actual_window, ends[rows]))
+
+    final_introns = dict()
+    for intron, overlaps in zip(introns, overlapping.tolist()):
+        if not overlaps:
+            final_introns.setdefault(intron[2:], set()).add(intron[1])
+    return final_introns
+
+
+def get_final_introns_direct(path, window_size, exon_index=None):
+    """
+    Get the final introns straight from a gtf or a gffutils db in a single pass
+    :param path: gtf or gffutils db
+    :param window_size: size of the flanks which may not sit inside an exon
+    :param exon_index: prebuilt ExonIndex of the same annotation, built from the exons when None
+    :return: dict of (chrom, start, end, strand) to set of gene ids, one based
+    """
+    logging.info("Reading exons")
+    with metrics.stage("read_annotation"):
+        transcripts, exons = gtf_reader.read_structure(path)
+    metrics.count("exons", len(exons))
+
+    logging.info("Creating a list of introns")
+    with metrics.stage("derive_introns"):
+        introns = list(derive_introns(transcripts, exons))
+    metrics.count("introns", len(introns))
+
+    logging.info("Finding introns overlapping exons and collapsing")
+    with metrics.stage("exon_overlap"):
+        return collapse_introns(introns, ExonIndex.from_exons(exons) if exon_index is None else exon_index,
+                                window_size)
+
+
+def gene_signatures(transcripts, exons):
+    """
+    Everything about a gene that feeds into the introns: its exons and whether their transcript gets walked
+    :param transcripts: set of transcript ids walked by create_introns
+    :param exons: list of (chrom, start, end, strand, gene_id, transcript_id), one based
+    :return: dict of gene_id to sorted tuple of (chrom, start, end, strand, transcript_id, walked)
+    """
+    signatures = dict()
+    for chrom, start, end, strand, gene_id, transcript_id in exons:
+        signatures.setdefault(gene_id, []).append((chrom, start, end, strand, str(transcript_id),
+                                                   transcript_id in transcripts))
+    return {gene_id: tuple(sorted(signature)) for gene_id, signature in signatures.items()}
+
+
+def changed_regions(old_signatures, new_signatures):
+    """
+    Loci whose introns may differ between two annotations: the old and new span of every added, removed
+    or changed gene. An intron of an unchanged gene outside these loci has the same exons around it.
+    :return: tuple of list of (chrom, start, end) regions, one based closed, and dict of change counts
+    """
+    counts = {"added": 0, "removed": 0, "changed": 0}
+    regions = list()
+    for gene_id in set(old_signatures) | set(new_signatures):
+        old, new = old_signatures.get(gene_id), new_signatures.get(gene_id)
+        if old == new:
+            continue
+        counts["added" if old is None else "removed" if new is None else "changed"] += 1
+        for signature in (old, new):
+            spans = dict()
+            for chrom, start, end, _, _, _ in signature or ():
+                span = spans.setdefault(chrom, [start, end])
+                span[0], span[1] = min(span[0], start), max(span[1], end)
+            regions.extend((chrom, start, end) for chrom, (start, end) in spans.items())
+    return regions, counts
+
+
+def read_final_introns(bed):
+    """
+    Read an introns bed written by this script
+    :return: dict of (chrom, start, end, strand) to set of gene ids, one based
+    """
+    final_introns = dict()
+    with open(bed) as in_handle:
+        for line in in_handle:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 6:
+                continue
+            final_introns[(fields[0], int(fields[1]) + 1, int(fields[2]), fields[5])] = set(fields[3].split(","))
+    return final_introns
+
+
+def in_regions(region_index, keys):
+    """
+    Which (chrom, start, end, ...) one based closed intervals touch a region of the index
+    """
+    keys = list(keys)
+    touched = np.zeros(len(keys), dtype=bool)
+    chroms = np.array([key[0] for key in keys], dtype=object)
+    starts = np.array([key[1] for key in keys], dtype=np.int64)
+    ends = np.array([key[2] for key in keys], dtype=np.int64)
+    for chrom in set(chroms.tolist()):
+        rows = np.flatnonzero(chroms == chrom)
+        touched[rows] = region_index.overlaps(chrom, starts[rows], ends[rows] + 1)
+    return touched.tolist()
+
+
+def get_final_introns_incremental(path, window_size, previous_bed, previous_annotation, exon_index=None):
+    """
+    Update the introns of a previous release: introns away from added, removed or changed genes are
+    taken from the previous bed, only the changed loci are derived again from the new annotation
+    :param path: new gtf or gffutils db
+    :param window_size: flank size, has to match the run that wrote previous_bed
+    :param previous_bed: introns bed of the previous annotation
+    :param previous_annotation: previous gtf or gffutils db
+    :param exon_index: prebuilt ExonIndex of the new annotation, built from the exons when None
+    :return: dict of (chrom, start, end, strand) to set of gene ids, one based
+    """
+    logging.info("Reading exons")
+    with metrics.stage("read_annotation"):
+        old_transcripts, old_exons = gtf_reader.read_structure(previous_annotation)
+        transcripts, exons = gtf_reader.read_structure(path)
+    metrics.count("exons", len(exons))
+
+    with metrics.stage("changed_regions"):
+        regions, counts = changed_regions(gene_signatures(old_transcripts, old_exons),
+                                          gene_signatures(transcripts, exons))
+    logging.info("Genes added: {added}, removed: {removed}, changed: {changed}".format(**counts))
+    # Regions are one based closed, the index works on half open intervals
+    region_index = ExonIndex.from_exons((chrom, start, end + 1) for chrom, start, end in regions)
+
+    previous = read_final_introns(previous_bed)
+    final_introns = {key: previous[key] for key, touched in zip(previous, in_regions(region_index, previous))
+                     if not touched}
+    logging.info("Kept {} of {} previous introns".format(len(final_introns), len(previous)))
+
+    # Only transcripts reaching into a changed locus can give introns there
+    spans = dict()
+    for chrom, start, end, _, _, transcript_id in exons:
+        if transcript_id in transcripts:
+            span = spans.setdefault(transcript_id, [chrom, start, end])
+            span[1], span[2] = min(span[1], start), max(span[2], end)
+    affected = set(transcript_id for transcript_id, touched in zip(spans, in_regions(region_index, spans.values()))
+                   if touched)
+
+    logging.info("Creating introns for {} transcripts in changed loci".format(len(affected)))
+    with metrics.stage("derive_introns"):
+        introns = list(derive_introns(affected, exons))
+        introns = [intron for intron, touched
+                   in zip(introns, in_regions(region_index, [intron[2:] for intron in introns])) if touched]
+    metrics.count("introns", len(introns))
+    with metrics.stage("exon_overlap"):
+        recomputed = collapse_introns(introns, ExonIndex.from_exons(exons) if exon_index is None else exon_index,
+                                      window_size)
+    logging.info("Recomputed {} introns".format(len(recomputed)))
+    metrics.count("kept_introns", len(final_introns))
+    metrics.count("recomputed_introns", len(recomputed))
+    final_introns.update(recomputed)
+    return final_introns
+
+
+def write_final_introns(final_introns, out):
+    """
+    Write the final introns as a sorted bed with zero based starts
+    :param final_introns: dict of (chrom, start, end, strand) to set of gene ids, one based
+    :param out: output bed
+    """
+    with open(out, "w") as out_handle:
+        for chrom, start, end, strand in sorted(final_introns):
+            out_handle.write("{}\t{}\t{}\t{}\t.\t{}\n".format(chrom, start - 1, end,
+                                                            ",".join(sorted(final_introns[(chrom, start, end, strand)])),
+                                                            strand))
+
+
 def main(args):
     # Logging
-    logging.info("GTF: {gtf_db}, WindowSize: {window} Outfile: {out}".format(gtf_db=args.gtf_db, window=args.window,
-                                                                             out=args.out))
+    annotation = args.gtf_db or args.gtf or args.snapshot
+    logging.info("GTF: {gtf_db}, WindowSize: {window} Outfile: {out} Engine: {engine}".format(
+        gtf_db=annotation, window=args.window, out=args.out, engine=args.engine))
+
+    exon_index = ExonIndex.open(args.exon_index) if args.exon_index else None
+
+    if args.previous_bed:
+        final_introns = get_final_introns_incremental(annotation, args.window, args.previous_bed,
+                                                      args.previous_annotation, exon_index)
+        logging.info("Writing output file")
+        with metrics.stage("write"):
+            write_final_introns(final_introns, args.out)
+        metrics.count("final_introns", len(final_introns))
+        return
+
+    if args.engine == "direct":
+        final_introns = get_final_introns_direct(annotation, args.window, exon_index)
+        logging.info("Writing output file")
+        with metrics.stage("write"):
+            write_final_introns(final_introns, args.out)
+        metrics.count("final_introns", len(final_introns))
+        return
 
     # Vars
     window_size = args.window
@@ -55,8 +289,10 @@ def main(args):
     # Get the list of introns and add a flank to it
     flanked_introns = list()
     logging.info("Creating a list of introns. This will take a while. Be Patient")
-    introns = list(db.create_introns())
+    with metrics.stage("create_introns"):
+        introns = list(db.create_introns())
     logging.info("Intron List Created")
+    metrics.count("introns", len(introns))
     for intron in introns:
         # Create a unique id
         intron_id = "{}|{}|{}|{}|{}".format(intron.attributes["transcript_id"][0],
@@ -67,15 +303,21 @@ def main(args):
         # Create the right flank
         flanked_introns.append((intron.chrom, intron.end - actual_window, intron.end, intron_id, intron.strand))
 
-    intron_bedtool = pybedtools.BedTool(flanked_introns)
-
-    # Get a list of exons
-    exons = get_exons(db=db)
-
     # Find overlapping introns
     logging.info("Finding introns overlapping exons")
-    overlapping_introns = intron_bedtool.intersect(exons, wa=True, f=1)
-    overlapping_introns_id = set([over_intron.name for over_intron in overlapping_introns])
+    with metrics.stage("exon_overlap"):
+        if exon_index is not None:
+            overlapping_introns_id = set(flank[3] for flank in flanked_introns
+                                         if exon_index.contains(flank[0], flank[1], flank[2])[0])
+        else:
+            intron_bedtool = pybedtools.BedTool(flanked_introns)
+
+            # Get a list of exons
+            exons = get_exons(db=db)
+
+            overlapping_introns = intron_bedtool.intersect(exons, wa=True, f=1)
+            overlapping_introns_id = set([over_intron.name for over_intron in overlapping_introns])
+            metrics.count("temp_bytes", os.path.getsize(overlapping_introns.fn))
 
     # Print the final list of introns
     # Medge introns having the same id for flanks
@@ -89,13 +331,17 @@ def main(args):
             final_introns.setdefault(intron_base_id, set())
             final_introns[intron_base_id].add(intron.attributes["gene_id"][0])
 
+    metrics.count("final_introns", len(final_introns))
+
     logging.info("Writing output file")
-    tmp_dump_file = tempfile.NamedTemporaryFile()
-    to_print_bedtools = get_final_intron_bedtools(final_introns)
-    # pybedtools has problems directly taking the bedtool for sorting
-    # Hence the need to write
-    to_print_bedtools.moveto(tmp_dump_file.name).sort().moveto(args.out)
-    tmp_dump_file.close()
+    with metrics.stage("write"):
+        tmp_dump_file = tempfile.NamedTemporaryFile()
+        to_print_bedtools = get_final_intron_bedtools(final_introns)
+        # pybedtools has problems directly taking the bedtool for sorting
+        # Hence the need to write
+        to_print_bedtools.moveto(tmp_dump_file.name).sort().moveto(args.out)
+        metrics.count("temp_bytes", os.path.getsize(tmp_dump_file.name))
+        tmp_dump_file.close()
 
 
 if __name__ == '__main__':
@@ -118,15 +364,45 @@ if __name__ == '__main__':
                                      epilog=epilog)
 
     required_args_group = parser.add_argument_group('required arguments')
-    required_args_group.add_argument('-d', '--gtfdb', dest='gtf_db', required=True,
-                                     type=lambda x: is_valid_file(parser, x))
+    annotation_args_group = required_args_group.add_mutually_exclusive_group(required=True)
+    annotation_args_group.add_argument('-d', '--gtfdb', dest='gtf_db',
+                                       type=lambda x: is_valid_file(parser, x))
+    annotation_args_group.add_argument('-g', '--gtf', dest='gtf', help="gtf file, uses the direct engine",
+                                       type=lambda x: is_valid_file(parser, x))
+    annotation_args_group.add_argument('-s', '--snapshot', dest='snapshot',
+                                       help="annotation snapshot (annotation_snapshot.py), uses the direct engine",
+                                       type=lambda x: is_valid_file(parser, x))
 
-    parser.add_argument('-w', '--window', dest='window', default=3, help="DEFAULT: 3")
+    parser.add_argument('-w', '--window', dest='window', default=3, type=int, help="DEFAULT: 3")
     parser.add_argument('-o', '--out', dest='out', help="DEFAULT: {GTF_BASE}_introns.bed")
+    parser.add_argument('-x', '--exon-index', dest='exon_index',
+                        help="prebuilt exon index of the same annotation (exon_index.py), "
+                             "replaces the bedtools exon intersect",
+                        type=lambda x: is_valid_file(parser, x))
+    parser.add_argument('--previous-bed', dest='previous_bed',
+                        help="introns bed of the previous annotation release, recompute only changed loci. "
+                             "Needs --previous-annotation and the same --window",
+                        type=lambda x: is_valid_file(parser, x))
+    parser.add_argument('--previous-annotation', dest='previous_annotation',
+                        help="gtf, gtf db or snapshot the previous bed was made from",
+                        type=lambda x: is_valid_file(parser, x))
+    parser.add_argument('-e', '--engine', dest='engine', choices=["gffutils", "direct"],
+                        help="gffutils: create_introns and bedtools intersect, "
+                             "direct: single pass over the gtf/db with an in memory exon sweep. "
+                             "DEFAULT: gffutils, direct with --gtf")
+
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
 
+    if (args.gtf or args.snapshot) and args.engine == "gffutils":
+        parser.error("--gtf and --snapshot need --engine direct")
+    if bool(args.previous_bed) != bool(args.previous_annotation):
+        parser.error("--previous-bed and --previous-annotation go together")
+    if not args.engine:
+        args.engine = "direct" if args.gtf or args.snapshot else "gffutils"
     if not args.out:
-        args.out = "{base}_introns.bed".format(base=os.path.splitext(args.gtf_db)[0])
+        args.out = "{base}_introns.bed".format(base=os.path.splitext(args.gtf_db or args.gtf or args.snapshot)[0])
     # Call up the main
-    main(args)
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
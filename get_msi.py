@@ -3,43 +3,61 @@
 # introns given in bed format
 # ----------------------------------------------------------------------------
 import argparse
+import hashlib
 import logging
+import multiprocessing
 import os
+from statistics import NormalDist
 
+import numpy as np
 import pybedtools
-
-
-class Intron(object):
-    """ Objects of the type intron """
-
-    def __init__(self, id):
-        """
-        Parameters
-        ----------
-        bed_file_path: str, filepath
-            Path to a .bed file
-        """
-        self.id = id
-        self.a1 = None
-        self.a2 = None
-        self.exon = None
-        self.covfrac = None
-        self.msi = None
-
-    def calc_msi(self):
-        if self.a1 == 0 and self.a2 == 0 and self.exon == 0:
-            self.msi = 0
-        else:
-            mis_splice_count = self.a1 + self.a2
-            self.msi = (mis_splice_count / ((2 * self.exon) + mis_splice_count)) * 100
-
-    def format(self):
-        return "{i.id}\t{i.a1}\t{i.a2}\t{i.exon}\t{i.covfrac}\t{i.msi}\n".format(i=self)
-
-
-def add_unique_id(feature):
-    feature.name = "{}|{}|{}|{}".format(feature.chrom, feature.start, feature.stop, feature.strand)
-    return feature
+import pysam
+
+import checkpoint
+import columnar
+import metrics
+import msi_cache
+import msi_engine
+from intron_panel import IntronPanel, WINDOWS
+from intron_table import IntronTable, read_genome_sizes
+
+# Introns per shard of a resumable run, see --checkpoint
+CHECKPOINT_SIZE = 5000
+
+
+def calc_msi(a1_counts, a2_counts, exon_counts):
+    """
+    Mis splicing index for every intron, introns without any reads get 0
+    :param a1_counts: array of reads across the intron start
+    :param a2_counts: array of reads across the intron end
+    :param exon_counts: array of reads spanning the intron
+    :return: array of msi values
+    """
+    mis_splice_count = a1_counts + a2_counts
+    total_count = (2 * exon_counts) + mis_splice_count
+    msi = np.zeros(len(total_count))
+    np.divide(mis_splice_count, total_count, out=msi, where=total_count > 0)
+    return msi * 100
+
+
+def calc_msi_interval(a1_counts, a2_counts, exon_counts, confidence=0.95):
+    """
+    Wilson score interval of the mis splicing index, the A1 + A2 reads taken
+    as successes out of the A1 + A2 + 2 * Exon trials of calc_msi
+    :param confidence: coverage of the interval
+    :return: arrays of lower and upper msi bounds, 0 for introns without any reads
+    """
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    successes = (a1_counts + a2_counts).astype(np.float64)
+    trials = successes + 2 * exon_counts
+    low, high = np.zeros(len(trials)), np.zeros(len(trials))
+    has_reads = trials > 0
+    n, p = trials[has_reads], successes[has_reads] / trials[has_reads]
+    centre = (p + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+    spread = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    low[has_reads] = np.clip(centre - spread, 0, 1)
+    high[has_reads] = np.clip(centre + spread, 0, 1)
+    return low * 100, high * 100
 
 
 def a1(feature):
@@ -60,45 +78,444 @@ def exon(feature):
     return feature
 
 
-def main(args):
-    # Logging
-    logging.info("BED: {introns}, BAM: {bam}, GENOMESIZES: {gsizes} OUT: {out}".format(introns=args.introns,
-                                                                                       bam=args.bam,
-                                                                                       gsizes=args.gsizes,
-                                                                                       out=args.out))
-
-    introns_bedtools = pybedtools.BedTool(args.introns)
-    bam_bedtools = pybedtools.BedTool(args.bam)
-
-    intron_dict = dict()
-
-    # Add a unique name to each of the introns
-    introns_bedtools_named = introns_bedtools.each(add_unique_id).saveas()
+def get_windows_bedtools(table, gsizes):
+    """
+    Build the named and sorted a1, a2, exon and intron beds once so they can be shared by all samples
+    :param table: IntronTable
+    :param gsizes: genome sizes file
+    :return: dict of window type to sorted bed file
+    """
+    # Name each of the introns by its row in the table
+    introns_bedtools_named = pybedtools.BedTool((chrom, start, end, str(row), ".", strand)
+                                                for row, (chrom, start, end, strand)
+                                                in enumerate(table.records())).saveas()
+
+    windows = {"a1": introns_bedtools_named.each(a1).sort(g=gsizes).saveas().fn,
+               "a2": introns_bedtools_named.each(a2).sort(g=gsizes).saveas().fn,
+               "exon": introns_bedtools_named.each(exon).sort(g=gsizes).saveas().fn,
+               "introns": introns_bedtools_named.sort(g=gsizes).saveas().fn}
+    metrics.count("temp_bytes", sum(os.path.getsize(fn) for fn in list(windows.values())
+                                    + [introns_bedtools_named.fn]))
+    return windows
+
+
+def get_windows_panel(panel):
+    """
+    Write the a1, a2, exon and intron beds of a prepared panel, already named and sorted
+    :param panel: IntronPanel
+    :return: dict of window type to sorted bed file
+    """
+    windows = dict()
+    for name in WINDOWS:
+        windows[name] = pybedtools.BedTool._tmp()
+        panel.write_window(name, windows[name])
+    metrics.count("temp_bytes", sum(os.path.getsize(fn) for fn in windows.values()))
+    return windows
+
+
+def get_msi_bedtools(table, windows, bam, gsizes):
+    """
+    Count reads for the intron windows with bedtools, one pass over the bam per count
+    """
+    bam_bedtools = pybedtools.BedTool(bam)
+
+    counts = msi_engine.new_counts(len(table))
+
+    for cov in pybedtools.BedTool(windows["a1"]).intersect(bam_bedtools, f=1, split=True, c=True,
+                                                           sorted=True, g=gsizes):
+        counts["a1"][int(cov.name)] = cov.count
+
+    for cov in pybedtools.BedTool(windows["a2"]).intersect(bam_bedtools, f=1, split=True, c=True,
+                                                           sorted=True, g=gsizes):
+        counts["a2"][int(cov.name)] = cov.count
+
+    for cov in pybedtools.BedTool(windows["exon"]).intersect(bam_bedtools, f=1, c=True, sorted=True, g=gsizes):
+        counts["exon"][int(cov.name)] = cov.count
+
+    for cov_frac in pybedtools.BedTool(windows["introns"]).coverage(bam_bedtools, split=True, sorted=True,
+                                                                   g=gsizes):
+        counts["covfrac"][int(cov_frac.name)] = float(cov_frac.fields[9])
+
+    return counts
+
+
+def get_windows_sweep(table, gsizes):
+    """
+    The sweep engine works on the sorted intron table directly
+    """
+    return None
+
+
+def get_msi_sweep(table, windows, bam, gsizes, threads=1, cache_dir=None, cache_max_gb=None, cache_max_age=None,
+                  fraction=None, read_budget=None, seed=0, confidence=0.95, checkpoint_dir=None,
+                  checkpoint_size=CHECKPOINT_SIZE):
+    """
+    Count reads for the intron windows with a single pass over the bam,
+    split into shards read through the bam index when threads > 1.
+    With a cache_dir the read evidence is kept per bam and reused for any intron set.
+    With a fraction or a read_budget only a seeded subsample of the reads is counted, see subsample_counts.
+    With a checkpoint_dir every finished shard of checkpoint_size introns is kept, see bam_checkpoint.
+    """
+    sample = read_sample(bam, fraction, read_budget, seed)
+    if checkpoint_dir:
+        resume = checkpoint.Checkpoint(bam_checkpoint(checkpoint_dir, bam),
+                                       bam_checkpoint_key(bam, table, checkpoint_size, sample))
+        counts = msi_engine.count_introns_checkpointed(bam, table, resume, checkpoint_size, threads=threads,
+                                                       sample=sample)
+    elif cache_dir:
+        return msi_cache.count_introns_cached(bam, table, cache_dir, threads=threads,
+                                              max_bytes=cache_max_gb * 1e9 if cache_max_gb else None,
+                                              max_age_days=cache_max_age)
+    else:
+        counts = msi_engine.count_introns(bam, table, threads=threads, sample=sample)
+    return subsample_counts(counts, sample[0], confidence) if sample is not None else counts
+
+
+def read_sample(bam, fraction=None, read_budget=None, seed=0):
+    """
+    Read subsample of a bam, a read budget is turned into the fraction of the mapped reads
+    :return: (fraction, seed) for msi_engine.count_introns, None to count every read
+    """
+    if fraction is None and read_budget is None:
+        return None
+    if read_budget is not None:
+        mapped = mapped_reads(bam)
+        if not mapped:
+            raise ValueError("A read budget needs an indexed bam: {}".format(bam))
+        fraction = min(1.0, read_budget / mapped)
+    logging.info("Counting {:.4g} of the reads of {}".format(fraction, bam))
+    return fraction, seed
+
+
+def bam_checkpoint(checkpoint_dir, bam):
+    """
+    Checkpoint directory of one bam, so the samples of a batch run keep their shards apart
+    """
+    path_digest = hashlib.blake2b(os.path.realpath(bam).encode(), digest_size=6).hexdigest()
+    return os.path.join(checkpoint_dir, "{}.{}".format(os.path.basename(bam), path_digest))
+
+
+def bam_checkpoint_key(bam, table, checkpoint_size, sample):
+    """ Run key of the checkpoint of one bam, see checkpoint.run_key """
+    return checkpoint.run_key(bam=checkpoint.file_stamp(bam), chroms=list(table.chroms), chrom=table.chrom,
+                              start=table.start, end=table.end, strand=table.strand, shard_size=checkpoint_size,
+                              sample=sample)
+
+
+def remove_checkpoints(checkpoint_dir, table, bams, options):
+    """
+    Remove the checkpoints of a run that wrote all its outputs
+    :param options: keyword arguments of get_msi_sweep the bams were counted with
+    """
+    for bam in bams:
+        sample = read_sample(bam, options["fraction"], options["read_budget"], options["seed"])
+        checkpoint.remove(bam_checkpoint(checkpoint_dir, bam),
+                          bam_checkpoint_key(bam, table, options["checkpoint_size"], sample))
+    if os.path.isdir(checkpoint_dir) and not os.listdir(checkpoint_dir):
+        os.rmdir(checkpoint_dir)
+
+
+def subsample_counts(counts, fraction, confidence):
+    """
+    Scale the counts of a read subsample up to the whole bam. MSI does not
+    change with the scale, so msi and its msi_low and msi_high confidence
+    bounds are taken from the counts actually seen, not the rounded ones.
+    CovFrac is left as observed in the subsample.
+    :param counts: dict of a1, a2, exon and covfrac arrays of the subsample
+    :param fraction: fraction of the reads counted
+    :param confidence: coverage of the interval
+    :return: dict of rescaled counts with msi, msi_low and msi_high
+    """
+    low, high = calc_msi_interval(counts["a1"], counts["a2"], counts["exon"], confidence)
+    scaled = {column: np.rint(counts[column] / fraction).astype(np.int64) for column in ("a1", "a2", "exon")}
+    scaled.update(covfrac=counts["covfrac"], msi=calc_msi(counts["a1"], counts["a2"], counts["exon"]),
+                  msi_low=low, msi_high=high)
+    return scaled
+
+
+MSI_HEADER = "ID\tA1\tA2\tExon\tCovFrac\tMSI\n"
+# Subsampled runs add the bounds of the MSI confidence interval
+MSI_SAMPLED_HEADER = "ID\tA1\tA2\tExon\tCovFrac\tMSI\tMSILow\tMSIHigh\n"
+# Table column to counts key, for the columnar output
+MSI_COLUMNS = (("A1", "a1"), ("A2", "a2"), ("Exon", "exon"), ("CovFrac", "covfrac"), ("MSI", "msi"),
+               ("MSILow", "msi_low"), ("MSIHigh", "msi_high"))
+
+ENGINES = {"bedtools": (get_windows_bedtools, get_msi_bedtools),
+           "sweep": (get_windows_sweep, get_msi_sweep)}
+
+# Set up once per worker process by init_worker
+_worker_state = dict()
+
+
+def init_worker(engine, table, windows, gsizes, options, out_format="text"):
+    """ Share the prepared intron windows with a worker process """
+    _worker_state.update(engine=engine, table=table, windows=windows, gsizes=gsizes, options=options,
+                         out_format=out_format)
+
+
+def write_msi_rows(out_handle, table, rows, counts):
+    """
+    Write MSI lines for some rows of the table, ids are only formatted here
+    :param out_handle: open output file
+    :param table: IntronTable
+    :param rows: array of table rows to write
+    :param counts: dict of a1, a2, exon and covfrac arrays aligned with rows,
+                   plus msi, msi_low and msi_high for subsampled counts
+    """
+    msi = counts["msi"] if "msi" in counts else calc_msi(counts["a1"], counts["a2"], counts["exon"])
+    no_reads = (counts["a1"] == 0) & (counts["a2"] == 0) & (counts["exon"] == 0)
+    if "msi_low" in counts:
+        bounds = ["\t{}\t{}".format(low, high) for low, high in zip(counts["msi_low"].tolist(),
+                                                                    counts["msi_high"].tolist())]
+    else:
+        bounds = [""] * len(msi)
+    for intron_id, a1_count, a2_count, exon_count, covfrac, msi_value, empty, bound in zip(
+            table.take(rows).ids(), counts["a1"].tolist(), counts["a2"].tolist(), counts["exon"].tolist(),
+            counts["covfrac"].tolist(), msi.tolist(), no_reads.tolist(), bounds):
+        out_handle.write("{}\t{}\t{}\t{}\t{}\t{}{}\n".format(intron_id, a1_count, a2_count, exon_count, covfrac,
+                                                           0 if empty else msi_value, bound))
+
+
+def write_msi(table, counts, out, out_format="text"):
+    """
+    Write the MSI table for a single sample
+    :param table: IntronTable
+    :param counts: dict of a1, a2, exon and covfrac arrays aligned with the table
+    :param out: output file
+    :param out_format: text, or columnar for a columnar.py table
+    """
+    if out_format == "columnar":
+        if "msi" not in counts:
+            counts = dict(counts, msi=calc_msi(counts["a1"], counts["a2"], counts["exon"]))
+        columnar.write_columns(out, "msi", table, [(column, counts[key]) for column, key in MSI_COLUMNS
+                                                   if key in counts])
+        return
+    with open(out, "w") as out_handle:
+        out_handle.write(MSI_SAMPLED_HEADER if "msi_low" in counts else MSI_HEADER)
+        write_msi_rows(out_handle, table, np.arange(len(table)), counts)
+
+
+def write_msi_stream(table, bam, out):
+    """
+    Calculate MSI while a coordinate sorted sam/bam streams in, e.g. on stdin
+    from an aligner. Introns are written as soon as the stream has passed
+    them, so the rows follow the chromosome order of the stream.
+    :param table: IntronTable
+    :param bam: sam/bam file or - for stdin
+    :param out: output file
+    """
+    with pysam.AlignmentFile(bam) as reads, open(out, "w") as out_handle:
+        out_handle.write(MSI_HEADER)
+        for finished in msi_engine.stream_counts(msi_engine.iter_alignments(reads), table):
+            rows, a1_counts, a2_counts, exon_counts, covfracs = (np.array(column) for column in zip(*finished))
+            write_msi_rows(out_handle, table, rows,
+                           {"a1": a1_counts, "a2": a2_counts, "exon": exon_counts, "covfrac": covfracs})
+
+
+def score_sample(sample):
+    """
+    Calculate MSI for one sample in a worker process
+    :param sample: tuple of (name, bam, out)
+    :return: name of the sample
+    """
+    name, bam, out = sample
+    logging.info("Scoring sample {name}: {bam}".format(name=name, bam=bam))
+    score_bam(_worker_state["engine"], _worker_state["table"], _worker_state["windows"], bam,
+              _worker_state["gsizes"], _worker_state["options"], out, _worker_state["out_format"])
+    return name
+
+
+def score_bam(engine, table, windows, bam, gsizes, options, out, out_format="text"):
+    """
+    Count, calculate and write the MSI table of one bam
+    """
+    get_msi = ENGINES[engine][1]
+    with metrics.stage("count"):
+        counts = get_msi(table, windows, bam, gsizes, **options)
+    with metrics.stage("write"):
+        write_msi(table, counts, out, out_format)
+
+
+def mapped_reads(bam):
+    """ Mapped reads of an indexed bam from its index, 0 when there is no index """
+    try:
+        with pysam.AlignmentFile(bam) as bam_handle:
+            return bam_handle.mapped
+    except (ValueError, OSError):
+        return 0
+
+
+def write_msi_matrix(samples, out):
+    """
+    Merge the per sample MSI tables into one wide matrix
+    :param samples: list of (name, bam, out) tuples, the tables may be text or columnar
+    :param out: matrix file
+    """
+    in_handles = list()
+    try:
+        # Columnar tables are merged through their text lines
+        for _, _, path in samples:
+            in_handles.append(columnar.ColumnTable(path) if columnar.is_columnar(path) else open(path))
+        lines = [in_handle.text_lines() if isinstance(in_handle, columnar.ColumnTable) else in_handle
+                 for in_handle in in_handles]
+        header = ["ID"]
+        # Columns after the ID, subsampled tables also have the MSI bounds
+        for (name, _, _), in_lines in zip(samples, lines):
+            header.extend("{}_{}".format(col, name) for col in next(in_lines).rstrip("\n").split("\t")[1:])
+        with open(out, "w") as out_handle:
+            out_handle.write("\t".join(header) + "\n")
+            for row_lines in zip(*lines):
+                rows = [line.rstrip("\n").split("\t") for line in row_lines]
+                if any(row[0] != rows[0][0] for row in rows):
+                    raise ValueError("MSI tables are not in the same intron order")
+                out_handle.write("\t".join([rows[0][0]] + [field for row in rows for field in row[1:]]) + "\n")
+    finally:
+        for in_handle in in_handles:
+            in_handle.close()
+
+
+CONVERGENCE_HEADER = "Fraction\tReads\tIntrons\tCorrelation\tMedianAbsDiff\tCICoverage\n"
+
+
+def write_convergence(table, bam, fractions, seed, confidence, threads, out):
+    """
+    Report how the subsampled MSI approaches the MSI of the largest fraction.
+    Subsamples are nested, a larger fraction keeps every read of a smaller one.
+    Per fraction: estimated reads, introns with reads, correlation and median
+    absolute difference of the MSI with the reference over the introns with
+    reference reads, and the share of those whose reference MSI lies in the interval.
+    :param table: IntronTable sorted like the bam
+    :param bam: coordinate sorted bam, indexed when threads > 1
+    :param fractions: read fractions, the largest one is the reference
+    :param seed: subsample seed
+    :param confidence: coverage of the intervals
+    :param threads: sweep engine processes
+    :param out: output file
+    """
+    fractions = sorted(fractions, reverse=True)
+    mapped = mapped_reads(bam)
+    results = list()
+    for fraction in fractions:
+        logging.info("Counting {:.4g} of the reads of {}".format(fraction, bam))
+        counts = msi_engine.count_introns(bam, table, threads=threads, sample=(fraction, seed))
+        low, high = calc_msi_interval(counts["a1"], counts["a2"], counts["exon"], confidence)
+        has_reads = (counts["a1"] + counts["a2"] + counts["exon"]) > 0
+        results.append((fraction, calc_msi(counts["a1"], counts["a2"], counts["exon"]), low, high, has_reads))
+
+    reference, reference_reads = results[0][1], results[0][4]
+    with open(out, "w") as out_handle:
+        out_handle.write(CONVERGENCE_HEADER)
+        for fraction, msi, low, high, has_reads in reversed(results):
+            ref, sub = reference[reference_reads], msi[reference_reads]
+            correlation = np.corrcoef(ref, sub)[0, 1] if len(ref) > 1 and ref.std() and sub.std() else np.nan
+            median_diff = np.median(np.abs(ref - sub)) if len(ref) else np.nan
+            inside = (ref >= low[reference_reads] - 1e-9) & (ref <= high[reference_reads] + 1e-9)
+            out_handle.write("{}\t{}\t{}\t{:.4f}\t{:.4f}\t{:.4f}\n".format(
+                fraction, int(round(mapped * fraction)), int(has_reads.sum()), correlation, median_diff,
+                inside.mean() if len(ref) else np.nan))
+
+
+def read_samplesheet(samplesheet):
+    """
+    Read a tab separated sample sheet of sample name and bam path
+    :param samplesheet: path to sample sheet
+    :return: list of (name, bam) tuples
+    """
+    samples = list()
+    with open(samplesheet) as in_handle:
+        for line in in_handle:
+            if not line.strip() or line.startswith("#"):
+                continue
+            name, bam = line.rstrip("\n").split("\t")[:2]
+            samples.append((name, bam))
+    return samples
 
-    for cov in introns_bedtools_named.each(a1).sort(g=args.gsizes).intersect(bam_bedtools,
-                                                                             f=1, split=True, c=True,
-                                                                             sorted=True, g=args.gsizes):
-        intron_dict.setdefault(cov.name, Intron(cov.name))
-        setattr(intron_dict[cov.name], "a1", cov.count)
 
-    for cov in introns_bedtools_named.each(a2).sort(g=args.gsizes).intersect(bam_bedtools,
-                                                                             f=1, split=True, c=True,
-                                                                             sorted=True, g=args.gsizes):
-        setattr(intron_dict[cov.name], "a2", cov.count)
-
-    for cov in introns_bedtools_named.each(exon).sort(g=args.gsizes).intersect(bam_bedtools, f=1, c=True, sorted=True,
-                                                                               g=args.gsizes):
-        setattr(intron_dict[cov.name], "exon", cov.count)
-
-    for cov_frac in introns_bedtools_named.sort(g=args.gsizes).coverage(bam_bedtools, split=True, sorted=True,
-                                                                        g=args.gsizes):
-        setattr(intron_dict[cov_frac.name], "covfrac", float(cov_frac.fields[9]))
+def main(args):
+    # Logging
+    logging.info("BED: {introns}, PANEL: {panel}, BAM: {bam}, SAMPLESHEET: {sheet}, GENOMESIZES: {gsizes} "
+                 "OUT: {out} ENGINE: {engine}".format(introns=args.introns, panel=args.panel, bam=args.bam,
+                                                      sheet=args.samplesheet, gsizes=args.gsizes, out=args.out,
+                                                      engine=args.engine))
+
+    # Build the intron windows once for all the samples, a panel has them ready
+    get_windows = ENGINES[args.engine][0]
+    with metrics.stage("read_introns"):
+        if args.panel:
+            panel = IntronPanel.open(args.panel)
+            table, gsizes = panel.table, None
+        else:
+            table, gsizes = IntronTable.from_bed(args.introns).sort(read_genome_sizes(args.gsizes)), args.gsizes
+    metrics.count("introns", len(table))
+    with metrics.stage("windows"):
+        if args.panel and args.engine == "bedtools":
+            windows = get_windows_panel(panel)
+            gsizes = pybedtools.BedTool._tmp()
+            panel.write_genome_sizes(gsizes)
+        else:
+            windows = get_windows(table, gsizes)
+    options = {"threads": args.threads, "cache_dir": args.cache_dir, "cache_max_gb": args.cache_max_gb,
+               "cache_max_age": args.cache_max_age, "fraction": args.fraction, "read_budget": args.read_budget,
+               "seed": args.seed, "confidence": args.confidence, "checkpoint_dir": args.checkpoint,
+               "checkpoint_size": args.checkpoint_size} if args.engine == "sweep" else {}
+
+    if args.samplesheet:
+        samples = read_samplesheet(args.samplesheet)
+    else:
+        samples = [(os.path.basename(bam).rsplit(".bam", 1)[0], bam) for bam in args.bam]
+    if len(set(name for name, _ in samples)) != len(samples):
+        raise ValueError("Sample names have to be unique")
+
+    metrics.count("samples", len(samples))
+    if metrics.enabled():
+        metrics.count("reads", sum(mapped_reads(bam) for _, bam in samples if bam != "-"))
+
+    # A single bam without batch outputs behaves as before
+    if samples[0][1] == "-":
+        logging.info("Streaming alignments from stdin")
+        with metrics.stage("stream"):
+            write_msi_stream(table, "-", args.out)
+        return
+    if args.convergence:
+        logging.info("Writing convergence report {}".format(args.convergence))
+        with metrics.stage("convergence"):
+            write_convergence(table, samples[0][1], args.fractions, args.seed, args.confidence, args.threads,
+                              args.convergence)
+    if len(samples) == 1 and not (args.samplesheet or args.outdir or args.matrix):
+        score_bam(args.engine, table, windows, samples[0][1], gsizes, options, args.out, args.out_format)
+        if args.checkpoint:
+            remove_checkpoints(args.checkpoint, table, [samples[0][1]], options)
+        return
+
+    outdir = args.outdir or os.getcwd()
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    suffix = columnar.SUFFIX if args.out_format == "columnar" else ".xls"
+    samples = [(name, bam, os.path.join(outdir, "{}_msi{}".format(name, suffix))) for name, bam in samples]
+
+    logging.info("Scoring {n} samples with {p} processes".format(n=len(samples), p=args.processes))
+    with metrics.stage("samples"):
+        if args.processes > 1:
+            pool = multiprocessing.Pool(args.processes, initializer=init_worker,
+                                        initargs=(args.engine, table, windows, gsizes, options, args.out_format))
+            try:
+                for name in pool.imap_unordered(score_sample, samples):
+                    logging.info("Finished sample {}".format(name))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            init_worker(args.engine, table, windows, gsizes, options, args.out_format)
+            for sample in samples:
+                score_sample(sample)
 
-    with open(args.out, "w") as out_handle:
-        out_handle.write("ID\tA1\tA2\tExon\tCovFrac\tMSI\n")
-        for intron in intron_dict:
-            intron_dict[intron].calc_msi()
-            out_handle.write(intron_dict[intron].format())
+    if args.matrix:
+        logging.info("Writing MSI matrix {}".format(args.matrix))
+        with metrics.stage("matrix"):
+            write_msi_matrix(samples, args.matrix)
+    # Kept until every output is written, a restart then only merges the finished shards again
+    if args.checkpoint:
+        remove_checkpoints(args.checkpoint, table, [bam for _, bam, _ in samples], options)
 
 
 if __name__ == '__main__':
@@ -123,13 +540,119 @@ if __name__ == '__main__':
 
     required_args_group = parser.add_argument_group('required arguments')
 
-    required_args_group.add_argument('-i', '--bed', dest='introns', required=True,
-                                     type=lambda x: is_valid_file(parser, x))
-    required_args_group.add_argument('-b', '--bam', dest='bam', required=True,
-                                     type=lambda x: is_valid_file(parser, x))
-    required_args_group.add_argument('-g', '--genomesizes', dest='gsizes', required=True,
+    introns_args_group = required_args_group.add_mutually_exclusive_group(required=True)
+    introns_args_group.add_argument('-i', '--bed', dest='introns', type=lambda x: is_valid_file(parser, x))
+    introns_args_group.add_argument('--panel', dest='panel', type=lambda x: is_valid_file(parser, x),
+                                    help="Intron panel prepared by intron_panel.py, used instead of --bed "
+                                         "and --genomesizes")
+    bam_args_group = required_args_group.add_mutually_exclusive_group(required=True)
+    bam_args_group.add_argument('-b', '--bam', dest='bam', action="append",
+                                help="Bam file, can be given multiple times for a batch run. "
+                                     "- streams a coordinate sorted sam/bam from stdin (sweep engine only)",
+                                type=lambda x: x if x == "-" else is_valid_file(parser, x))
+    bam_args_group.add_argument('-s', '--samplesheet', dest='samplesheet',
+                                help="Tab separated file of sample name and bam path for a batch run",
+                                type=lambda x: is_valid_file(parser, x))
+    required_args_group.add_argument('-g', '--genomesizes', dest='gsizes',
+                                     help="Required with --bed",
                                      type=lambda x: is_valid_file(parser, x))
     parser.add_argument('-o', '--out', dest='out', default="msi.xls")
+    parser.add_argument('-e', '--engine', dest='engine', default="bedtools", choices=["bedtools", "sweep"],
+                        help="bedtools: one bedtools pass per count, "
+                             "sweep: single pass over a coordinate sorted bam. DEFAULT: bedtools")
+    parser.add_argument('--outdir', dest='outdir',
+                        help="Batch runs: directory for the per sample {SAMPLE}_msi.xls files, {SAMPLE}_msi.npz with "
+                             "--format columnar. DEFAULT: current dir")
+    parser.add_argument('--matrix', dest='matrix', help="Batch runs: also merge all samples into one wide matrix")
+    parser.add_argument('--format', dest='out_format', default="text", choices=["text", "columnar"],
+                        help="text: tab separated tables, columnar: compressed typed columns, convert them back "
+                             "with columnar.py. The --matrix is always text. DEFAULT: text")
+    parser.add_argument('-p', '--processes', dest='processes', type=int, default=1,
+                        help="Batch runs: number of samples scored in parallel. DEFAULT: 1")
+    parser.add_argument('-t', '--threads', dest='threads', type=int, default=1,
+                        help="Sweep engine: split every sample into shards read through the bam index "
+                             "and count them on this many cores. DEFAULT: 1")
+    parser.add_argument('--cache-dir', dest='cache_dir',
+                        help="Sweep engine: keep the read evidence of every bam in this directory, "
+                             "reruns with a new intron bed are answered from it without reading the bam")
+    parser.add_argument('--cache-max-gb', dest='cache_max_gb', type=float,
+                        help="Evict least recently used cache entries above this size")
+    parser.add_argument('--cache-max-age', dest='cache_max_age', type=float,
+                        help="Evict cache entries not used for this many days")
+    parser.add_argument('--checkpoint', dest='checkpoint',
+                        help="Sweep engine: keep every finished shard of introns in this directory, a restarted "
+                             "run only counts the missing shards. Needs indexed bams")
+    parser.add_argument('--checkpoint-size', dest='checkpoint_size', type=int, default=CHECKPOINT_SIZE,
+                        help="Introns per checkpoint shard, shards never span chromosomes. "
+                             "DEFAULT: {}".format(CHECKPOINT_SIZE))
+    sample_args_group = parser.add_mutually_exclusive_group()
+    sample_args_group.add_argument('--fraction', dest='fraction', type=float,
+                                   help="Sweep engine: fast QC, count only this fraction of the reads, picked by a "
+                                        "seeded hash of the read name, and scale A1, A2 and Exon up. "
+                                        "Adds the MSILow and MSIHigh columns")
+    sample_args_group.add_argument('--read-budget', dest='read_budget', type=int,
+                                   help="Sweep engine: like --fraction, with the fraction that gives about this "
+                                        "many reads of an indexed bam")
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help="Subsample seed. DEFAULT: 0")
+    parser.add_argument('--confidence', dest='confidence', type=float, default=0.95,
+                        help="Coverage of the MSI intervals of subsampled runs. DEFAULT: 0.95")
+    parser.add_argument('--convergence', dest='convergence',
+                        help="Sweep engine: also write how the MSI of growing read fractions approaches "
+                             "the MSI of the largest one to this file")
+    parser.add_argument('--fractions', dest='fractions', default="0.01,0.05,0.1,0.25,0.5,1",
+                        type=lambda x: [float(fraction) for fraction in x.split(",")],
+                        help="Read fractions of the convergence report. DEFAULT: 0.01,0.05,0.1,0.25,0.5,1")
+    metrics.add_arguments(parser)
+
     args = parser.parse_args()
+
+    if args.introns and not args.gsizes:
+        parser.error("--bed needs --genomesizes")
+    if args.panel and args.gsizes:
+        parser.error("a panel is sorted by the genome sizes it was built with, --genomesizes can not be given")
+    if args.bam and "-" in args.bam:
+        if args.engine != "sweep":
+            parser.error("streaming from stdin needs --engine sweep")
+        if len(args.bam) > 1 or args.outdir or args.matrix or args.threads > 1 or args.cache_dir:
+            parser.error("streaming from stdin works on a single sample without --threads or --cache-dir")
+        if args.fraction or args.read_budget or args.convergence:
+            parser.error("streaming from stdin can not be subsampled")
+        if args.out_format != "text":
+            parser.error("streaming from stdin writes text")
+        if args.checkpoint:
+            parser.error("streaming from stdin can not be checkpointed")
+    if (args.fraction or args.read_budget or args.convergence) and args.engine != "sweep":
+        parser.error("--fraction, --read-budget and --convergence need --engine sweep")
+    if (args.fraction or args.read_budget) and args.cache_dir:
+        parser.error("--fraction and --read-budget can not be combined with --cache-dir")
+    if args.fraction is not None and not 0 < args.fraction <= 1:
+        parser.error("--fraction has to be in (0, 1]")
+    if args.read_budget is not None and args.read_budget < 1:
+        parser.error("--read-budget has to be at least 1")
+    if not 0 <= args.seed < 2 ** 64:
+        parser.error("--seed has to be in [0, 2**64)")
+    if not 0 < args.confidence < 1:
+        parser.error("--confidence has to be in (0, 1)")
+    if args.convergence and (args.samplesheet or len(args.bam) > 1):
+        parser.error("--convergence works on a single sample")
+    if args.convergence and not all(0 < fraction <= 1 for fraction in args.fractions):
+        parser.error("--fractions have to be in (0, 1]")
+    if args.cache_dir and args.engine != "sweep":
+        parser.error("--cache-dir needs --engine sweep")
+    if args.checkpoint and args.engine != "sweep":
+        parser.error("--checkpoint needs --engine sweep")
+    if args.checkpoint and args.cache_dir:
+        parser.error("--checkpoint and --cache-dir can not be combined, the cache already keeps the read evidence")
+    if args.checkpoint_size < 1:
+        parser.error("--checkpoint-size has to be at least 1")
+    if args.threads > 1 and args.engine != "sweep":
+        parser.error("--threads needs --engine sweep")
+    if args.threads > 1 and args.processes > 1:
+        parser.error("--threads and --processes can not be combined, pick one level of parallelism")
+
+    if args.samplesheet:
+        for name, bam in read_samplesheet(args.samplesheet):
+            is_valid_file(parser, bam)
     # Call up the main
-    main(args)
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
@@ -0,0 +1,124 @@
+# ---------------------- gtf reader ------------------------------------------
+# Lightweight readers for gtf files and gffutils sqlite dbs which walk the
+# annotation once without building gffutils Feature objects
+# ----------------------------------------------------------------------------
+import gzip
+import json
+import re
+import sqlite3
+
+# key "value"; pairs of a gtf attribute column
+ATTRIBUTE_RE = re.compile(r'\s*([^\s;]+)\s+"?([^";]*)"?\s*;?')
+
+
+def open_text(path):
+    """ Open plain or gzipped text """
+    return gzip.open(path, "rt") if path.endswith(".gz") else open(path)
+
+
+def parse_attributes(attributes):
+    """
+    Parse a gtf attribute column
+    :param attributes: e.g. 'gene_id "G1"; tag "basic"; tag "CCDS";'
+    :return: dict of attribute to list of values, in order of appearance
+    """
+    parsed = dict()
+    for key, value in ATTRIBUTE_RE.findall(attributes):
+        parsed.setdefault(key, []).append(value)
+    return parsed
+
+
+def iter_gtf(gtf):
+    """
+    Iterate over the feature lines of a gtf
+    :param gtf: path to gtf, may be gzipped
+    :return: generator of (chrom, source, featuretype, start, end, score, strand, frame, attributes) with
+             one based integer start/end and the raw attribute column
+    """
+    with open_text(gtf) as in_handle:
+        for line in in_handle:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = line.rstrip("\n").split("\t")
+            yield (fields[0], fields[1], fields[2], int(fields[3]), int(fields[4]), fields[5], fields[6],
+                   fields[7], fields[8])
+
+
+def read_gtf_structure(gtf):
+    """
+    Read the transcript/exon structure of a gtf in a single pass
+    :param gtf: path to gtf, may be gzipped
+    :return: tuple of
+             set of transcript ids that gffutils create_introns would walk, i.e. with a transcript line
+             and a gene_id that has a gene line,
+             list of exons as (chrom, start, end, strand, gene_id, transcript_id)
+    """
+    genes, transcripts, transcript_genes, exons = set(), set(), dict(), list()
+    for chrom, _, featuretype, start, end, _, strand, _, attributes in iter_gtf(gtf):
+        if featuretype not in ("gene", "transcript", "exon"):
+            continue
+        attributes = parse_attributes(attributes)
+        gene_id = attributes.get("gene_id", [None])[0]
+        transcript_id = attributes.get("transcript_id", [None])[0]
+        if transcript_id is not None and gene_id is not None:
+            transcript_genes.setdefault(transcript_id, set()).add(gene_id)
+        if featuretype == "gene" and gene_id is not None:
+            genes.add(gene_id)
+        elif featuretype == "transcript" and transcript_id is not None:
+            transcripts.add(transcript_id)
+        elif featuretype == "exon":
+            exons.append((chrom, start, end, strand, gene_id, transcript_id))
+    transcripts = set(transcript_id for transcript_id in transcripts
+                      if transcript_genes.get(transcript_id, set()) & genes)
+    return transcripts, exons
+
+
+def db_walked_transcripts(conn):
+    """
+    Level one children of the genes, what gffutils walks in create_introns
+    :param conn: sqlite3 connection to a gffutils db
+    :return: set of transcript ids
+    """
+    return set(row[0] for row in conn.execute(
+        "SELECT DISTINCT relations.child FROM relations "
+        "JOIN features AS parents ON parents.id = relations.parent "
+        "JOIN features AS children ON children.id = relations.child "
+        "WHERE relations.level = 1 AND parents.featuretype = 'gene'"))
+
+
+def read_db_structure(db):
+    """
+    Read the transcript/exon structure of a gffutils db with a few plain sql queries
+    :param db: path to gffutils sqlite db
+    :return: same as read_gtf_structure
+    """
+    conn = sqlite3.connect(db)
+    try:
+        transcripts = db_walked_transcripts(conn)
+        exons = list()
+        for chrom, start, end, strand, attributes in conn.execute(
+                "SELECT seqid, start, end, strand, attributes FROM features WHERE featuretype = 'exon'"):
+            attributes = json.loads(attributes)
+            exons.append((chrom, start, end, strand, attributes.get("gene_id", [None])[0],
+                          attributes.get("transcript_id", [None])[0]))
+    finally:
+        conn.close()
+    return transcripts, exons
+
+
+def is_sqlite(path):
+    """ Check for the sqlite file header """
+    with open(path, "rb") as in_handle:
+        return in_handle.read(16) == b"SQLite format 3\x00"
+
+
+def read_structure(path):
+    """
+    Read the structure from an annotation snapshot, a gffutils db or a gtf, decided by the file content
+    """
+    # Imported here, the snapshot module builds on this one
+    from annotation_snapshot import AnnotationSnapshot
+    if AnnotationSnapshot.is_snapshot(path):
+        with AnnotationSnapshot.open(path) as snapshot:
+            return snapshot.structure()
+    return read_db_structure(path) if is_sqlite(path) else read_gtf_structure(path)
@@ -1,23 +1,282 @@
-# ---------------------- get intron type -------------------------------------
+# ---------------------- gtf to db -------------------------------------------
 # Convert gtf to an sqlite db which makes filtering and querying easier
 # ----------------------------------------------------------------------------
 
 import argparse
+import gzip
+import json
 import logging
+import multiprocessing
 import os
+import sqlite3
+import tempfile
+import time
 
 import gffutils
+from gffutils import bins, constants, helpers, iterators, parser as gff_parser
 
+import metrics
 
-def main(cmds):
+# gffutils ids for gtf features, everything else gets featuretype_N
+ID_SPEC = {"gene": "gene_id", "transcript": "transcript_id"}
+TRANSCRIPT_KEY = "transcript_id"
+GENE_KEY = "gene_id"
+# Lines per parsing task
+CHUNK_LINES = 20000
+# Write optimised pragmas for the bulk load, the db is thrown away if the load fails anyway
+BULK_PRAGMAS = {
+    "synchronous": "OFF",
+    "journal_mode": "OFF",
+    "locking_mode": "EXCLUSIVE",
+    "temp_store": "MEMORY",
+    "main.page_size": 4096,
+    "main.cache_size": -1048576,
+}
+# Indexes gffutils creates at the end of create_db, same names and order
+INDEXES = (
+    "CREATE INDEX relationsparent ON relations (parent)",
+    "CREATE INDEX relationschild ON relations (child)",
+    "CREATE INDEX featuretype ON features (featuretype)",
+    "CREATE INDEX seqidstartend ON features (seqid, start, end)",
+    "CREATE INDEX seqidstartendstrand ON features (seqid, start, end, strand)",
+)
+
+# Same compact json as gffutils helpers._jsonify, without building an encoder per call
+JSONIFY = json.JSONEncoder(separators=(",", ":")).encode
+
+_dialect = None
+
+
+def init_parser(dialect):
+    global _dialect
+    _dialect = dialect
+
+
+def to_int(value):
+    """ gffutils keeps "." and empty coordinates as None """
+    return None if value in (".", "") else int(value)
+
+
+def parse_lines(lines):
+    """
+    Parse gtf lines the way gffutils feature_from_line does
+    :param lines: raw lines of the gtf
+    :return: tuple of
+             list of (seqid, source, featuretype, start, end, score, strand, frame, attributes json,
+             extra json, bin, id attribute or None, transcript_id or None, gene_id or None),
+             list of directives, True if a fasta section started
+    """
+    rows, directives = list(), list()
+    for line in lines:
+        line = line.rstrip("\n\r")
+        if line == "##FASTA" or line.startswith(">"):
+            return rows, directives, True
+        if line.startswith("##"):
+            directives.append(line[2:])
+            continue
+        if line.startswith("#") or len(line) == 0:
+            continue
+        fields = line.split("\t")
+        attributes, _ = gff_parser._split_keyvals(fields[8] if len(fields) > 8 else "", dialect=_dialect)
+        start, end = to_int(fields[3]), to_int(fields[4])
+        try:
+            feature_bin = bins.bins(start, end, one=True)
+        except TypeError:
+            feature_bin = None
+
+        id_value = None
+        id_key = ID_SPEC.get(fields[2])
+        if id_key in attributes:
+            if len(attributes[id_key]) > 1:
+                raise ValueError("The ID field {} has more than one value but a single value is required "
+                                 "for a primary key in the database".format(id_key))
+            id_value = attributes[id_key][0] if attributes[id_key] else None
+        transcript_id = attributes[TRANSCRIPT_KEY][0] if attributes.get(TRANSCRIPT_KEY) else None
+        gene_id = attributes[GENE_KEY][0] if attributes.get(GENE_KEY) else None
+
+        rows.append((fields[0], fields[1], fields[2], start, end, fields[5], fields[6], fields[7],
+                     JSONIFY(attributes._d), JSONIFY(fields[9:]) if len(fields) > 9 else "[]", feature_bin,
+                     id_value, transcript_id, gene_id))
+    return rows, directives, False
+
+
+def parse_task(task):
+    """
+    Parse one chunk: either a list of lines or a (path, offset, size) byte range of a plain gtf
+    """
+    if isinstance(task, list):
+        return parse_lines(task)
+    path, offset, size = task
+    with open(path, "rb") as in_handle:
+        in_handle.seek(offset)
+        data = in_handle.read(size).decode("utf-8")
+    return parse_lines(data.splitlines())
+
+
+def plan_tasks(gtf, chunk_bytes=1 << 20):
+    """
+    Cut the gtf into parsing tasks, byte ranges ending on line breaks for plain files,
+    lists of lines for gzipped ones
+    """
+    if gtf.endswith(".gz"):
+        chunk = list()
+        with gzip.open(gtf, "rt") as in_handle:
+            for line in in_handle:
+                chunk.append(line)
+                if len(chunk) == CHUNK_LINES:
+                    yield chunk
+                    chunk = list()
+        if chunk:
+            yield chunk
+        return
+
+    size = os.path.getsize(gtf)
+    with open(gtf, "rb") as in_handle:
+        offset = 0
+        while offset < size:
+            in_handle.seek(min(offset + chunk_bytes, size))
+            in_handle.readline()
+            end = min(in_handle.tell(), size)
+            yield (gtf, offset, end - offset)
+            offset = end
+
+
+def bulk_create_db(gtf, gtfdb, processes=1):
+    """
+    Build a gffutils compatible db (same schema, ids, relations, meta and indexes as
+    create_db with disable_infer_genes/transcripts) with parallel parsing, batched
+    inserts in a single transaction and the indexes built after the load
+    :param gtf: path to gtf, may be gzipped
+    :param gtfdb: path to the db to write, replaced if present
+    :param processes: parsing processes
+    """
+    # Dialect from the first lines, exactly like the gffutils iterator does
+    dialect = iterators.DataIterator(gtf, checklines=10).dialect
+
+    tmp_db = "{}.tmp{}".format(gtfdb, os.getpid())
+    if os.path.exists(tmp_db):
+        os.remove(tmp_db)
+    conn = sqlite3.connect(tmp_db)
+    pool = None
+    # Removed on any failure, only a complete db is moved to gtfdb
+    try:
+        conn.executescript(";\n".join(["PRAGMA %s=%s" % pragma for pragma in BULK_PRAGMAS.items()]))
+        conn.executescript(constants.SCHEMA)
+
+        if processes > 1:
+            pool = multiprocessing.Pool(processes, initializer=init_parser, initargs=(dialect,))
+            results = pool.imap(parse_task, plan_tasks(gtf))
+        else:
+            init_parser(dialect)
+            results = map(parse_task, plan_tasks(gtf))
+
+        autoincrements, directives = dict(), list()
+        gene_transcripts = set()
+        n_features = 0
+        conn.execute("BEGIN")
+        with metrics.stage("load"):
+            for rows, chunk_directives, fasta in results:
+                directives.extend(chunk_directives)
+                features, relations = list(), list()
+                for row in rows:
+                    feature_id, transcript_id, gene_id = row[11:]
+                    if feature_id is None:
+                        autoincrements[row[2]] = autoincrements.get(row[2], 0) + 1
+                        feature_id = "{}_{}".format(row[2], autoincrements[row[2]])
+                    features.append((feature_id,) + row[:11])
+                    if transcript_id is not None:
+                        relations.append((transcript_id, feature_id, 1))
+                    if gene_id is not None:
+                        relations.append((gene_id, feature_id, 2))
+                        # Repeated on nearly every line, only send it once
+                        if transcript_id is not None and (gene_id, transcript_id) not in gene_transcripts:
+                            gene_transcripts.add((gene_id, transcript_id))
+                            relations.append((gene_id, transcript_id, 1))
+                try:
+                    conn.executemany(constants._INSERT, features)
+                except sqlite3.IntegrityError:
+                    raise ValueError("Duplicate feature id in {}, use gtf_to_db.py without --fast and a gffutils "
+                                     "merge strategy for such files".format(gtf))
+                conn.executemany("INSERT OR IGNORE INTO relations (parent, child, level) VALUES (?, ?, ?)", relations)
+                n_features += len(features)
+                if fasta:
+                    break
+        if not n_features:
+            raise ValueError("No lines parsed -- was an empty file provided?")
+        metrics.count("features", n_features)
+
+        # What gffutils _finalize writes
+        conn.executemany("INSERT INTO directives VALUES (?)", ((directive,) for directive in directives))
+        conn.execute("INSERT INTO meta (version, dialect) VALUES (?, ?)",
+                     (gffutils.version.version, helpers._jsonify(dialect)))
+        conn.executemany("INSERT OR REPLACE INTO autoincrements VALUES (?, ?)", list(autoincrements.items()))
+        conn.commit()
+
+        logging.info("Loaded {} features, creating indexes".format(n_features))
+        with metrics.stage("index"):
+            for index in INDEXES:
+                conn.execute(index)
+            conn.execute("ANALYZE features")
+            conn.commit()
+        conn.close()
+        os.replace(tmp_db, gtfdb)
+    finally:
+        if pool:
+            pool.terminate()
+        conn.close()
+        if os.path.exists(tmp_db):
+            os.remove(tmp_db)
+
+
+def gffutils_create_db(gtf, gtfdb):
+    """ The plain gffutils load """
+    gffutils.create_db(gtf,
+                       gtfdb,
+                       disable_infer_genes=True,
+                       disable_infer_transcripts=True)
+
+
+def compare_loaders(gtf, gtfdb, processes):
+    """
+    Time the bulk loader against create_db on the same gtf and check both dbs hold the same content
+    """
+    timings = dict()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(gtfdb))) as tmp_dir:
+        reference = os.path.join(tmp_dir, "gffutils.db")
+        start = time.time()
+        gffutils_create_db(gtf, reference)
+        timings["gffutils"] = time.time() - start
+        start = time.time()
+        bulk_create_db(gtf, gtfdb, processes)
+        timings["fast"] = time.time() - start
+
+        same = True
+        for query in ("SELECT * FROM features ORDER BY id", "SELECT * FROM relations ORDER BY parent, child, level",
+                      "SELECT * FROM meta", "SELECT * FROM autoincrements ORDER BY base",
+                      "SELECT * FROM directives"):
+            with sqlite3.connect(reference) as ref_conn, sqlite3.connect(gtfdb) as fast_conn:
+                same = same and ref_conn.execute(query).fetchall() == fast_conn.execute(query).fetchall()
+
+    logging.info("gffutils create_db: {:.1f}s, fast loader ({} processes): {:.1f}s, speedup {:.1f}x, "
+                 "identical content: {}".format(timings["gffutils"], processes, timings["fast"],
+                                                timings["gffutils"] / max(timings["fast"], 1e-9), same))
+    return timings, same
+
+
+def main(args):
     # Logging
     logging.info("GTF:{gtf}, GTFDB:{gtfdb}".format(gtf=args.gtf, gtfdb=args.gtfdb))
 
     # Now do the actual conversion
-    db = gffutils.create_db(args.gtf,
-                            args.gtfdb,
-                            disable_infer_genes=True,
-                            disable_infer_transcripts=True)
+    if args.compare:
+        with metrics.stage("compare_loaders"):
+            compare_loaders(args.gtf, args.gtfdb, args.processes)
+    elif args.fast:
+        with metrics.stage("bulk_create_db"):
+            bulk_create_db(args.gtf, args.gtfdb, args.processes)
+    else:
+        with metrics.stage("create_db"):
+            gffutils_create_db(args.gtf, args.gtfdb)
 
 
 if __name__ == '__main__':
@@ -42,8 +301,21 @@ if __name__ == '__main__':
     required_args_group = parser.add_argument_group('required arguments')
     required_args_group.add_argument('-g', '--gtf', dest='gtf', required=True,
                                      type=lambda x: is_valid_file(parser, x))
+    parser.add_argument('-f', '--fast', dest='fast', action='store_true',
+                        help="bulk loader: parallel parsing, batched inserts, indexes after the load. "
+                             "Writes the same gffutils db, files with duplicate ids need the default loader")
+    parser.add_argument('-p', '--processes', dest='processes', default=1, type=int,
+                        help="parsing processes for --fast. DEFAULT: 1")
+    parser.add_argument('--compare', dest='compare', action='store_true',
+                        help="build with both loaders, report the timings and check the content matches. "
+                             "Keeps the --fast db")
+    metrics.add_arguments(parser)
+
     args = parser.parse_args()
+    if args.processes < 1:
+        parser.error("--processes has to be at least 1")
     if not args.gtfdb:
         args.gtfdb = "{base}.db".format(base=os.path.splitext(args.gtf)[0])
 
-    main(args)
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
@@ -0,0 +1,183 @@
+# ---------------------- intron panel ----------------------------------------
+# Prepared intron panel for get_msi.py, built once per intron bed and genome
+# sizes file. It holds the introns sorted like the genome sizes and numbered
+# by their row (the integer intron ids), and for each of the a1, a2, exon and
+# intron windows the flanked coordinates already in bedtools sort -g order.
+# The file is memory mapped on open, so an MSI run starts counting without
+# reading the bed or naming, flanking and sorting any windows.
+# ----------------------------------------------------------------------------
+
+import argparse
+import logging
+import os
+
+import numpy as np
+
+import array_store
+import metrics
+from intron_table import IntronTable, read_genome_sizes
+
+MAGIC = b"IRPANEL\x01"
+VERSION = 1
+# Flank added around the intron boundaries, see get_msi.a1/a2/exon
+FLANK = 3
+# Windows of the bedtools engine, window name to the (field, offset) of its start and end
+WINDOWS = {"a1": (("start", -FLANK), ("start", FLANK)),
+           "a2": (("end", -FLANK), ("end", FLANK)),
+           "exon": (("start", -FLANK), ("end", FLANK)),
+           "introns": (("start", 0), ("end", 0))}
+# Arrays of the intron table, in the dtypes IntronTable uses
+TABLE_FIELDS = {"chrom": "<i4", "start": "<i8", "end": "<i8", "strand": "<i1"}
+
+
+class IntronPanel(object):
+    """
+    Introns as an IntronTable sorted like the genome sizes, intron id i is
+    row i, plus every window as {window}_ids, {window}_start and {window}_end
+    arrays in sorted window order.
+    """
+
+    def __init__(self, table, genome_sizes, windows, buffer=None):
+        """
+        :param table: IntronTable sorted like the genome sizes
+        :param genome_sizes: list of (chrom, size) in genome sizes order
+        :param windows: dict of array name to int64 array
+        :param buffer: mmap backing the arrays, if any
+        """
+        self.table = table
+        self.genome_sizes = genome_sizes
+        self.windows = windows
+        self.buffer = buffer
+
+    @classmethod
+    def build(cls, bed, gsizes):
+        """
+        Build a panel from an intron bed and a genome sizes file
+        """
+        genome_sizes = list()
+        with open(gsizes) as in_handle:
+            for line in in_handle:
+                fields = line.split()
+                if fields:
+                    genome_sizes.append((fields[0], int(fields[1])))
+        chrom_order = read_genome_sizes(gsizes)
+        table = IntronTable.from_bed(bed).sort(chrom_order)
+
+        windows = dict()
+        for name, ((start_field, start_offset), (end_field, end_offset)) in WINDOWS.items():
+            window = IntronTable(table.chroms, table.chrom, getattr(table, start_field) + start_offset,
+                                 getattr(table, end_field) + end_offset, table.strand)
+            ids = window.sort_order(chrom_order)
+            windows["{}_ids".format(name)] = ids.astype(np.int64)
+            windows["{}_start".format(name)] = window.start[ids]
+            windows["{}_end".format(name)] = window.end[ids]
+        return cls(table, genome_sizes, windows)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory map a panel written by save
+        """
+        meta, arrays, buffer = array_store.open_arrays(path, MAGIC, VERSION)
+        table = IntronTable(meta["chroms"], *(arrays[field] for field in TABLE_FIELDS))
+        windows = {name: array for name, array in arrays.items() if name not in TABLE_FIELDS}
+        return cls(table, [tuple(chrom_size) for chrom_size in meta["genome_sizes"]], windows, buffer)
+
+    @staticmethod
+    def is_panel(path):
+        return array_store.has_magic(path, MAGIC)
+
+    def save(self, path):
+        """
+        Write the panel
+        """
+        arrays = {field: np.asarray(getattr(self.table, field), dtype=dtype)
+                  for field, dtype in TABLE_FIELDS.items()}
+        arrays.update(self.windows)
+        array_store.write_arrays(path, MAGIC, VERSION,
+                                 {"chroms": self.table.chroms, "genome_sizes": self.genome_sizes}, arrays)
+
+    def close(self):
+        if self.buffer is not None:
+            self.table = self.windows = None
+            self.buffer.close()
+            self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.table)
+
+    def write_window(self, name, out):
+        """
+        Write a window as a sorted bed named by intron id, the way get_msi.get_windows_bedtools builds it
+        :param name: window name, see WINDOWS
+        :param out: output bed file
+        """
+        ids = self.windows["{}_ids".format(name)]
+        introns = self.table.take(ids)
+        with open(out, "w") as out_handle:
+            for chrom, start, end, intron_id, strand in zip(
+                    introns.chrom_names().tolist(), self.windows["{}_start".format(name)].tolist(),
+                    self.windows["{}_end".format(name)].tolist(), ids.tolist(), introns.strand_names().tolist()):
+                out_handle.write("{}\t{}\t{}\t{}\t.\t{}\n".format(chrom, start, end, intron_id, strand))
+
+    def write_genome_sizes(self, out):
+        """
+        Write the genome sizes the panel was built with
+        """
+        with open(out, "w") as out_handle:
+            for chrom, size in self.genome_sizes:
+                out_handle.write("{}\t{}\n".format(chrom, size))
+
+
+def main(args):
+    logging.info("BED: {bed}, GENOMESIZES: {gsizes}, Outfile: {out}".format(bed=args.introns, gsizes=args.gsizes,
+                                                                           out=args.out))
+    with metrics.stage("build"):
+        panel = IntronPanel.build(args.introns, args.gsizes)
+    logging.info("Writing a panel of {} introns".format(len(panel)))
+    metrics.count("introns", len(panel))
+    with metrics.stage("write"):
+        panel.save(args.out)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s : %(message)s', level=logging.INFO)
+
+
+    def is_valid_file(parser, arg):
+        """ Check if file exists """
+        if not os.path.isfile(arg):
+            parser.error('The file at %s does not exist' % arg)
+        else:
+            return arg
+
+
+    epilog = "EXAMPLE: python " + os.path.basename(__file__) + \
+             " --bed /path/to/introns.bed  --genomesizes /path/to/genome.sizes  --out /path/to/introns.panel"
+
+    parser = argparse.ArgumentParser(description="Script to prepare an intron panel for get_msi.py --panel",
+                                     epilog=epilog)
+
+    required_args_group = parser.add_argument_group('required arguments')
+    required_args_group.add_argument('-i', '--bed', dest='introns', required=True,
+                                     type=lambda x: is_valid_file(parser, x))
+    required_args_group.add_argument('-g', '--genomesizes', dest='gsizes', required=True,
+                                     type=lambda x: is_valid_file(parser, x))
+
+    parser.add_argument('-o', '--out', dest='out', help="DEFAULT: {BED_BASE}.panel")
+
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if not args.out:
+        args.out = "{base}.panel".format(base=os.path.splitext(args.introns)[0])
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
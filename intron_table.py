@@ -0,0 +1,146 @@
+# ---------------------- intron table ----------------------------------------
+# Columnar, numpy backed table of introns shared by get_msi.py and
+# get_intron_type.py. Coordinates are kept as integer arrays, chromosomes
+# and strands as small integer codes. The "chrom|start|end|strand" ids are
+# only built when a table gets written out.
+# ----------------------------------------------------------------------------
+import logging
+
+import numpy as np
+
+STRANDS = ("+", "-", ".")
+STRAND_CODES = {strand: code for code, strand in enumerate(STRANDS)}
+
+
+def read_genome_sizes(gsizes):
+    """
+    Read the chromosome order from a genome sizes file
+    :param gsizes: path to tab separated chrom/size file
+    :return: dict of chrom to rank
+    """
+    order = dict()
+    with open(gsizes) as in_handle:
+        for line in in_handle:
+            fields = line.split()
+            if fields:
+                order.setdefault(fields[0], len(order))
+    return order
+
+
+class IntronTable(object):
+    """
+    Introns as parallel arrays. Row i of the table is
+    (chroms[chrom[i]], start[i], end[i], STRANDS[strand[i]]) with bed style
+    zero based starts.
+    """
+
+    def __init__(self, chroms, chrom, start, end, strand):
+        """
+        :param chroms: list of chromosome names, indexed by the chrom codes
+        :param chrom: int32 array of chromosome codes
+        :param start: int64 array of starts
+        :param end: int64 array of ends
+        :param strand: int8 array of strand codes, see STRANDS
+        """
+        self.chroms = list(chroms)
+        self.chrom = np.asarray(chrom, dtype=np.int32)
+        self.start = np.asarray(start, dtype=np.int64)
+        self.end = np.asarray(end, dtype=np.int64)
+        self.strand = np.asarray(strand, dtype=np.int8)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build a table from (chrom, start, end, strand) tuples. Repeated introns are kept once, at their first
+        row, and strands other than +, - and . are read as unstranded with a warning.
+        """
+        chrom_codes = dict()
+        seen = set()
+        unknown_strands = dict()
+        chrom, start, end, strand = [], [], [], []
+        for record in records:
+            if record[3] not in STRAND_CODES:
+                unknown_strands[record[3]] = unknown_strands.get(record[3], 0) + 1
+            intron = (record[0], record[1], record[2], STRAND_CODES.get(record[3], STRAND_CODES["."]))
+            if intron in seen:
+                continue
+            seen.add(intron)
+            chrom.append(chrom_codes.setdefault(intron[0], len(chrom_codes)))
+            start.append(intron[1])
+            end.append(intron[2])
+            strand.append(intron[3])
+        for value, count in unknown_strands.items():
+            logging.warning("{count} introns with unknown strand {value!r}, read as unstranded (.)".format(
+                count=count, value=value))
+        return cls(list(chrom_codes), chrom, start, end, strand)
+
+    @classmethod
+    def from_bed(cls, bed):
+        """
+        Read a bed file, the strand is taken from the sixth column when present. Like from_records, an intron
+        listed more than once gives a single row.
+        """
+        def gen():
+            with open(bed) as in_handle:
+                for line in in_handle:
+                    if not line.strip() or line.startswith(("#", "track", "browser")):
+                        continue
+                    fields = line.rstrip("\n").split("\t")
+                    yield (fields[0], int(fields[1]), int(fields[2]), fields[5] if len(fields) > 5 else ".")
+
+        return cls.from_records(gen())
+
+    def __len__(self):
+        return len(self.start)
+
+    def take(self, rows):
+        """
+        New table holding the given rows (index array or boolean mask)
+        """
+        return IntronTable(self.chroms, self.chrom[rows], self.start[rows], self.end[rows], self.strand[rows])
+
+    def sort(self, chrom_order=None):
+        """
+        Sort by chromosome and start the way bedtools sort (-g) does, ties keep their order
+        :param chrom_order: dict of chrom to rank, chromosomes missing from it go last by name.
+                            Without it chromosomes are sorted by name.
+        :return: sorted table
+        """
+        return self.take(self.sort_order(chrom_order))
+
+    def sort_order(self, chrom_order=None):
+        """
+        Rows in the order of sort
+        :return: array of row indices
+        """
+        chrom_order = chrom_order or dict()
+        by_name = sorted(range(len(self.chroms)), key=lambda code: self.chroms[code])
+        name_rank = np.empty(len(self.chroms), dtype=np.int64)
+        name_rank[by_name] = np.arange(len(self.chroms))
+        unknown = len(chrom_order)
+        chrom_rank = np.array([chrom_order.get(name, unknown) for name in self.chroms], dtype=np.int64)
+        return np.lexsort((self.start, name_rank[self.chrom], chrom_rank[self.chrom]))
+
+    def chrom_names(self):
+        """
+        Chromosome name for every row
+        """
+        return np.asarray(self.chroms, dtype=object)[self.chrom] if len(self.chroms) else np.array([], dtype=object)
+
+    def strand_names(self):
+        """
+        Strand for every row
+        """
+        return np.asarray(STRANDS, dtype=object)[self.strand]
+
+    def records(self):
+        """
+        Rows as (chrom, start, end, strand) tuples
+        """
+        return zip(self.chrom_names().tolist(), self.start.tolist(), self.end.tolist(), self.strand_names().tolist())
+
+    def ids(self):
+        """
+        "chrom|start|end|strand" id for every row, unique for tables read by from_records or from_bed
+        """
+        return ["{}|{}|{}|{}".format(*record) for record in self.records()]
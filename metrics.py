@@ -0,0 +1,166 @@
+# ---------------------- metrics ---------------------------------------------
+# Stage level instrumentation shared by the pipeline scripts: wall and cpu
+# time per stage (including pool workers that finished in it), peak RSS
+# sampled while the stage runs, named counters and optional cProfile dumps.
+# Nothing is collected unless a script is run with --metrics-json or
+# --profile, so metrics.stage / metrics.count are free to call everywhere.
+# ----------------------------------------------------------------------------
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# Seconds between RSS samples
+SAMPLE_INTERVAL = 0.05
+
+_collector = None
+
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, the peak so far where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as in_handle:
+            return int(in_handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return peak_rss()
+
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes """
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def cpu_times():
+    """ cpu seconds of this process and of its finished child processes """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time(), children.ru_utime + children.ru_stime
+
+
+class Metrics(object):
+    """
+    Collects stages and counters of one script run
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.stages = list()
+        self.counters = dict()
+        self._open = list()
+        self._begin = time.perf_counter()
+        self._begin_cpu = cpu_times()
+        self._peak = current_rss()
+        self._done = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="metrics-rss-sampler")
+        self._sampler.daemon = True
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._done.wait(SAMPLE_INTERVAL):
+            self._record_rss()
+
+    def _record_rss(self):
+        rss = current_rss()
+        self._peak = max(self._peak, rss)
+        for record in list(self._open):
+            record["peak_rss"] = max(record["peak_rss"], rss)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {"name": "/".join([open_record["name"] for open_record in self._open[-1:]] + [name]),
+                  "start": time.perf_counter() - self._begin, "peak_rss": current_rss()}
+        begin, (begin_cpu, begin_children) = time.perf_counter(), cpu_times()
+        self._open.append(record)
+        try:
+            yield record
+        finally:
+            self._record_rss()
+            self._open.remove(record)
+            end_cpu, end_children = cpu_times()
+            record.update(wall=time.perf_counter() - begin, cpu=end_cpu - begin_cpu,
+                          children_cpu=end_children - begin_children)
+            self.stages.append(record)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """
+        All metrics as a json serialisable dict
+        """
+        self._done.set()
+        self._record_rss()
+        end_cpu, end_children = cpu_times()
+        return {"script": self.script, "argv": sys.argv[1:],
+                "total": {"wall": time.perf_counter() - self._begin, "cpu": end_cpu - self._begin_cpu[0],
+                          "children_cpu": end_children - self._begin_cpu[1],
+                          "peak_rss": max(self._peak, peak_rss())},
+                "stages": sorted(self.stages, key=lambda record: record["start"]),
+                "counters": self.counters}
+
+
+def enabled():
+    """ Whether metrics are being collected, to skip work that only feeds a counter """
+    return _collector is not None
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Time a stage of the running script, nested stages are named parent/child
+    """
+    if _collector is None:
+        yield None
+    else:
+        with _collector.stage(name) as record:
+            yield record
+
+
+def count(name, value=1):
+    """
+    Add to a named counter of the running script (introns, reads, windows, temp_bytes, ...)
+    """
+    if _collector is not None:
+        _collector.count(name, value)
+
+
+def add_arguments(parser):
+    """ Add the --metrics-json and --profile options to a script """
+    parser.add_argument('--metrics-json', dest='metrics_json',
+                        help="Write per stage wall/cpu time, peak memory and counters to this json file")
+    parser.add_argument('--profile', dest='profile',
+                        help="Write a cProfile dump of the run to this file (see python -m pstats)")
+
+
+@contextlib.contextmanager
+def collect(metrics_json=None, profile=None):
+    """
+    Collect metrics and/or a cProfile dump for the enclosed run, for the entry points:
+        with metrics.collect(args.metrics_json, args.profile):
+            main(args)
+    """
+    global _collector
+    if metrics_json is None and profile is None:
+        yield
+        return
+    _collector = Metrics(os.path.basename(sys.argv[0]))
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        collector, _collector = _collector, None
+        report = collector.report()
+        if metrics_json:
+            with open(metrics_json, "w") as out_handle:
+                json.dump(report, out_handle, indent=1)
@@ -0,0 +1,380 @@
+# ---------------------- msi cache -------------------------------------------
+# Persistent per bam cache of the read evidence get_msi.py needs, so a new
+# intron set can be scored without reading the bam again.
+# For every chromosome the cache keeps
+#   - boundary track: run length encoded number of reads with a block fully
+#     covering the 6bp window around a position (A1/A2)
+#   - coverage runs: merged blocks (CovFrac)
+#   - spans: distinct (start, end) read spans with their counts (Exon)
+# Entries are keyed by a checksum of the bam plus the counting parameters
+# and evicted by size and age.
+# ----------------------------------------------------------------------------
+import array
+import contextlib
+import fcntl
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import operator
+import os
+import tempfile
+import time
+
+import numpy as np
+import pysam
+
+import msi_engine
+from checkpoint import atomic_write_json
+
+# Bump when the evidence layout or the counting rules change
+CACHE_VERSION = 1
+
+# Spans are queried in chunks of about sqrt(number of spans), never smaller than this
+MIN_SPAN_CHUNK = 256
+
+
+@contextlib.contextmanager
+def digests_lock(cache_dir):
+    """ Exclusive lock of the digests file, held while it is read, updated and rewritten """
+    with open(os.path.join(cache_dir, "digests.json.lock"), "w") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+
+def read_digests(digests_file):
+    if not os.path.isfile(digests_file):
+        return dict()
+    with open(digests_file) as in_handle:
+        return json.load(in_handle)
+
+
+def file_checksum(path, cache_dir):
+    """
+    Checksum of a file's content (bam, gtf, genome, ...). Hashing a large file
+    is not free, so the digest is remembered per path, size and modification time.
+    Concurrent runs sharing the cache directory update the digests file under a lock.
+    :param path: file
+    :param cache_dir: cache directory holding the digests file
+    :return: hex digest
+    """
+    stat = os.stat(path)
+    digests_file = os.path.join(cache_dir, "digests.json")
+    real_path = os.path.realpath(path)
+    # The digests file is only ever moved in place, reading it needs no lock
+    known = read_digests(digests_file).get(real_path)
+    if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+        return known["digest"]
+
+    logging.info("Calculating checksum of {}".format(path))
+    digest = hashlib.blake2b()
+    with open(path, "rb") as in_handle:
+        for chunk in iter(lambda: in_handle.read(1 << 20), b""):
+            digest.update(chunk)
+    # Read again under the lock, entries written by other runs while hashing are kept
+    with digests_lock(cache_dir):
+        digests = read_digests(digests_file)
+        digests[real_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest.hexdigest()}
+        atomic_write_json(digests, digests_file)
+    return digest.hexdigest()
+
+
+def cache_key(checksum):
+    """
+    Cache key for a bam checksum and the counting parameters
+    """
+    params = {"version": CACHE_VERSION, "flank": msi_engine.FLANK,
+              "block_ops": sorted(msi_engine.BLOCK_OPS), "skip_op": msi_engine.SKIP_OP}
+    return hashlib.blake2b("{}|{}".format(checksum, json.dumps(params, sort_keys=True)).encode(),
+                           digest_size=20).hexdigest()
+
+
+def collect_evidence(alignments):
+    """
+    Reduce the alignments of one chromosome to the cached evidence
+    :param alignments: iterable of (chrom, start, end, blocks) from msi_engine.iter_alignments
+    :return: dict of evidence arrays
+    """
+    block_starts, block_ends = array.array("q"), array.array("q")
+    span_starts, span_ends = array.array("q"), array.array("q")
+    for _, start, end, blocks in alignments:
+        span_starts.append(start)
+        span_ends.append(end)
+        for block_start, block_end in blocks:
+            block_starts.append(block_start)
+            block_ends.append(block_end)
+
+    block_starts = np.frombuffer(block_starts, dtype=np.int64)
+    block_ends = np.frombuffer(block_ends, dtype=np.int64)
+    evidence = dict()
+
+    # Boundary track: a block covers the window [x - 3, x + 3) for x in [start + 3, end - 2)
+    flank = msi_engine.FLANK
+    usable = block_ends - block_starts >= 2 * flank
+    positions = np.concatenate([block_starts[usable] + flank, block_ends[usable] - flank + 1])
+    deltas = np.concatenate([np.ones(usable.sum(), dtype=np.int64), -np.ones(usable.sum(), dtype=np.int64)])
+    track_pos, inverse = np.unique(positions, return_inverse=True)
+    evidence["track_pos"] = track_pos
+    evidence["track_depth"] = np.cumsum(np.bincount(inverse, weights=deltas, minlength=len(track_pos))).astype(
+        np.int64)
+
+    # Coverage runs: merge overlapping and touching blocks
+    order = np.argsort(block_starts, kind="stable")
+    starts, ends = block_starts[order], block_ends[order]
+    reach = np.maximum.accumulate(ends) if len(ends) else ends
+    new_run = np.ones(len(starts), dtype=bool)
+    new_run[1:] = starts[1:] > reach[:-1]
+    evidence["run_starts"] = starts[new_run]
+    evidence["run_ends"] = np.maximum.reduceat(ends, np.flatnonzero(new_run)) if len(ends) else ends
+
+    # Spans: distinct (start, end) pairs sorted by start, with counts
+    span_starts = np.frombuffer(span_starts, dtype=np.int64)
+    span_ends = np.frombuffer(span_ends, dtype=np.int64)
+    spans, span_counts = np.unique(np.stack([span_starts, span_ends], axis=1), axis=0, return_counts=True) \
+        if len(span_starts) else (np.zeros((0, 2), dtype=np.int64), np.zeros(0, dtype=np.int64))
+    evidence["span_starts"] = spans[:, 0]
+    evidence["span_ends"] = spans[:, 1]
+    evidence["span_counts"] = span_counts.astype(np.int64)
+    return evidence
+
+
+def _collect_chrom_task(task):
+    bam_path, chrom = task
+    with pysam.AlignmentFile(bam_path) as bam:
+        return chrom, collect_evidence(msi_engine.iter_alignments(bam.fetch(chrom)))
+
+
+def build_evidence(bam_path, threads=1):
+    """
+    Read the bam once and collect the evidence of every chromosome
+    :param bam_path: coordinate sorted bam, indexed when threads > 1
+    :param threads: number of chromosomes collected in parallel
+    :return: dict of chrom to evidence
+    """
+    evidence = dict()
+    if threads > 1:
+        with pysam.AlignmentFile(bam_path) as bam:
+            chroms = list(bam.references)
+        pool = multiprocessing.Pool(threads)
+        try:
+            for chrom, chrom_evidence in pool.imap_unordered(_collect_chrom_task,
+                                                             [(bam_path, chrom) for chrom in chroms]):
+                evidence[chrom] = chrom_evidence
+        finally:
+            pool.close()
+            pool.join()
+        return evidence
+
+    with pysam.AlignmentFile(bam_path) as bam:
+        for chrom, alignments in itertools.groupby(msi_engine.iter_alignments(bam.fetch(until_eof=True)),
+                                                   key=operator.itemgetter(0)):
+            if chrom in evidence:
+                raise ValueError("Alignments are not coordinate sorted: {} seen twice".format(chrom))
+            evidence[chrom] = collect_evidence(alignments)
+    return evidence
+
+
+def save_evidence(evidence, path):
+    """
+    Save the evidence as a compressed npz, moved in place once complete
+    """
+    chroms = sorted(evidence)
+    arrays = {"chroms": np.array(chroms, dtype=str)}
+    for index, chrom in enumerate(chroms):
+        for name, values in evidence[chrom].items():
+            arrays["c{}_{}".format(index, name)] = values
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".npz")
+    with os.fdopen(fd, "wb") as out_handle:
+        np.savez_compressed(out_handle, **arrays)
+    os.replace(tmp_path, path)
+
+
+class Evidence(object):
+    """ Lazily loaded evidence of a cache entry, one chromosome at a time """
+
+    FIELDS = ("track_pos", "track_depth", "run_starts", "run_ends", "span_starts", "span_ends", "span_counts")
+
+    def __init__(self, path):
+        self.npz = np.load(path)
+        self.chroms = {chrom: index for index, chrom in enumerate(self.npz["chroms"].tolist())}
+
+    def __contains__(self, chrom):
+        return chrom in self.chroms
+
+    def __getitem__(self, chrom):
+        index = self.chroms[chrom]
+        return {name: self.npz["c{}_{}".format(index, name)] for name in self.FIELDS}
+
+    def close(self):
+        self.npz.close()
+
+
+def query_boundary(evidence, positions):
+    """
+    Number of reads with a block covering [x - 3, x + 3) for every position x
+    """
+    slot = np.searchsorted(evidence["track_pos"], positions, side="right") - 1
+    depth = np.zeros(len(positions), dtype=np.int64)
+    inside = slot >= 0
+    depth[inside] = evidence["track_depth"][slot[inside]]
+    return depth
+
+
+def query_covered(evidence, starts, ends):
+    """
+    Number of bases in [start, end) covered by at least one block
+    """
+    run_starts, run_ends = evidence["run_starts"], evidence["run_ends"]
+    run_cum = np.concatenate([[0], np.cumsum(run_ends - run_starts)])
+    first = np.searchsorted(run_ends, starts, side="right")
+    last = np.searchsorted(run_starts, ends, side="left")
+    covered = np.zeros(len(starts), dtype=np.int64)
+    hit = first < last
+    first, last = first[hit], last[hit]
+    covered[hit] = (run_cum[last] - run_cum[first]
+                    - np.maximum(0, starts[hit] - run_starts[first])
+                    - np.maximum(0, run_ends[last - 1] - ends[hit]))
+    return covered
+
+
+def query_spanning(evidence, window_starts, window_ends):
+    """
+    Number of reads whose span contains [window_start, window_end). Spans
+    are split into chunks with their ends sorted, so whole chunks are
+    counted with one binary search per query and only the last, partial
+    chunk is scanned.
+    """
+    span_starts, span_ends, span_counts = evidence["span_starts"], evidence["span_ends"], evidence["span_counts"]
+    spanning = np.zeros(len(window_starts), dtype=np.int64)
+    if not len(span_starts) or not len(window_starts):
+        return spanning
+
+    chunk = max(MIN_SPAN_CHUNK, int(np.sqrt(len(span_starts))))
+    n_chunks = len(span_starts) // chunk
+    # Spans with start <= window start are the prefix [0, limit)
+    limit = np.searchsorted(span_starts, window_starts, side="right")
+    full_chunks = limit // chunk
+
+    order = np.argsort(window_starts, kind="stable")
+    sorted_full = full_chunks[order]
+    for index in range(n_chunks):
+        # Queries are sorted by start, so the ones covering this chunk are a suffix
+        begin = np.searchsorted(sorted_full, index, side="right")
+        if begin == len(order):
+            break
+        queries = order[begin:]
+        chunk_slice = slice(index * chunk, (index + 1) * chunk)
+        by_end = np.argsort(span_ends[chunk_slice], kind="stable")
+        chunk_ends = span_ends[chunk_slice][by_end]
+        at_least = np.concatenate([np.cumsum(span_counts[chunk_slice][by_end][::-1])[::-1], [0]])
+        spanning[queries] += at_least[np.searchsorted(chunk_ends, window_ends[queries], side="left")]
+
+    for query in np.flatnonzero(limit > full_chunks * chunk):
+        partial = slice(full_chunks[query] * chunk, limit[query])
+        spanning[query] += span_counts[partial][span_ends[partial] >= window_ends[query]].sum()
+    return spanning
+
+
+def query_evidence(evidence, table):
+    """
+    Answer A1, A2, Exon and CovFrac for an intron table from cached evidence
+    :param evidence: Evidence or dict of chrom to evidence arrays
+    :param table: IntronTable
+    :return: dict of a1, a2, exon and covfrac arrays aligned with the table
+    """
+    counts = msi_engine.new_counts(len(table))
+    flank = msi_engine.FLANK
+    for code, chrom in enumerate(table.chroms):
+        rows = np.flatnonzero(table.chrom == code)
+        if not len(rows) or chrom not in evidence:
+            continue
+        chrom_evidence = evidence[chrom]
+        starts, ends = table.start[rows], table.end[rows]
+        counts["a1"][rows] = query_boundary(chrom_evidence, starts)
+        counts["a2"][rows] = query_boundary(chrom_evidence, ends)
+        counts["exon"][rows] = query_spanning(chrom_evidence, starts - flank, ends + flank)
+        counts["covfrac"][rows] = [msi_engine.coverage_fraction(covered, length) for covered, length
+                                   in zip(query_covered(chrom_evidence, starts, ends).tolist(),
+                                          (ends - starts).tolist())]
+    return counts
+
+
+def evict(cache_dir, max_bytes=None, max_age_days=None, keep=None):
+    """
+    Drop cache entries older than max_age_days (by last use) and then the
+    least recently used ones until the cache fits in max_bytes
+    :param keep: entry that is never evicted, e.g. the one in use
+    """
+    entries = list()
+    for name in os.listdir(cache_dir):
+        if name.endswith(".evidence.npz"):
+            path = os.path.join(cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Evicted by a concurrent run
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    for last_used, size, path in entries:
+        too_old = max_age_days is not None and now - last_used > max_age_days * 86400
+        too_big = max_bytes is not None and total > max_bytes
+        if path == keep or not (too_old or too_big):
+            continue
+        logging.info("Evicting cache entry {}".format(path))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def count_introns_cached(bam_path, table, cache_dir, threads=1, max_bytes=None, max_age_days=None):
+    """
+    Count the introns from the cache, reading the bam only on a cache miss
+    :param bam_path: coordinate sorted bam file
+    :param table: IntronTable
+    :param cache_dir: directory holding the cache entries
+    :param threads: number of chromosomes collected in parallel on a miss
+    :param max_bytes: evict least recently used entries above this size
+    :param max_age_days: evict entries unused for this many days
+    :return: dict of a1, a2, exon and covfrac arrays aligned with the table
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    path = os.path.join(cache_dir, "{}.evidence.npz".format(cache_key(file_checksum(bam_path, cache_dir))))
+
+    try:
+        evidence = Evidence(path)
+    except FileNotFoundError:
+        # Not cached yet, or evicted by a concurrent run
+        evidence = None
+
+    if evidence is not None:
+        logging.info("Cache hit for {bam}: {path}".format(bam=bam_path, path=path))
+        try:
+            # The modification time doubles as last use for the eviction
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted since it was opened, the open entry stays readable
+            pass
+        try:
+            counts = query_evidence(evidence, table)
+        finally:
+            evidence.close()
+    else:
+        logging.info("Cache miss for {bam}, collecting read evidence".format(bam=bam_path))
+        evidence = build_evidence(bam_path, threads=threads)
+        save_evidence(evidence, path)
+        # Queried in memory, a concurrent run may evict the saved entry right away
+        counts = query_evidence(evidence, table)
+    # Also on a hit, a lowered limit or entries added by other runs are enforced by every run
+    evict(cache_dir, max_bytes=max_bytes, max_age_days=max_age_days, keep=path)
+    return counts
@@ -0,0 +1,464 @@
+# ---------------------- msi engine ------------------------------------------
+# Single pass counting engine for get_msi.py
+# Walks a coordinate sorted bam once and fills A1, A2, Exon and CovFrac for
+# every intron at the same time. The counts follow the bedtools calls made
+# in get_msi.py: A1/A2 are reads with a split block fully covering the 6bp
+# boundary window, Exon are reads whose span covers the intron plus 3bp on
+# either side and CovFrac is the fraction of intron bases covered by blocks.
+# ----------------------------------------------------------------------------
+import hashlib
+import heapq
+import logging
+import multiprocessing
+import struct
+import sys
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+import pysam
+
+# Flank added around the intron boundaries, see get_msi.a1/a2/exon
+FLANK = 3
+
+# Cigar operations bedtools keeps inside a block when splitting a read.
+# M, D, = and X consume the reference, N closes the block.
+BLOCK_OPS = frozenset((0, 2, 7, 8))
+SKIP_OP = 3
+
+
+def get_blocks(read):
+    """
+    Split an alignment into blocks the way bedtools -split does
+    :param read: pysam aligned segment
+    :return: list of (start, end) blocks and the end of the alignment span
+    """
+    blocks = []
+    block_start = pos = read.reference_start
+    for op, length in read.cigartuples:
+        if op in BLOCK_OPS:
+            pos += length
+        elif op == SKIP_OP:
+            if pos > block_start:
+                blocks.append((block_start, pos))
+            pos += length
+            block_start = pos
+    if pos > block_start:
+        blocks.append((block_start, pos))
+    return blocks, pos
+
+
+def keep_read(name, threshold, seed):
+    """
+    Whether a read is in a subsample, decided by a seeded hash of its name so
+    mates and repeated runs agree and a larger fraction keeps every read of a
+    smaller one
+    :param name: read name
+    :param threshold: fraction of reads to keep scaled to 2 ** 64
+    :param seed: subsample seed
+    """
+    digest = hashlib.blake2b(name.encode(), digest_size=8, key=seed.to_bytes(8, "little"))
+    return int.from_bytes(digest.digest(), "little") < threshold
+
+
+def iter_alignments(reads, sample=None):
+    """
+    Mapped alignments reduced to what the counting needs
+    :param reads: iterable of pysam aligned segments
+    :param sample: optional (fraction, seed) to keep only a subsample of the reads, see keep_read
+    :return: generator of (chrom, start, end, blocks)
+    """
+    threshold = seed = None
+    if sample is not None and sample[0] < 1:
+        threshold, seed = int(sample[0] * 2 ** 64), sample[1]
+    for read in reads:
+        if read.is_unmapped or not read.cigartuples:
+            continue
+        if threshold is not None and not keep_read(read.query_name, threshold, seed):
+            continue
+        blocks, end = get_blocks(read)
+        if blocks:
+            yield read.reference_name, read.reference_start, end, blocks
+
+
+def coverage_fraction(covered, length):
+    """
+    Fraction of covered bases the way bedtools coverage reports it:
+    single precision division printed with seven decimals
+    :param covered: number of covered bases
+    :param length: length of the interval
+    :return: fraction as float
+    """
+    if length <= 0:
+        return 0.0
+    fraction = struct.unpack("f", struct.pack("f", covered / length))[0]
+    return float("{:.7f}".format(fraction))
+
+
+def group_by_chrom(table):
+    """
+    Split an intron table into per chromosome start sorted lists
+    :param table: IntronTable
+    :return: dict of chrom to (indices, starts, ends)
+    """
+    shards = dict()
+    for code, chrom in enumerate(table.chroms):
+        rows = np.flatnonzero(table.chrom == code)
+        if not len(rows):
+            continue
+        rows = rows[np.argsort(table.start[rows], kind="stable")]
+        shards[chrom] = (rows.tolist(), table.start[rows].tolist(), table.end[rows].tolist())
+    return shards
+
+
+class ChromSweep(object):
+    """
+    Counts for all introns of one chromosome. Reads have to be added in
+    coordinate order and finished introns can be collected while reads are
+    still coming in.
+    """
+
+    def __init__(self, starts, ends):
+        """
+        :param starts: intron starts (zero based) sorted ascending
+        :param ends: intron ends in the same order as starts
+        """
+        self.starts = starts
+        self.ends = ends
+        size = len(starts)
+        self.by_end = sorted(range(size), key=ends.__getitem__)
+        self.sorted_ends = [ends[k] for k in self.by_end]
+        self.a1 = [0] * size
+        self.a2 = [0] * size
+        self.exon = [0] * size
+        # A1/A2 are kept as difference arrays over the start/end order and
+        # turned into counts once no later read can touch them anymore
+        self._a1_diff = [0] * (size + 1)
+        self._a2_diff = [0] * (size + 1)
+        self._a1_pos = self._a1_sum = 0
+        self._a2_pos = self._a2_sum = 0
+        # Coverage: blocks not yet merged and finished runs of covered bases
+        self._pending = []
+        self._run = None
+        self._run_starts = []
+        self._run_ends = []
+        self._run_cum = [0]
+        self._last_start = -1
+        self._next = 0
+
+    def add(self, start, end, blocks):
+        """
+        Add one alignment
+        :param start: alignment start
+        :param end: alignment end including skipped regions
+        :param blocks: list of (start, end) blocks from get_blocks
+        """
+        if start < self._last_start:
+            raise ValueError("Alignments are not coordinate sorted")
+        self._last_start = start
+        self._advance(start)
+
+        starts = self.starts
+        sorted_ends = self.sorted_ends
+        for block_start, block_end in blocks:
+            heapq.heappush(self._pending, (block_start, block_end))
+            # Boundary windows [x - 3, x + 3) lying fully inside the block
+            low = block_start + FLANK
+            high = block_end - FLANK
+            if low > high:
+                continue
+            lo, hi = bisect_left(starts, low), bisect_right(starts, high)
+            if lo < hi:
+                self._a1_diff[lo] += 1
+                self._a1_diff[hi] -= 1
+            lo, hi = bisect_left(sorted_ends, low), bisect_right(sorted_ends, high)
+            if lo < hi:
+                self._a2_diff[lo] += 1
+                self._a2_diff[hi] -= 1
+
+        # Exon window [start - 3, end + 3) inside the alignment span
+        ends = self.ends
+        exon = self.exon
+        for k in range(bisect_left(starts, start + FLANK), bisect_right(starts, end - FLANK)):
+            if ends[k] + FLANK <= end:
+                exon[k] += 1
+
+    def collect(self, position):
+        """
+        Pop introns that no alignment starting at or after position can change
+        :param position: start of the next alignment
+        :return: list of (index, a1, a2, exon, covfrac), index in start order
+        """
+        self._advance(position)
+        finished = []
+        starts, ends = self.starts, self.ends
+        while self._next < len(starts) and ends[self._next] <= position:
+            k = self._next
+            covered = self._covered(starts[k], ends[k])
+            finished.append((k, self.a1[k], self.a2[k], self.exon[k],
+                             coverage_fraction(covered, ends[k] - starts[k])))
+            self._next += 1
+        return finished
+
+    def finish(self):
+        """
+        Close the chromosome
+        :return: list of (index, a1, a2, exon, covfrac) for remaining introns
+        """
+        finished = self.collect(sys.maxsize)
+        if self._run is not None:
+            self._close_run()
+        return finished
+
+    def _advance(self, position):
+        # Blocks starting before position can only be extended by blocks
+        # already seen, so merge them into runs of covered bases
+        pending = self._pending
+        while pending and pending[0][0] < position:
+            block_start, block_end = heapq.heappop(pending)
+            run = self._run
+            if run is not None and block_start <= run[1]:
+                if block_end > run[1]:
+                    run[1] = block_end
+            else:
+                if run is not None:
+                    self._close_run()
+                self._run = [block_start, block_end]
+
+        # Boundary counts whose window starts before position + 3 are final
+        starts = self.starts
+        while self._a1_pos < len(starts) and starts[self._a1_pos] < position + FLANK:
+            self._a1_sum += self._a1_diff[self._a1_pos]
+            self.a1[self._a1_pos] = self._a1_sum
+            self._a1_pos += 1
+        sorted_ends = self.sorted_ends
+        while self._a2_pos < len(sorted_ends) and sorted_ends[self._a2_pos] < position + FLANK:
+            self._a2_sum += self._a2_diff[self._a2_pos]
+            self.a2[self.by_end[self._a2_pos]] = self._a2_sum
+            self._a2_pos += 1
+
+    def _close_run(self):
+        run_start, run_end = self._run
+        self._run_starts.append(run_start)
+        self._run_ends.append(run_end)
+        self._run_cum.append(self._run_cum[-1] + run_end - run_start)
+        self._run = None
+
+    def _covered(self, start, end):
+        run_starts, run_ends, run_cum = self._run_starts, self._run_ends, self._run_cum
+        covered = 0
+        first = bisect_right(run_ends, start)
+        last = bisect_left(run_starts, end)
+        if first < last:
+            covered = run_cum[last] - run_cum[first]
+            covered -= max(0, start - run_starts[first])
+            covered -= max(0, run_ends[last - 1] - end)
+        if self._run is not None:
+            covered += max(0, min(self._run[1], end) - max(self._run[0], start))
+        return covered
+
+
+def plan_shards(table, size):
+    """
+    Split introns into shards that can be counted independently. Shards are
+    cut only where no intron window spans the cut so neighbouring shards
+    share as few reads as possible.
+    :param table: IntronTable
+    :param size: rough number of introns per shard
+    :return: list of (chrom, fetch_start, fetch_end, indices, starts, ends)
+    """
+    shards = list()
+    for chrom, (indices, starts, ends) in group_by_chrom(table).items():
+        begin = reach = 0
+        for k in range(len(starts)):
+            if k - begin >= size and starts[k] - FLANK >= reach:
+                shards.append((chrom, max(0, starts[begin] - FLANK), reach,
+                               indices[begin:k], starts[begin:k], ends[begin:k]))
+                begin = k
+            reach = max(reach, ends[k] + FLANK) if k > begin else ends[k] + FLANK
+        shards.append((chrom, max(0, starts[begin] - FLANK), reach, indices[begin:], starts[begin:], ends[begin:]))
+    return shards
+
+
+def count_shard(bam_path, shard, sample=None):
+    """
+    Count one shard, fetching only its reads through the bam index
+    :param bam_path: coordinate sorted and indexed bam file
+    :param shard: shard tuple from plan_shards
+    :param sample: optional (fraction, seed) read subsample
+    :return: list of (index, a1, a2, exon, covfrac) with indices into the intron table
+    """
+    chrom, fetch_start, fetch_end, indices, starts, ends = shard
+    sweep = ChromSweep(starts, ends)
+    with pysam.AlignmentFile(bam_path) as bam:
+        if chrom in bam.references:
+            for _, start, end, blocks in iter_alignments(bam.fetch(chrom, fetch_start, fetch_end), sample):
+                sweep.add(start, end, blocks)
+    return [(indices[k],) + tuple(counts) for k, *counts in sweep.finish()]
+
+
+def _count_shard_task(task):
+    return count_shard(*task)
+
+
+def new_counts(size):
+    """
+    Empty count columns for size introns
+    :return: dict of a1, a2, exon and covfrac arrays
+    """
+    return {"a1": np.zeros(size, dtype=np.int64),
+            "a2": np.zeros(size, dtype=np.int64),
+            "exon": np.zeros(size, dtype=np.int64),
+            "covfrac": np.zeros(size, dtype=np.float64)}
+
+
+def store_counts(counts, finished):
+    """
+    Copy finished introns into the count columns
+    :param counts: dict from new_counts
+    :param finished: list of (row, a1, a2, exon, covfrac)
+    """
+    if not finished:
+        return
+    rows, a1_counts, a2_counts, exon_counts, covfracs = zip(*finished)
+    rows = np.asarray(rows)
+    counts["a1"][rows] = a1_counts
+    counts["a2"][rows] = a2_counts
+    counts["exon"][rows] = exon_counts
+    counts["covfrac"][rows] = covfracs
+
+
+def stream_counts(alignments, table):
+    """
+    Count introns while the alignments stream in. An intron is handed out as
+    soon as the alignments have moved past its end, so only the introns of
+    the current chromosome are kept.
+    :param alignments: iterable of (chrom, start, end, blocks) in coordinate order
+    :param table: IntronTable
+    :return: generator of lists of finished (row, a1, a2, exon, covfrac)
+    """
+    shards = group_by_chrom(table)
+    seen = set()
+    current = sweep = None
+
+    def to_rows(chrom, finished):
+        indices = shards[chrom][0]
+        return [(indices[k],) + tuple(counts) for k, *counts in finished]
+
+    for chrom, start, end, blocks in alignments:
+        if chrom != current:
+            if sweep is not None:
+                yield to_rows(current, sweep.finish())
+            if chrom in seen:
+                raise ValueError("Alignments are not coordinate sorted: {} seen twice".format(chrom))
+            seen.add(chrom)
+            current = chrom
+            sweep = ChromSweep(shards[chrom][1], shards[chrom][2]) if chrom in shards else None
+        if sweep is not None:
+            sweep.add(start, end, blocks)
+            finished = sweep.collect(start)
+            if finished:
+                yield to_rows(chrom, finished)
+    if sweep is not None:
+        yield to_rows(current, sweep.finish())
+
+    # Introns on chromosomes without any alignments
+    for chrom, (indices, _, _) in shards.items():
+        if chrom not in seen:
+            yield [(row, 0, 0, 0, 0.0) for row in indices]
+
+
+def count_introns(bam_path, table, threads=1, sample=None):
+    """
+    Count A1, A2, Exon and CovFrac for every intron in one pass over the bam
+    :param bam_path: coordinate sorted bam file, indexed when threads > 1
+    :param table: IntronTable
+    :param threads: number of processes counting shards of the introns
+    :param sample: optional (fraction, seed) to count only a subsample of the reads
+    :return: dict of a1, a2, exon and covfrac arrays aligned with the table
+    """
+    if threads > 1:
+        return count_introns_sharded(bam_path, table, threads, sample)
+
+    counts = new_counts(len(table))
+    with pysam.AlignmentFile(bam_path) as bam:
+        for finished in stream_counts(iter_alignments(bam.fetch(until_eof=True), sample), table):
+            store_counts(counts, finished)
+    return counts
+
+
+def _count_checkpoint_task(task):
+    number, bam_path, shard, sample = task
+    return number, count_shard(bam_path, shard, sample)
+
+
+def count_introns_checkpointed(bam_path, table, checkpoint, shard_size, threads=1, sample=None):
+    """
+    Count the introns shard by shard, every finished shard is kept in the
+    checkpoint so a restarted run counts only the shards still missing.
+    :param bam_path: coordinate sorted and indexed bam file
+    :param table: IntronTable
+    :param checkpoint: checkpoint.Checkpoint of this bam, table, shard size and sample
+    :param shard_size: rough number of introns per shard, see plan_shards
+    :param threads: number of processes counting the missing shards
+    :param sample: optional (fraction, seed) read subsample
+    :return: dict of a1, a2, exon and covfrac arrays aligned with the table
+    """
+    counts = new_counts(len(table))
+    shards = plan_shards(table, shard_size)
+    tasks = list()
+    for number, shard in enumerate(shards):
+        if number in checkpoint:
+            finished = checkpoint.load(number)
+            for column in counts:
+                counts[column][finished["rows"]] = finished[column]
+        else:
+            tasks.append((number, bam_path, shard, sample))
+    logging.info("Counting {n} of {total} shards".format(n=len(tasks), total=len(shards)))
+
+    def save(number, finished):
+        store_counts(counts, finished)
+        rows, a1_counts, a2_counts, exon_counts, covfracs = zip(*finished) if finished else ((),) * 5
+        checkpoint.save(number, {"rows": np.asarray(rows, dtype=np.int64),
+                                 "a1": np.asarray(a1_counts, dtype=np.int64),
+                                 "a2": np.asarray(a2_counts, dtype=np.int64),
+                                 "exon": np.asarray(exon_counts, dtype=np.int64),
+                                 "covfrac": np.asarray(covfracs, dtype=np.float64)})
+
+    if threads > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(threads)
+        try:
+            for number, finished in pool.imap_unordered(_count_checkpoint_task, tasks):
+                save(number, finished)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            save(*_count_checkpoint_task(task))
+    return counts
+
+
+def count_introns_sharded(bam_path, table, threads, sample=None):
+    """
+    Count the introns in shards spread over a pool of processes. Every shard
+    reads only its own region from the bam index and results are stored by
+    table row, whichever shard finishes first.
+    :param bam_path: coordinate sorted and indexed bam file
+    :param table: IntronTable
+    :param threads: number of processes
+    :param sample: optional (fraction, seed) read subsample
+    :return: dict of a1, a2, exon and covfrac arrays aligned with the table
+    """
+    counts = new_counts(len(table))
+    if not len(table):
+        return counts
+    # A few shards per process keeps the pool busy when chromosomes differ in size
+    shards = plan_shards(table, max(1, len(table) // (threads * 4)))
+    pool = multiprocessing.Pool(threads)
+    try:
+        for finished in pool.imap_unordered(_count_shard_task, [(bam_path, shard, sample) for shard in shards]):
+            store_counts(counts, finished)
+    finally:
+        pool.close()
+        pool.join()
+    return counts
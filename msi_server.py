@@ -0,0 +1,303 @@
+# ---------------------- msi server ------------------------------------------
+# Long running local MSI worker. Intron panels (an intron bed and its genome
+# sizes, or a panel file of intron_panel.py) are read, named and sorted once
+# and kept in memory, then bams are scored against them over a small HTTP api
+# on localhost:
+#   GET  /panels                          names of the preloaded panels
+#   POST /msi {"panel": NAME, "bam": PATH}  the MSI table of the bam
+# Instead of a panel name a request can give "bed" and "genomesizes" paths or
+# a "panelfile" path, those panels are prepared on first use and kept too.
+# Requests are counted with the sweep engine in a bounded pool of worker
+# processes.
+# ----------------------------------------------------------------------------
+import argparse
+import collections
+import io
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import get_msi
+import metrics
+from intron_panel import IntronPanel
+from intron_table import IntronTable, read_genome_sizes
+
+# Set up once per worker process by init_worker
+_worker_state = dict()
+
+
+def load_panel(bed, gsizes=None):
+    """
+    Intron table of a panel, sorted like the genome sizes as the sweep engine needs it
+    :param bed: intron bed, or a panel file of intron_panel.py when gsizes is None
+    :param gsizes: genome sizes file of the bed
+    """
+    if gsizes is None:
+        # Memory mapped, the arrays keep the mapping open
+        return IntronPanel.open(bed).table
+    return IntronTable.from_bed(bed).sort(read_genome_sizes(gsizes))
+
+
+def panel_key(*paths):
+    """ Key of a panel given by its files, changes when a file is replaced """
+    return tuple((os.path.realpath(path), os.path.getmtime(path)) for path in paths if path is not None)
+
+
+def init_worker(panels, max_panels, options):
+    """
+    Share the preloaded panels with a worker process
+    :param panels: dict of panel name to (IntronTable, genome sizes file)
+    :param max_panels: number of panels given by files kept per worker, least recently used are dropped
+    :param options: keyword arguments of get_msi.get_msi_sweep
+    """
+    # Stopping is left to the server, a worker killed while waiting for a task would block the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _worker_state.update(panels=panels, loaded=collections.OrderedDict(), max_panels=max_panels, options=options)
+
+
+def worker_panel(name, bed, gsizes):
+    """
+    Panel of a request in a worker process, loaded on first use when given by files
+    :param bed: intron bed, or a panel file when gsizes is None
+    """
+    if name is not None:
+        return _worker_state["panels"][name]
+    key, loaded = panel_key(bed, gsizes), _worker_state["loaded"]
+    if key in loaded:
+        loaded.move_to_end(key)
+    else:
+        logging.info("Preparing panel {bed}".format(bed=bed))
+        loaded[key] = (load_panel(bed, gsizes), gsizes)
+        while len(loaded) > _worker_state["max_panels"]:
+            loaded.popitem(last=False)
+    return loaded[key]
+
+
+def score_request(request):
+    """
+    Calculate MSI of one bam against a panel in a worker process
+    :param request: tuple of (panel name or None, bed or panel file, genome sizes or None, bam)
+    :return: the MSI table as text
+    """
+    name, bed, gsizes, bam = request
+    table, gsizes = worker_panel(name, bed, gsizes)
+    logging.info("Scoring {bam}".format(bam=bam))
+    counts = get_msi.get_msi_sweep(table, None, bam, gsizes, **_worker_state["options"])
+    out_handle = io.StringIO()
+    out_handle.write(get_msi.MSI_HEADER)
+    get_msi.write_msi_rows(out_handle, table, np.arange(len(table)), counts)
+    return out_handle.getvalue()
+
+
+class RequestError(Exception):
+    """ A request that can not be served, with its HTTP status """
+
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+
+class MSIServer(ThreadingHTTPServer):
+    """
+    HTTP server handing MSI requests to a pool of worker processes
+    """
+    daemon_threads = True
+
+    def __init__(self, address, panels, workers, max_queue, max_panels, options):
+        """
+        :param address: (host, port) to listen on
+        :param panels: dict of panel name to (IntronTable, genome sizes file or None)
+        :param workers: worker processes
+        :param max_queue: requests waiting for a worker before new ones are refused
+        :param max_panels: panels given by files kept per worker
+        :param options: keyword arguments of get_msi.get_msi_sweep
+        """
+        # Set before binding, a failed bind calls server_close
+        self.pool = None
+        ThreadingHTTPServer.__init__(self, address, MSIRequestHandler)
+        self.panels = panels
+        self.pool = multiprocessing.Pool(workers, initializer=init_worker,
+                                         initargs=(panels, max_panels, options))
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        # Requests already handed to the workers are finished
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def parse_request_body(self, body):
+        """
+        Check a /msi request
+        :param body: decoded json of the request
+        :return: request tuple for score_request
+        """
+        if not isinstance(body, dict) or not isinstance(body.get("bam"), str):
+            raise RequestError(400, "A request needs a bam path")
+        bam = body["bam"]
+        if not os.path.isfile(bam):
+            raise RequestError(400, "The file at {} does not exist".format(bam))
+        if "panel" in body:
+            if body["panel"] not in self.panels:
+                raise RequestError(404, "Unknown panel {}".format(body["panel"]))
+            return body["panel"], None, None, bam
+        if "panelfile" in body:
+            if not isinstance(body["panelfile"], str) or not os.path.isfile(body["panelfile"]):
+                raise RequestError(400, "The file at {} does not exist".format(body["panelfile"]))
+            if not IntronPanel.is_panel(body["panelfile"]):
+                raise RequestError(400, "{} is not an intron panel".format(body["panelfile"]))
+            return None, body["panelfile"], None, bam
+        bed, gsizes = body.get("bed"), body.get("genomesizes")
+        if not (isinstance(bed, str) and isinstance(gsizes, str)):
+            raise RequestError(400, "A request needs a panel name, bed and genomesizes paths or a panelfile path")
+        for path in (bed, gsizes):
+            if not os.path.isfile(path):
+                raise RequestError(400, "The file at {} does not exist".format(path))
+        return None, bed, gsizes, bam
+
+    def score(self, request):
+        """ Run a request in the pool, refused when the pool and its queue are full """
+        if not self.slots.acquire(blocking=False):
+            raise RequestError(503, "All workers are busy, try again later")
+        try:
+            return self.pool.apply_async(score_request, (request,)).get()
+        finally:
+            self.slots.release()
+
+
+class MSIRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/panels":
+            self.send_text(404, "Not found\n")
+            return
+        self.send_json(200, {name: len(table) for name, (table, _) in self.server.panels.items()})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/msi":
+            self.send_text(404, "Not found\n")
+            return
+        try:
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+            except ValueError:
+                raise RequestError(400, "The request body is not valid json")
+            request = self.server.parse_request_body(body)
+            try:
+                result = self.server.score(request)
+            except RequestError:
+                raise
+            except Exception as error:
+                logging.exception("Failed to score {bam}".format(bam=request[3]))
+                raise RequestError(500, "{}: {}".format(type(error).__name__, error))
+        except RequestError as error:
+            self.send_json(error.status, {"error": str(error)})
+            return
+        metrics.count("requests")
+        self.send_text(200, result, "text/tab-separated-values")
+
+    def send_text(self, status, text, content_type="text/plain"):
+        data = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_json(self, status, body):
+        self.send_text(status, json.dumps(body) + "\n", "application/json")
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s", self.address_string(), format % args)
+
+
+def main(args):
+    logging.info("Received the following args: \n {}".format(args))
+
+    panels = dict()
+    with metrics.stage("panels"):
+        for name, bed, gsizes in args.panels or []:
+            logging.info("Preparing panel {name}: {bed}".format(name=name, bed=bed))
+            panels[name] = (load_panel(bed, gsizes), gsizes)
+        for name, path in args.panel_files or []:
+            logging.info("Opening panel {name}: {path}".format(name=name, path=path))
+            panels[name] = (load_panel(path), None)
+    options = {"cache_dir": args.cache_dir, "cache_max_gb": args.cache_max_gb}
+
+    server = MSIServer((args.host, args.port), panels, args.workers, args.max_queue, args.max_panels, options)
+    logging.info("Serving MSI on http://{host}:{port}".format(host=args.host, port=server.server_address[1]))
+    # Stop like on ctrl-c when the service is terminated, shutdown waits for serve_forever so not in this thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    try:
+        with metrics.stage("serve"):
+            server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Shutting down")
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s : %(message)s', level=logging.INFO)
+
+
+    def is_valid_file(parser, arg):
+        """ Check if file exists """
+        if not os.path.isfile(arg):
+            parser.error('The file at %s does not exist' % arg)
+        else:
+            return arg
+
+
+    epilog = "EXAMPLE: python " + os.path.basename(__file__) + \
+             " --panel human /path/to/human_introns.bed /path/to/hg38.sizes" \
+             " --panel-file mouse /path/to/mouse_introns.panel --workers 4"
+
+    parser = argparse.ArgumentParser(description="Serve MSI of bam files against intron panels kept in memory",
+                                     epilog=epilog)
+
+    parser.add_argument('--panel', dest='panels', action="append", nargs=3,
+                        metavar=("NAME", "BED", "GENOMESIZES"),
+                        help="Intron panel to preload, may be repeated")
+    parser.add_argument('--panel-file', dest='panel_files', action="append", nargs=2, metavar=("NAME", "PANEL"),
+                        help="Intron panel prepared by intron_panel.py to preload, may be repeated")
+    parser.add_argument('--host', dest='host', default="127.0.0.1", help="DEFAULT: 127.0.0.1")
+    parser.add_argument('--port', dest='port', type=int, default=8765, help="DEFAULT: 8765")
+    parser.add_argument('-w', '--workers', dest='workers', type=int, default=2,
+                        help="Worker processes scoring bams. DEFAULT: 2")
+    parser.add_argument('--max-queue', dest='max_queue', type=int, default=8,
+                        help="Requests waiting for a worker before new ones are refused with 503. DEFAULT: 8")
+    parser.add_argument('--max-panels', dest='max_panels', type=int, default=8,
+                        help="Panels given by bed and genomesizes in requests kept per worker. DEFAULT: 8")
+    parser.add_argument('--cache-dir', dest='cache_dir',
+                        help="Keep the read evidence of every bam in this directory, see get_msi.py")
+    parser.add_argument('--cache-max-gb', dest='cache_max_gb', type=float,
+                        help="Evict least recently used cache entries above this size")
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    for name, bed, gsizes in args.panels or []:
+        is_valid_file(parser, bed)
+        is_valid_file(parser, gsizes)
+    for name, path in args.panel_files or []:
+        is_valid_file(parser, path)
+        if not IntronPanel.is_panel(path):
+            parser.error("{} is not an intron panel, prepare it with intron_panel.py".format(path))
+    names = [panel[0] for panel in (args.panels or []) + (args.panel_files or [])]
+    if len(set(names)) != len(names):
+        parser.error("Panel names have to be unique")
+    if args.workers < 1:
+        parser.error("--workers has to be at least 1")
+
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
@@ -0,0 +1,209 @@
+# ---------------------- pwm scorer ------------------------------------------
+# NumPy replacement for the gimmemotifs Scanner as get_intron_type.py uses it:
+# best log-odds hit of every motif on both strands (nreport=1, threshold 0),
+# rescaled to 0-50 / 50-100. All windows of all sequences are scored at once,
+# one motif column at a time, in the same order gimmemotifs sums them.
+# Motifs are read and rounded the way gimmemotifs 0.18 does it, and
+# tests/test_pwm_scorer.py pins the scores to Scanner scores recorded with
+# gimmemotifs 0.18.4. Other gimmemotifs releases round the motifs differently.
+# ----------------------------------------------------------------------------
+
+import re
+
+import numpy as np
+
+# gimmemotifs Motif constants
+BACKGROUND = 0.25
+PSEUDO_LOGODDS = 0.01
+PSEUDO_PFM = 0.001
+# Decimals the motif fractions are rounded to, also used by the motif file the Scanner re-reads
+PLACES = 4
+# pwmscan only keeps hits above its initial best score
+SCAN_FLOOR = -100
+
+# Sequence codes: A, C, G, T, N, anything else, past the end of the sequence
+BASE_CODES = np.full(256, 5, dtype=np.uint8)
+for _code, _base in enumerate("ACGTN"):
+    BASE_CODES[ord(_base)] = BASE_CODES[ord(_base.lower())] = _code
+PAD = 6
+
+NUMBER = r"(\d+(\.\d+)?(e-\d+)?)"
+PWM_LINE_RE = re.compile(r"\s+".join([NUMBER] * 4))
+
+
+class PWM(object):
+    """
+    A motif as gimmemotifs reads it from a pwm file
+    """
+
+    def __init__(self, motif_id, rows):
+        """
+        :param motif_id: motif id, the text after ">"
+        :param rows: per position A, C, G, T fractions or counts
+        """
+        self.id = motif_id
+        if not np.all(np.isclose(np.sum(rows, 1), 1, atol=1e-3)):
+            # Counts, converted to fractions with a pseudo count
+            rows = [[(x + PSEUDO_PFM) / (float(np.sum(row)) + PSEUDO_PFM * 4) for x in row] for row in rows]
+        self.pwm = [saferound([float(x) for x in row], PLACES) for row in rows]
+        logodds = np.array([[np.log(n / BACKGROUND + PSEUDO_LOGODDS) for n in row] for row in np.array(self.pwm)])
+        self.logodds = logodds.tolist()
+        self.min_score = logodds.min(1).sum()
+        self.max_score = logodds.max(1).sum()
+
+    def __len__(self):
+        return len(self.pwm)
+
+    def scan_motif(self):
+        """
+        The motif the gimmemotifs Scanner actually scans with, the pwm written to its motif file and read back
+        """
+        return PWM(self.id, [[float("{:.{}f}".format(p, PLACES)) for p in row] for row in self.pwm])
+
+
+def saferound(values, places):
+    """
+    Round values to places keeping their rounded sum, iteround.saferound with
+    the "difference" strategy, which gimmemotifs rounds every motif row with
+    :param values: list of floats
+    :return: list of rounded floats
+    """
+    step = 1 / (10 ** places)
+    rounded = [round(value, places) for value in values]
+    total = round(sum(values), places)
+    # Kept across rounds and summed in its order, like the list iteround re-sorts
+    order = list(range(len(values)))
+    rounded_total = round(sum(rounded[i] for i in order), places)
+    while order and rounded_total != total:
+        diff = round(total - rounded_total, places)
+        increment = -step if diff < 0 else step
+        # Largest rounding error first when rounding up, smallest first when rounding down
+        order.sort(key=lambda i: values[i] - rounded[i], reverse=diff >= 0)
+        for i in order[:min(int(abs(diff) / step), len(order))]:
+            rounded[i] = round(rounded[i] + increment, places)
+        rounded_total = round(sum(rounded[i] for i in order), places)
+    return rounded
+
+
+def read_pwms(pwm_file):
+    """
+    Read motifs from a gimmemotifs style pwm file: ">id" lines followed by one
+    line of four numbers per position, duplicated ids get a _N suffix
+    :return: list of PWM
+    """
+    motifs, rows, motif_id, seen_id = list(), list(), "", dict()
+    with open(pwm_file) as in_handle:
+        for line in in_handle:
+            if line.startswith("#") or line.strip() == "":
+                continue
+            if line.startswith(">"):
+                if rows:
+                    motifs.append(PWM(motif_id, rows))
+                    rows = list()
+                motif_id = line.strip()[1:]
+                seen_id[motif_id] = seen_id.get(motif_id, 0) + 1
+                if seen_id[motif_id] > 1:
+                    motif_id += "_{}".format(seen_id[motif_id] - 1)
+            else:
+                match = PWM_LINE_RE.search(line)
+                if match:
+                    rows.append([float(match.group(group)) for group in (1, 4, 7, 10)])
+    if rows:
+        motifs.append(PWM(motif_id, rows))
+    return motifs
+
+
+def encode(seqs):
+    """
+    Encode sequences into a padded code matrix
+    :param seqs: list of str or bytes
+    :return: uint8 array of shape (n sequences, longest sequence), see BASE_CODES and PAD
+    """
+    seqs = [seq.encode() if isinstance(seq, str) else seq for seq in seqs]
+    width = max([len(seq) for seq in seqs] + [0])
+    codes = np.full((len(seqs), width), PAD, dtype=np.uint8)
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    if len(seqs) and width:
+        if lengths.min() == width:
+            codes[:] = BASE_CODES[np.frombuffer(b"".join(seqs), dtype=np.uint8).reshape(len(seqs), width)]
+        else:
+            for row, seq in enumerate(seqs):
+                codes[row, :len(seq)] = BASE_CODES[np.frombuffer(seq, dtype=np.uint8)]
+    return codes
+
+
+def encode_windows(windows, lengths):
+    """
+    Encode a byte matrix of sequences, such as genome_fasta windows, into a padded code matrix
+    :param windows: uint8 array (n sequences, width)
+    :param lengths: length of every sequence, positions past it become PAD
+    """
+    codes = BASE_CODES[windows]
+    codes[np.arange(windows.shape[1]) >= np.asarray(lengths)[:, None]] = PAD
+    return codes
+
+
+def best_scores(codes, motif):
+    """
+    Best raw log-odds hit of a motif on either strand for every sequence, what
+    Scanner.scan(nreport=1) reports with a threshold of 0
+    :param codes: encode output
+    :param motif: PWM as scanned (see PWM.scan_motif)
+    :return: float64 array
+    """
+    n_seqs, width = codes.shape
+    length = len(motif)
+    n_windows = width - length + 1
+    if n_windows <= 0:
+        return np.full(n_seqs, motif.min_score)
+
+    # Score added per position and base code, N and any other character add the column minimum
+    logodds = np.array(motif.logodds, dtype=np.float64)
+    forward = np.zeros((length, PAD + 1))
+    reverse = np.zeros((length, PAD + 1))
+    forward[:, :4] = logodds
+    reverse[:, :4] = logodds[::-1, ::-1]
+    forward[:, 4:PAD] = logodds.min(axis=1)[:, None]
+    reverse[:, 4:PAD] = logodds[::-1].min(axis=1)[:, None]
+    forward[:, PAD] = reverse[:, PAD] = -np.inf
+
+    forward_scores = np.zeros((n_seqs, n_windows))
+    reverse_scores = np.zeros((n_seqs, n_windows))
+    for position in range(length):
+        window_codes = codes[:, position:position + n_windows]
+        forward_scores += forward[position][window_codes]
+        reverse_scores += reverse[position][window_codes]
+
+    best = np.maximum(forward_scores.max(axis=1), reverse_scores.max(axis=1))
+    # No hit above the threshold (the pwm minimum) reports the minimum
+    return np.where((best >= motif.min_score) & (best > SCAN_FLOOR), best, motif.min_score)
+
+
+def rescale_scores(scores, motif):
+    """
+    Rescale raw scores like get_intron_type.rescale: [min, 0] to [0, 50] and [0, max] to [50, 100]
+    :param motif: PWM as read from the pwm file, its unrounded min/max are used
+    """
+    low = (50 - 0) * (scores - motif.min_score) / (0 - motif.min_score) + 0
+    high = (100 - 50) * (scores - 0) / (motif.max_score - 0) + 50
+    return np.where(scores < 0, low, high)
+
+
+def score_sequences(seqs, motifs):
+    """
+    Score sequences against motifs
+    :param seqs: list of sequences
+    :param motifs: list of PWM
+    :return: dict of motif id to rescaled score array
+    """
+    return score_codes(encode(seqs), motifs)
+
+
+def score_codes(codes, motifs):
+    """
+    Score encoded sequences against motifs
+    :param codes: encode or encode_windows output
+    :param motifs: list of PWM
+    :return: dict of motif id to rescaled score array
+    """
+    return {motif.id: rescale_scores(best_scores(codes, motif.scan_motif()), motif) for motif in motifs}
@@ -0,0 +1,281 @@
+# ---------------------- run pipeline ----------------------------------------
+# Run the whole intron retention pipeline in one process:
+#   gtf -> filtered gtf -> introns -> intron types -> MSI per sample
+# There is no gtf -> db stage: filtering and intron extraction read the gtf
+# in a single pass, so the gtf_to_db.py step of the pipeline is skipped.
+# The intron table is handed from stage to stage in memory. Every stage is
+# keyed by a hash of its inputs, parameters and code; stages whose key is
+# already in the cache directory are not run again, their outputs are reused.
+# ----------------------------------------------------------------------------
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import filter_gtf
+import get_intron_type
+import get_introns
+import get_msi
+import metrics
+import msi_cache
+from genome_fasta import ensure_fai
+from intron_table import IntronTable, read_genome_sizes
+
+# Bump when the layout of the cached stage outputs changes
+PIPELINE_VERSION = 1
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Modules whose code decides the output of each stage, their content is part of the stage keys
+STAGE_SOURCES = {
+    "filter": ("filter_gtf.py", "gtf_reader.py"),
+    "introns": ("get_introns.py", "gtf_reader.py", "exon_index.py", "intron_table.py"),
+    "types": ("get_intron_type.py", "pwm_scorer.py", "genome_fasta.py", "intron_table.py"),
+    "msi": ("get_msi.py", "msi_engine.py", "intron_table.py"),
+}
+
+
+class StageCache(object):
+    """
+    Directory of finished stage outputs, one sub directory per stage and key
+    """
+
+    def __init__(self, cache_dir, force=False):
+        """
+        :param cache_dir: cache directory, created when missing
+        :param force: run every stage even when its key is cached
+        """
+        self.cache_dir = cache_dir
+        self.force = force
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def checksum(self, path):
+        """ Content checksum of an input file, remembered across runs """
+        return msi_cache.file_checksum(path, self.cache_dir)
+
+    def key(self, stage, params, inputs):
+        """
+        Key of a stage run
+        :param stage: stage name, see STAGE_SOURCES
+        :param params: json serialisable parameters
+        :param inputs: checksums of the input files and keys of the upstream stages
+        """
+        sources = list()
+        for source in STAGE_SOURCES[stage]:
+            with open(os.path.join(SCRIPT_DIR, source), "rb") as in_handle:
+                sources.append(hashlib.blake2b(in_handle.read()).hexdigest())
+        description = {"version": PIPELINE_VERSION, "stage": stage, "params": params, "inputs": list(inputs),
+                       "sources": sources}
+        return hashlib.blake2b(json.dumps(description, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def run(self, stage, key, outputs, build):
+        """
+        Reuse the outputs of a cached stage run or build them
+        :param stage: stage name
+        :param key: stage key
+        :param outputs: names of the output files
+        :param build: function taking a dict of output name to path, writes every output
+        :return: dict of output name to path in the cache
+        """
+        entry = os.path.join(self.cache_dir, stage, key)
+        paths = {name: os.path.join(entry, name) for name in outputs}
+        if os.path.isdir(entry) and not self.force:
+            logging.info("Stage {stage}: cached ({key})".format(stage=stage, key=key))
+            return paths
+
+        logging.info("Stage {stage}: running ({key})".format(stage=stage, key=key))
+        if not os.path.isdir(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry))
+        # Built next to the entry and moved in place, a killed run never leaves a partial entry
+        tmp_entry = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix=".{}.".format(key))
+        try:
+            with metrics.stage(stage):
+                build({name: os.path.join(tmp_entry, name) for name in outputs})
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.replace(tmp_entry, entry)
+        finally:
+            if os.path.isdir(tmp_entry):
+                shutil.rmtree(tmp_entry)
+        return paths
+
+
+def publish(path, out):
+    """
+    Copy a cached output to its place in the output directory. A copy rather than a link, so editing the
+    output never changes the cache entry. An earlier output is removed first, it may still be a link.
+    """
+    if os.path.lexists(out):
+        os.remove(out)
+    shutil.copyfile(path, out)
+
+
+def run_filter(cache, gtf, gtf_key, transtypes):
+    """
+    Drop the genes/transcripts of the given transcript types from the gtf
+    :return: stage key and dict of output name to path
+    """
+    key = cache.key("filter", {"transtypes": sorted(transtypes)}, [gtf_key])
+
+    def build(paths):
+        filtered_ids = filter_gtf.get_filtered_ids_gtf(gtf, transtypes)
+        logging.info("Filtering {} genes/transcripts".format(len(filtered_ids)))
+        metrics.count("filtered_ids", len(filtered_ids))
+        filter_gtf.write_filtered_ids(filtered_ids, paths["filtered_ids.txt"])
+        filter_gtf.write_filtered_gtf(gtf, paths["filtered.gtf.gz"], filtered_ids)
+
+    return key, cache.run("filter", key, ["filtered_ids.txt", "filtered.gtf.gz"], build)
+
+
+def run_introns(cache, gtf, gtf_key, window):
+    """
+    Clean introns of the gtf, with the direct engine of get_introns.py
+    :return: stage key, dict of output name to path and the IntronTable
+    """
+    key = cache.key("introns", {"window": window}, [gtf_key])
+    built = dict()
+
+    def build(paths):
+        final_introns = get_introns.get_final_introns_direct(gtf, window)
+        get_introns.write_final_introns(final_introns, paths["introns.bed"])
+        # Same rows, in the same order, as the bed just written
+        built["table"] = IntronTable.from_records((chrom, start - 1, end, strand)
+                                                  for chrom, start, end, strand in sorted(final_introns))
+
+    paths = cache.run("introns", key, ["introns.bed"], build)
+    table = built.get("table") or IntronTable.from_bed(paths["introns.bed"])
+    metrics.count("introns", len(table))
+    return key, paths, table
+
+
+def run_types(cache, table, introns_key, genomefa, donorpwm, branchpwm, scorer, threads):
+    """
+    U2/U12 type of every intron, with get_intron_type.py
+    :param scorer: numpy/gimmemotifs
+    :return: dict of output name to path
+    """
+    key = cache.key("types", {"scorer": scorer},
+                    [introns_key, cache.checksum(genomefa), cache.checksum(donorpwm), cache.checksum(branchpwm)])
+
+    def build(paths):
+        if scorer == "numpy":
+            ensure_fai(genomefa)
+        scores = {column: np.full(len(table), np.nan) for column in get_intron_type.MOTIF_COLUMNS}
+        types = tuple(np.empty(len(table), dtype=object) for _ in range(3))
+        get_intron_type.type_introns(np.arange(len(table)), (table, genomefa, donorpwm, branchpwm, scorer),
+                                     threads, scores, types)
+        get_intron_type.write_types(table, scores, paths["intronType.xls"], types)
+
+    return cache.run("types", key, ["intronType.xls"], build)
+
+
+def run_msi(cache, table, introns_key, name, bam, gsizes, threads):
+    """
+    MSI of one sample, with the sweep engine of get_msi.py
+    :param table: IntronTable sorted like the genome sizes
+    :return: dict of output name to path
+    """
+    key = cache.key("msi", {"engine": "sweep"}, [introns_key, cache.checksum(bam), cache.checksum(gsizes)])
+
+    def build(paths):
+        logging.info("Scoring sample {name}: {bam}".format(name=name, bam=bam))
+        get_msi.score_bam("sweep", table, None, bam, gsizes, {"threads": threads}, paths["msi.xls"])
+
+    return cache.run("msi", key, ["msi.xls"], build)
+
+
+def main(args):
+    logging.info("Received the following args: \n {}".format(args))
+
+    cache = StageCache(args.cache_dir or os.path.join(args.outdir, ".pipeline_cache"), force=args.force)
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    gtf, gtf_key = args.gtf, cache.checksum(args.gtf)
+    if args.transtypes:
+        gtf_key, paths = run_filter(cache, args.gtf, gtf_key, args.transtypes)
+        gtf = paths["filtered.gtf.gz"]
+        publish(paths["filtered_ids.txt"], os.path.join(args.outdir, "filtered_ids.txt"))
+
+    introns_key, paths, table = run_introns(cache, gtf, gtf_key, args.window)
+    publish(paths["introns.bed"], os.path.join(args.outdir, "introns.bed"))
+
+    if args.genomefa:
+        paths = run_types(cache, table, introns_key, args.genomefa, args.donorpwm, args.branchpwm, args.scorer,
+                          args.threads)
+        publish(paths["intronType.xls"], os.path.join(args.outdir, "intronType.xls"))
+
+    samples = get_msi.read_samplesheet(args.samplesheet) if args.samplesheet else \
+        [(os.path.basename(bam).rsplit(".bam", 1)[0], bam) for bam in args.bam or []]
+    if len(set(name for name, _ in samples)) != len(samples):
+        raise ValueError("Sample names have to be unique")
+    if samples:
+        sorted_table = table.sort(read_genome_sizes(args.gsizes))
+        for name, bam in samples:
+            paths = run_msi(cache, sorted_table, introns_key, name, bam, args.gsizes, args.threads)
+            publish(paths["msi.xls"], os.path.join(args.outdir, "{}_msi.xls".format(name)))
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s : %(message)s', level=logging.INFO)
+
+
+    def is_valid_file(parser, arg):
+        """ Check if file exists """
+        if not os.path.isfile(arg):
+            parser.error('The file at %s does not exist' % arg)
+        else:
+            return arg
+
+
+    epilog = "EXAMPLE: python " + os.path.basename(__file__) + \
+             " --gtf /path/to/genes.gtf.gz --transtypes retained_intron --genome /path/to/genome.fa" \
+             " --branch /path/to/branch.pwm --don /path/to/don.pwm --genomesizes /path/to/genome.sizes" \
+             " --samplesheet /path/to/samples.tsv --outdir /path/to/results"
+
+    parser = argparse.ArgumentParser(description="Run gtf filtering, intron extraction, intron typing and MSI in "
+                                                 "one process, reusing cached stage results", epilog=epilog)
+
+    required_args_group = parser.add_argument_group('required arguments')
+    required_args_group.add_argument('-a', '--gtf', dest='gtf', required=True, help="gtf, may be gzipped",
+                                     type=lambda x: is_valid_file(parser, x))
+    required_args_group.add_argument('-o', '--outdir', dest='outdir', required=True)
+
+    parser.add_argument('-t', '--transtypes', dest='transtypes', action="append",
+                        help="Drop genes/transcripts of this transcript type first, may be repeated")
+    parser.add_argument('-w', '--window', dest='window', default=3, type=int, help="DEFAULT: 3")
+    parser.add_argument('-g', '--genomefa', dest='genomefa', type=lambda x: is_valid_file(parser, x),
+                        help="Genome fasta, types the introns together with --branchpwm and --donorpwm")
+    parser.add_argument('-b', '--branchpwm', dest='branchpwm', type=lambda x: is_valid_file(parser, x))
+    parser.add_argument('-d', '--donorpwm', dest='donorpwm', type=lambda x: is_valid_file(parser, x))
+    parser.add_argument('-s', '--scorer', dest='scorer', choices=["numpy", "gimmemotifs"], default="gimmemotifs",
+                        help="pwm scorer of the typing stage, see get_intron_type.py --scorer. DEFAULT: gimmemotifs")
+    bam_args_group = parser.add_mutually_exclusive_group()
+    bam_args_group.add_argument('--bam', dest='bam', action="append", type=lambda x: is_valid_file(parser, x),
+                                help="Sorted bam to calculate MSI for, may be repeated")
+    bam_args_group.add_argument('--samplesheet', dest='samplesheet', type=lambda x: is_valid_file(parser, x),
+                                help="Tab separated sample name and bam path per line")
+    parser.add_argument('--genomesizes', dest='gsizes', type=lambda x: is_valid_file(parser, x),
+                        help="Genome sizes, needed for MSI")
+    parser.add_argument('--threads', dest='threads', type=int, default=1,
+                        help="Processes for intron typing and MSI counting. DEFAULT: 1")
+    parser.add_argument('--cache-dir', dest='cache_dir', help="DEFAULT: {OUTDIR}/.pipeline_cache")
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help="Run every stage even when a cached result exists")
+
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    if args.genomefa and not (args.branchpwm and args.donorpwm):
+        parser.error("--genomefa needs --branchpwm and --donorpwm")
+    if (args.bam or args.samplesheet) and not args.gsizes:
+        parser.error("MSI needs --genomesizes")
+
+    with metrics.collect(args.metrics_json, args.profile):
+        main(args)
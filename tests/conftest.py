@@ -0,0 +1,27 @@
+import os
+import sys
+
+# The scripts are flat modules at the top of the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import checkpoint
+
+
+@pytest.fixture
+def interrupt_checkpoint(monkeypatch):
+    """
+    Call with n to stop checkpointed runs once their checkpoint holds n shards, like a run killed part way.
+    They raise RuntimeError("interrupted ..."), monkeypatch.undo() lets them run through again
+    """
+    save = checkpoint.Checkpoint.save
+
+    def interrupt(shards):
+        def interrupted_save(self, shard, arrays):
+            if len(self.finished) >= shards:
+                raise RuntimeError("interrupted before shard {}".format(shard))
+            save(self, shard, arrays)
+
+        monkeypatch.setattr(checkpoint.Checkpoint, "save", interrupted_save)
+    return interrupt
@@ -0,0 +1,89 @@
+import argparse
+
+import numpy as np
+import pytest
+
+import columnar
+import delta_msi
+import get_intron_type
+import get_msi
+from intron_table import IntronTable
+
+RECORDS = [("chr1", 100, 200, "+"), ("chr1", 300, 400, "-"), ("chr1", 600, 700, "+"), ("chr2", 50, 90, "."),
+           ("chr10", 5, 25, "-")]
+
+# a1, a2, exon and covfrac per intron, the fourth one without reads
+COUNTS = {"a1": np.array([4, 2, 1, 0, 7]), "a2": np.array([3, 1, 1, 0, 0]), "exon": np.array([1, 1, 2, 0, 3]),
+          "covfrac": np.array([0.21, 0.09, 1.0, 0.0, 1 / 3])}
+
+
+@pytest.fixture
+def table():
+    return IntronTable.from_records(RECORDS)
+
+
+def write_both(write, tmp_path, name):
+    """ Write a table as text and columnar, return both paths """
+    paths = [str(tmp_path / "{}.xls".format(name)), str(tmp_path / "{}{}".format(name, columnar.SUFFIX))]
+    for path, out_format in zip(paths, ("text", "columnar")):
+        write(path, out_format)
+    return paths
+
+
+def read_text(path):
+    with open(path) as in_handle:
+        return in_handle.read()
+
+
+@pytest.mark.parametrize("sampled", [False, True])
+def test_msi_round_trip(table, tmp_path, sampled):
+    counts = get_msi.subsample_counts(COUNTS, 0.3, 0.95) if sampled else COUNTS
+    text, columns = write_both(lambda path, out_format: get_msi.write_msi(table, counts, path, out_format),
+                               tmp_path, "sample_msi")
+    assert columnar.is_columnar(columns) and not columnar.is_columnar(text)
+
+    with columnar.ColumnTable(columns) as column_table:
+        assert column_table.kind == "msi"
+        assert column_table.types["A1"] == "int" and column_table.types["MSI"] == "float"
+        assert column_table.columns == ["A1", "A2", "Exon", "CovFrac", "MSI"] + (["MSILow", "MSIHigh"] if sampled
+                                                                                else [])
+        assert column_table.table.ids() == table.ids()
+    # columnar.py gives back the text table
+    out = str(tmp_path / "converted.xls")
+    columnar.main(argparse.Namespace(path=columns, out=out))
+    assert read_text(out) == read_text(text)
+
+    # delta_msi reads both the same
+    text_ids, text_columns = delta_msi.read_msi(text)
+    column_ids, column_columns = delta_msi.read_msi(columns)
+    assert column_ids == text_ids
+    assert list(column_columns) == list(text_columns)
+    for column in text_columns:
+        np.testing.assert_array_equal(column_columns[column], text_columns[column], err_msg=column)
+
+
+def test_msi_matrix_of_mixed_tables(table, tmp_path):
+    text, columns = write_both(lambda path, out_format: get_msi.write_msi(table, COUNTS, path, out_format),
+                               tmp_path, "sample_msi")
+    matrices = list()
+    for name, paths in (("text", [text, text]), ("mixed", [text, columns])):
+        matrices.append(str(tmp_path / "{}.matrix".format(name)))
+        get_msi.write_msi_matrix([("a", None, paths[0]), ("b", None, paths[1])], matrices[-1])
+    assert read_text(matrices[1]) == read_text(matrices[0])
+
+
+def test_types_round_trip(table, tmp_path):
+    rng = np.random.default_rng(3)
+    scores = {column: rng.uniform(0, 100, len(table)) for column in get_intron_type.MOTIF_COLUMNS}
+    # An intron without a branch window
+    scores["GT_AG_U12_b"][3] = np.nan
+    text, columns = write_both(lambda path, out_format: get_intron_type.write_types(table, scores, path,
+                                                                                    out_format=out_format),
+                               tmp_path, "types")
+    with columnar.ColumnTable(columns) as column_table:
+        assert column_table.kind == "types"
+        assert column_table.types["Type"] == "category"
+        assert column_table["Type"].tolist() == get_intron_type.get_type(scores)[0].tolist()
+        out = str(tmp_path / "converted.xls")
+        column_table.write_text(out)
+    assert read_text(out) == read_text(text)
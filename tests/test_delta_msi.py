@@ -0,0 +1,107 @@
+from fractions import Fraction
+from math import comb
+
+import numpy as np
+import pytest
+
+import delta_msi
+
+# matrix(c(x11, x21, x12, x22), nrow = 2), the first two are the fisher.test examples of the R documentation
+# (TeaTasting, p-value = 0.4857, and Convictions, p-value = 0.0005367)
+FISHER_TABLES = [(3, 1, 1, 3), (2, 10, 15, 3), (0, 5, 0, 7), (2, 2, 2, 2), (1, 2, 3, 4), (120, 80, 30, 95),
+                 (7, 0, 0, 9), (40, 3, 37, 6), (5, 5, 10, 10), (1, 12, 9, 3)]
+
+
+def exact_fisher(x11, x21, x12, x22):
+    """ Two sided p-value of fisher.test in exact arithmetic, with the same 1 + 1e-7 tolerance on the densities """
+    m, n, k = x11 + x21, x12 + x22, x11 + x12
+    density = {x: Fraction(comb(m, x) * comb(n, k - x), comb(m + n, k))
+               for x in range(max(0, k - n), min(k, m) + 1)}
+    return float(sum(d for d in density.values() if d <= density[x11] * Fraction(1 + 1e-7)))
+
+
+def test_fisher_exact():
+    expected = [exact_fisher(*table) for table in FISHER_TABLES]
+    assert expected[0] == pytest.approx(0.4857, abs=5e-5)
+    assert expected[1] == pytest.approx(0.0005367, abs=5e-8)
+    # Repeated tables are tested once and mapped back
+    tables = FISHER_TABLES + FISHER_TABLES[::-1]
+    np.testing.assert_allclose(delta_msi.fisher_exact(tables), expected + expected[::-1], rtol=1e-12)
+
+
+def test_holm():
+    # p.adjust(c(0.01, 0.04, 0.03, 0.005, 0.04), method = "holm")
+    pvalues = np.array([0.01, 0.04, 0.03, 0.005, 0.04])
+    np.testing.assert_allclose(delta_msi.holm(pvalues), [0.04, 0.09, 0.09, 0.025, 0.09], rtol=1e-15)
+    np.testing.assert_allclose(delta_msi.holm(np.array([0.5, 0.4])), [0.8, 0.8], rtol=1e-15)
+    assert delta_msi.holm(np.array([])).tolist() == []
+
+
+@pytest.mark.parametrize("value, text", [
+    (1 / 3, "0.333333333333333"), (2 / 3, "0.666666666666667"), (0.1 + 0.2, "0.3"), (0.3 - 0.1, "0.2"),
+    (1e-5, "1e-05"), (1e-4, "1e-04"), (0.0001234, "0.0001234"), (1e5, "1e+05"), (123456.0, "123456"),
+    (123456789012.0, "123456789012"), (1e15, "1e+15"), (1234567.1, "1234567.1"), (100.0, "100"), (0.0, "0"),
+    (-0.5, "-0.5"), (1e-20, "1e-20"), (float("nan"), "NA"), (float("inf"), "Inf"), (float("-inf"), "-Inf"),
+])
+def test_format_number(value, text):
+    # What write.table prints for the value, 15 significant digits and the shorter of fixed and scientific
+    assert delta_msi.format_number(value) == text
+
+
+TRT = """ID\tA1\tA2\tExon\tCovFrac\tMSI
+chr1|100|200|+\t8\t7\t2\t0.97\t78.95
+chr1|300|400|-\t0\t0\t7\t0.99\t0.3
+chr1|500|600|+\t6\t6\t1\t0.5\t85.7
+chr2|100|200|+\t1\t1\t0\t1\t100
+chr2|300|400|+\t5\t5\t5\t0.96\t50
+chr2|500|600|-\t20\t17\t40\t0.98\t31.6
+chr3|10|20|+\t9\t9\t9\t1\t50
+"""
+
+CTRL = """ID\tA1\tA2\tExon\tCovFrac\tMSI
+chr3|50|60|+\t9\t9\t9\t1\t50
+chr1|100|200|+\t2\t1\t10\t0.6\t13.04
+chr1|300|400|-\t5\t4\t0\t0.2\t0.1
+chr1|500|600|+\t6\t6\t1\t0.9\t85.7
+chr2|100|200|+\t1\t6\t0\t0.99\t100
+chr2|300|400|+\t5\t5\t5\t0.5\t50
+chr2|500|600|-\t3\t3\t3\t0.92\t50
+"""
+
+# deltaMSI.R output: chr1|500|600 fails the CovFrac filter, chr2|100|200 the A1 filter, chr3 introns are in one
+# table only. Rows are sorted by padj, pval and padj are checked against PVALUES separately.
+EXPECTED = [
+    "Chrom\tStart\tEnd\tStrand\tDeltaMSI\tpval\tpadj\tMSI_trt\tMSI_ctrl\tA1_trt\tA1_ctrl\tA2_trt\tA2_ctrl\t"
+    "Exon_trt\tExon_ctrl\tCovFrac_trt\tCovFrac_ctrl",
+    "chr1\t300\t400\t-\t0.2\t{}\t{}\t0.3\t0.1\t0\t5\t0\t4\t7\t0\t0.99\t0.2",
+    "chr1\t100\t200\t+\t65.91\t{}\t{}\t78.95\t13.04\t8\t2\t7\t1\t2\t10\t0.97\t0.6",
+    "chr2\t500\t600\t-\t-18.4\t{}\t{}\t31.6\t50\t20\t3\t17\t3\t40\t3\t0.98\t0.92",
+    "chr2\t300\t400\t+\t0\t{}\t{}\t50\t50\t5\t5\t5\t5\t5\t5\t0.96\t0.5",
+]
+# (Exon_trt, Exon_ctrl, Intron_trt, Intron_ctrl) of the rows above
+FISHER_ROWS = [(7, 0, 0, 9), (2, 10, 15, 3), (40, 3, 37, 6), (5, 5, 10, 10)]
+
+
+def test_delta_msi_pair(tmp_path):
+    tables = dict()
+    for name, text in (("trt", TRT), ("ctrl", CTRL)):
+        path = tmp_path / "{}_msi.xls".format(name)
+        path.write_text(text)
+        tables[name] = delta_msi.read_msi(str(path))
+    tables = delta_msi.MSITables(tables)
+    result = delta_msi.delta_msi(tables, [("trt", "ctrl")])[0]
+    out = str(tmp_path / "deltaMSI.xls")
+    delta_msi.write_delta_msi(tables, ("trt", "ctrl"), result, out)
+
+    pvalues = np.array([exact_fisher(*row) for row in FISHER_ROWS])
+    # Holm over the four tested introns
+    padj = np.maximum.accumulate(np.minimum(1, (4 - np.arange(4)) * pvalues))
+    with open(out) as in_handle:
+        lines = in_handle.read().splitlines()
+    assert lines[0] == EXPECTED[0]
+    assert len(lines) == len(EXPECTED)
+    for line, expected, pval, adjusted in zip(lines[1:], EXPECTED[1:], pvalues, padj):
+        fields = line.split("\t")
+        assert float(fields[5]) == pytest.approx(pval, rel=1e-12)
+        assert float(fields[6]) == pytest.approx(adjusted, rel=1e-12)
+        assert "\t".join(fields[:5] + ["{}", "{}"] + fields[7:]) == expected
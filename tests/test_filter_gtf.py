@@ -0,0 +1,101 @@
+import argparse
+import gzip
+
+import pytest
+
+import filter_gtf
+import gtf_to_db
+from annotation_snapshot import AnnotationSnapshot
+
+TRANSTYPES = ["retained_intron", "nonsense_mediated_decay"]
+
+
+def gtf_line(feature, start, end, attributes):
+    return "chr1\ttest\t{}\t{}\t{}\t.\t+\t.\t{}\n".format(feature, start, end, attributes)
+
+
+def gene(gene_id):
+    return gtf_line("gene", 1, 1000, 'gene_id "{}";'.format(gene_id))
+
+
+def transcript(gene_id, transcript_id, *transcript_types):
+    attributes = 'gene_id "{}"; transcript_id "{}";'.format(gene_id, transcript_id)
+    types = "".join(' transcript_type "{}";'.format(transcript_type) for transcript_type in transcript_types)
+    return [gtf_line("transcript", 1, 1000, attributes + types),
+            gtf_line("exon", 1, 100, attributes + ' exon_number "1";'),
+            gtf_line("exon", 500, 1000, attributes + ' exon_number "2";')]
+
+
+GTF_LINES = ["#!genome-build test\n",
+             # Single matching transcript, the gene goes
+             gene("g1")] + transcript("g1", "t1", "retained_intron") + [
+             # One of two transcripts matches, only that transcript goes
+             gene("g10")] + transcript("g10", "t10a", "protein_coding") + \
+            transcript("g10", "t10b", "nonsense_mediated_decay") + [
+             # Both transcripts match
+             gene("g2")] + transcript("g2", "t2a", "retained_intron") + transcript("g2", "t2b", "retained_intron") + [
+             # A repeated tag, any of its values matches
+             gene("g3")] + transcript("g3", "t3a", "protein_coding", "retained_intron") + \
+            transcript("g3", "t3b", "protein_coding") + [
+             # Nothing matches
+             gene("g4")] + transcript("g4", "t4", "protein_coding") + \
+            transcript("g5", "t5", "retained_intron") + [   # no gene line, not walked
+             # Exons without a transcript line are not counted as a transcript of the gene
+             gene("g6")] + transcript("g6", "t6a", "retained_intron") + transcript("g6", "t6b")[1:]
+
+EXPECTED_IDS = {"g1", "t10b", "t2a", "t2b", "t3a", "g6"}
+
+
+@pytest.fixture(params=["gffutils", "bulk"])
+def annotation(tmp_path, request):
+    gtf = str(tmp_path / "genes.gtf")
+    with open(gtf, "w") as out_handle:
+        out_handle.writelines(GTF_LINES)
+    db = str(tmp_path / "genes.db")
+    if request.param == "gffutils":
+        gtf_to_db.gffutils_create_db(gtf, db)
+    else:
+        gtf_to_db.bulk_create_db(gtf, db)
+    return gtf, db
+
+
+def test_engines_match_gffutils(annotation):
+    gtf, db = annotation
+    expected = filter_gtf.get_filtered_ids_gffutils(db, TRANSTYPES)
+    assert expected == EXPECTED_IDS
+    assert filter_gtf.get_filtered_ids_sql(db, TRANSTYPES) == expected
+    assert filter_gtf.get_filtered_ids_gtf(gtf, TRANSTYPES) == expected
+    for snapshot in (AnnotationSnapshot.from_gtf(gtf), AnnotationSnapshot.from_db(db)):
+        assert filter_gtf.get_filtered_ids_snapshot(snapshot, TRANSTYPES) == expected
+    # A single type, and one no transcript has
+    for transtypes in (["retained_intron"], ["processed_pseudogene"]):
+        expected = filter_gtf.get_filtered_ids_gffutils(db, transtypes)
+        assert filter_gtf.get_filtered_ids_sql(db, transtypes) == expected
+        assert filter_gtf.get_filtered_ids_gtf(gtf, transtypes) == expected
+        assert filter_gtf.get_filtered_ids_snapshot(AnnotationSnapshot.from_gtf(gtf), transtypes) == expected
+
+
+def read_lines(path):
+    with (gzip.open(path, "rt") if path.endswith(".gz") else open(path)) as in_handle:
+        return in_handle.readlines()
+
+
+@pytest.mark.parametrize("source", ["gffutils", "sql", "gtf", "snapshot"])
+@pytest.mark.parametrize("filtered_gtf", ["filtered.gtf", "filtered.gtf.gz"])
+def test_filtered_gtf(annotation, tmp_path, source, filtered_gtf):
+    gtf, db = annotation
+    snapshot = str(tmp_path / "genes.snapshot")
+    AnnotationSnapshot.from_gtf(gtf).save(snapshot)
+    args = argparse.Namespace(gtf_db=db if source in ("gffutils", "sql") else None,
+                              snapshot=snapshot if source == "snapshot" else None, base_gtf=gtf,
+                              engine="sql" if source == "sql" else "gffutils", transtypes=TRANSTYPES,
+                              out=str(tmp_path / "filt.txt"), filtered_gtf=str(tmp_path / filtered_gtf))
+    filter_gtf.main(args)
+    assert read_lines(args.out) == ["{}\n".format(filt_id) for filt_id in sorted(EXPECTED_IDS)]
+
+    # Exact id matches, g10 is not dropped with g1
+    expected = [line for line in GTF_LINES
+                if not any('gene_id "{0}";'.format(filt_id) in line or 'transcript_id "{0}";'.format(filt_id) in line
+                           for filt_id in EXPECTED_IDS)]
+    assert read_lines(args.filtered_gtf) == expected
+    assert any('gene_id "g10";' in line for line in expected)
@@ -0,0 +1,119 @@
+import os
+import shutil
+
+import numpy as np
+import pysam
+import pytest
+
+import get_intron_type
+import pwm_scorer
+from genome_fasta import GenomeFasta, build_fai, ensure_fai
+from intron_table import IntronTable
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# chrom to (sequence, bases per line, line end)
+CHROMS = {"chr1": ("ACGTTGCAAC" * 13, 60, "\n"),
+          "chr2": ("ggcATNNcaT" * 2 + "ACGTA", 7, "\r\n"),   # soft masked, N, windows ending lines
+          "chr3": ("TTAGC" * 8, 40, "\n")}                   # one full line
+
+
+@pytest.fixture
+def genome(tmp_path):
+    fasta = str(tmp_path / "genome.fa")
+    with open(fasta, "w", newline="") as out_handle:
+        for chrom, (sequence, line_bases, line_end) in CHROMS.items():
+            out_handle.write(">{} description\n".format(chrom))
+            out_handle.writelines(sequence[k:k + line_bases] + line_end for k in range(0, len(sequence), line_bases))
+    return fasta
+
+
+def test_fai_matches_samtools(genome, tmp_path):
+    fai = str(tmp_path / "ours.fai")
+    build_fai(genome, fai)
+    pysam.faidx(genome)
+    with open(fai) as ours, open(genome + ".fai") as samtools:
+        assert ours.read() == samtools.read()
+
+
+def test_ensure_fai_rebuilds_stale_index(genome):
+    fai = ensure_fai(genome)
+    with open(fai, "w") as out_handle:
+        out_handle.write("stale\t1\t1\t1\t1\n")
+    os.utime(fai, (0, 0))
+    assert ensure_fai(genome) == fai
+    with open(fai) as in_handle:
+        assert in_handle.readline().split("\t")[0] == "chr1"
+
+
+def expected_window(chrom, start, end):
+    """ What bedtools getfasta gives: the + strand sequence, nothing for intervals off the chromosome """
+    sequence = CHROMS[chrom][0] if chrom in CHROMS else ""
+    if chrom not in CHROMS or start < 0 or end > len(sequence) or end <= start:
+        return None
+    return sequence[start:end]
+
+
+WINDOWS = [("chr1", 0, 13), ("chr1", 55, 68), ("chr1", 50, 120), ("chr1", 117, 130), ("chr1", 0, 130),
+           # Clipped at the chromosome ends
+           ("chr1", -3, 10), ("chr1", 120, 131), ("chr1", 125, 160),
+           ("chr2", 0, 7), ("chr2", 5, 16), ("chr2", 20, 25), ("chr2", 13, 14), ("chr2", 22, 26), ("chr2", -1, 2),
+           ("chr3", 30, 40), ("chr3", 0, 40), ("chr3", 38, 41),
+           # Empty, and on an unknown chromosome
+           ("chr3", 10, 10), ("chrUn", 0, 5)]
+
+
+def test_fetch_windows(genome):
+    chroms, starts, ends = zip(*WINDOWS)
+    with GenomeFasta(genome) as fasta:
+        windows, lengths = fasta.fetch_windows(chroms, starts, ends)
+        for row, (chrom, start, end) in enumerate(WINDOWS):
+            expected = expected_window(chrom, start, end)
+            assert fasta.fetch(chrom, start, end) == expected
+            if expected is None:
+                assert lengths[row] == -1
+                assert not windows[row].any()
+            else:
+                assert lengths[row] == len(expected)
+                assert windows[row, :lengths[row]].tobytes().decode() == expected
+                # Zero padded past the window
+                assert not windows[row, lengths[row]:].any()
+        # No windows at all
+        windows, lengths = fasta.fetch_windows([], [], [])
+        assert windows.shape == (0, 0) and len(lengths) == 0
+
+
+def test_clipped_windows_are_not_scored(genome):
+    # Donor windows reach 3 bases before a + intron and 3 bases after a - intron, branch windows 38 bases into it
+    table = IntronTable.from_records([("chr1", 2, 60, "+"), ("chr1", 20, 128, "-"), ("chr1", 5, 40, "-"),
+                                      ("chr1", 30, 100, "+"), ("chr2", 1, 20, "+"), ("chr3", 10, 20, ".")])
+    motifs = pwm_scorer.read_pwms(os.path.join(DATA, "don.pwm"))
+    with GenomeFasta(genome) as fasta:
+        scores = get_intron_type.get_motif_scores_indexed(table, fasta, motifs, "donor")
+    start, end = get_intron_type.window_bounds(table, "donor")
+    for row, record in enumerate(table.records()):
+        sequence = expected_window(record[0], int(start[row]), int(end[row])) if record[3] != "." else None
+        for motif in motifs:
+            if sequence is None:
+                assert np.isnan(scores[motif.id][row]), (record, motif.id)
+            else:
+                expected = pwm_scorer.score_codes(pwm_scorer.encode([sequence]), [motif])[motif.id][0]
+                assert scores[motif.id][row] == expected, (record, motif.id)
+    assert [np.isnan(scores[motifs[0].id][row]) for row in range(len(table))] == \
+        [True, True, False, False, True, True]
+
+
+@pytest.mark.skipif(shutil.which("bedtools") is None, reason="needs bedtools")
+def test_windows_match_bedtools(genome):
+    table = IntronTable.from_records([("chr1", 2, 60, "+"), ("chr1", 20, 128, "-"), ("chr1", 5, 90, "-"),
+                                      ("chr1", 30, 100, "+"), ("chr2", 1, 20, "+"), ("chr2", 3, 22, "-")])
+    for type in ("donor", "branch"):
+        fa = get_intron_type.get_fa(table, genome, type)
+        with open(fa.seqfn) as in_handle:
+            lines = in_handle.read().split()
+        bedtools_windows = {int(name[1:].split("::")[0]): sequence for name, sequence in zip(lines[::2], lines[1::2])}
+        start, end = get_intron_type.window_bounds(table, type)
+        with GenomeFasta(genome) as fasta:
+            windows = {row: fasta.fetch(chrom, int(start[row]), int(end[row]))
+                       for row, chrom in enumerate(table.chrom_names().tolist())}
+        assert {row: sequence for row, sequence in windows.items() if sequence is not None} == bedtools_windows
@@ -0,0 +1,153 @@
+import argparse
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import checkpoint
+import get_intron_type
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+CHROM_SIZES = {"chr1": 600, "chr2": 400}
+
+# (chrom, start, end, strand)
+# The first one holds the GT_AG_U12 donor and branch consensus of tests/test_pwm_scorer.py, the others random windows
+INTRONS = [("chr1", 50, 150, "+"), ("chr1", 120, 300, "-"), ("chr1", 200, 260, "+"), ("chr1", 400, 560, "-"),
+           ("chr1", 420, 500, "+"), ("chr2", 60, 200, "+"), ("chr2", 100, 340, "-"), ("chr2", 250, 350, "+")]
+
+
+U12_DONOR = (47, "ACACTTTGGGACC")
+U12_BRANCH = (112, "TCTAACACTTTGGGACTCCGCCCCCTTATA")
+
+
+@pytest.fixture
+def type_files(tmp_path):
+    rng = np.random.default_rng(7)
+    genome = tmp_path / "genome.fa"
+    with open(genome, "w") as out_handle:
+        for chrom, size in CHROM_SIZES.items():
+            sequence = "".join(rng.choice(list("ACGT"), size))
+            if chrom == "chr1":
+                for start, window in (U12_DONOR, U12_BRANCH):
+                    sequence = sequence[:start] + window + sequence[start + len(window):]
+            out_handle.write(">{}\n{}\n".format(chrom, "\n".join(sequence[k:k + 60] for k in range(0, size, 60))))
+    bed = tmp_path / "introns.bed"
+    bed.write_text("".join("{}\t{}\t{}\tintron{}\t0\t{}\n".format(chrom, start, end, k, strand)
+                           for k, (chrom, start, end, strand) in enumerate(INTRONS)))
+    return str(bed), str(genome)
+
+
+def type_args(bed, genome, out, **options):
+    args = {"intbed": bed, "genomefa": genome, "donorpwm": os.path.join(DATA, "don.pwm"),
+            "branchpwm": os.path.join(DATA, "branch.pwm"), "out": out, "out_format": "text", "scorer": "numpy",
+            "threads": 1, "cache": None, "cache_max_mb": None, "checkpoint": None,
+            "checkpoint_size": get_intron_type.CHECKPOINT_SIZE}
+    args.update(options)
+    return argparse.Namespace(**args)
+
+
+def read_text(path):
+    with open(path) as in_handle:
+        return in_handle.read()
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+@pytest.mark.parametrize("finished", [0, 2, 4])
+def test_checkpoint_resume(type_files, tmp_path, monkeypatch, interrupt_checkpoint, threads, finished):
+    bed, genome = type_files
+    full = str(tmp_path / "full.xls")
+    get_intron_type.main(type_args(bed, genome, full))
+    assert [line.split("\t")[4:7] for line in read_text(full).splitlines()[1:3]] == \
+        [["U12", "GT_AG_U12", "High"], ["U2", "GT_AG_U2", "Low"]]
+
+    out = str(tmp_path / "resumed.xls")
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    args = type_args(bed, genome, out, threads=threads, checkpoint=checkpoint_dir, checkpoint_size=2)
+    # chr1 in three chunks, chr2 in two
+    interrupt_checkpoint(finished)
+    with pytest.raises(RuntimeError, match="interrupted"):
+        get_intron_type.main(args)
+    monkeypatch.undo()
+    assert len(checkpoint.read_manifest(checkpoint_dir)["shards"]) == finished
+    assert not os.path.exists(out)
+
+    get_intron_type.main(args)
+    assert read_text(out) == read_text(full)
+    # Removed once the output is written
+    assert not os.path.exists(checkpoint_dir)
+
+
+def test_checkpoint_of_other_inputs(type_files, tmp_path, monkeypatch, interrupt_checkpoint):
+    bed, genome = type_files
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    args = type_args(bed, genome, str(tmp_path / "types.xls"), checkpoint=checkpoint_dir, checkpoint_size=2)
+    interrupt_checkpoint(2)
+    with pytest.raises(RuntimeError, match="interrupted"):
+        get_intron_type.main(args)
+    monkeypatch.undo()
+    manifest = checkpoint.read_manifest(checkpoint_dir)
+
+    # A changed pwm, other introns or another chunk size never reuse its chunks
+    donorpwm = str(tmp_path / "don.pwm")
+    shutil.copy(args.donorpwm, donorpwm)
+    with open(donorpwm, "a") as out_handle:
+        out_handle.write("0.25\t0.25\t0.25\t0.25\n")
+    other_bed = str(tmp_path / "other.bed")
+    with open(bed) as in_handle, open(other_bed, "w") as out_handle:
+        out_handle.writelines(in_handle.readlines()[1:])
+    for options in ({"donorpwm": donorpwm}, {"intbed": other_bed}, {"checkpoint_size": 3}):
+        with pytest.raises(ValueError, match="another run"):
+            get_intron_type.main(argparse.Namespace(**dict(vars(args), **options)))
+    assert checkpoint.read_manifest(checkpoint_dir) == manifest
+
+    # A directory holding other files is not taken over
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    (other_dir / "notes.txt").write_text("keep\n")
+    with pytest.raises(ValueError, match="holds no checkpoint"):
+        get_intron_type.main(argparse.Namespace(**dict(vars(args), checkpoint=str(other_dir))))
+    assert os.listdir(str(other_dir)) == ["notes.txt"]
+
+
+def test_type_cache(type_files, tmp_path, monkeypatch):
+    bed, genome = type_files
+    cache = str(tmp_path / "types.sqlite")
+    typed = list()
+    type_introns = get_intron_type.type_introns
+
+    def spy(rows, *args, **kwargs):
+        typed.append(len(rows))
+        return type_introns(rows, *args, **kwargs)
+
+    monkeypatch.setattr(get_intron_type, "type_introns", spy)
+
+    def run(name, **options):
+        out = str(tmp_path / "{}.xls".format(name))
+        get_intron_type.main(type_args(bed, genome, out, **options))
+        return read_text(out)
+
+    full = run("full")
+    # Miss, then hit with the same output
+    assert run("miss", cache=cache) == full
+    assert run("hit", cache=cache) == full
+    # The uncached run and the miss type every intron, the hit none
+    assert typed == [len(INTRONS), len(INTRONS)]
+
+    # A changed pwm invalidates every call
+    donorpwm = str(tmp_path / "don.pwm")
+    with open(os.path.join(DATA, "don.pwm")) as in_handle, open(donorpwm, "w") as out_handle:
+        for line in in_handle:
+            out_handle.write("\t".join(field if line.startswith(("#", ">")) else str(float(field) ** 2)
+                                       for field in line.split()) + "\n")
+    changed = run("changed", donorpwm=donorpwm)
+    assert changed != full
+    assert run("changed_miss", cache=cache, donorpwm=donorpwm) == changed
+    assert run("changed_hit", cache=cache, donorpwm=donorpwm) == changed
+    assert typed[2:] == [len(INTRONS), len(INTRONS)]
+
+    # A hit evicted down to nothing afterwards, the next run scores everything again
+    assert run("evicted", cache=cache, cache_max_mb=0) == full
+    assert run("after_evict", cache=cache) == full
+    assert typed[4:] == [len(INTRONS)]
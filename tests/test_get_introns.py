@@ -0,0 +1,153 @@
+import os
+import shutil
+import subprocess
+import sys
+
+import gffutils
+import pytest
+
+import get_introns
+import gtf_reader
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "get_introns.py")
+
+# (chrom, start, end, strand, gene_id, transcript_id), one based like the gtf
+EXONS = [
+    ("chr1", 100, 200, "+", "gA", "tA1"), ("chr1", 300, 400, "+", "gA", "tA1"), ("chr1", 500, 600, "+", "gA", "tA1"),
+    # Middle exon overlaps the tA1 ones, dropping both transcripts' introns next to it
+    ("chr1", 100, 200, "+", "gA", "tA2"), ("chr1", 350, 450, "+", "gA", "tA2"), ("chr1", 500, 600, "+", "gA", "tA2"),
+    # Overlapping exons give no intron
+    ("chr1", 100, 200, "+", "gA", "tA3"), ("chr1", 190, 250, "+", "gA", "tA3"),
+    # Minus strand listed from the last exon, its intron sits inside the single exon tB2
+    ("chr1", 1200, 1300, "-", "gB", "tB1"), ("chr1", 1000, 1100, "-", "gB", "tB1"),
+    ("chr1", 1000, 1300, "-", "gB", "tB2"),
+    # Intron shared by two genes is merged
+    ("chr2", 300, 310, "-", "gC", "tC1"), ("chr2", 150, 200, "-", "gC", "tC1"), ("chr2", 50, 80, "-", "gC", "tC1"),
+    ("chr2", 150, 200, "-", "gD", "tD1"), ("chr2", 50, 80, "-", "gD", "tD1"),
+    ("chr2", 400, 500, "-", "gC", "tC3"),
+]
+
+# Output of the gffutils engine: create_introns, flanks checked with bedtools intersect -f 1, merged and sorted
+EXPECTED_BED = ("chr1\t450\t499\tgA\t.\t+\n"
+                "chr2\t80\t149\tgC,gD\t.\t-\n"
+                "chr2\t200\t299\tgC\t.\t-\n")
+
+
+def gtf_line(chrom, feature, start, end, strand, attributes):
+    return "{}\ttest\t{}\t{}\t{}\t.\t{}\t.\t{}\n".format(chrom, feature, start, end, strand, attributes)
+
+
+def write_gtf(gtf, exons):
+    """ Gene, transcript and exon lines of the given exons """
+    genes, transcripts = dict(), dict()
+    for chrom, start, end, strand, gene_id, transcript_id in exons:
+        for features, key, value in ((genes, gene_id, (chrom, strand)),
+                                     (transcripts, transcript_id, (chrom, strand, gene_id))):
+            feature = features.setdefault(key, [value, start, end])
+            feature[1], feature[2] = min(feature[1], start), max(feature[2], end)
+
+    with open(gtf, "w") as out_handle:
+        for gene_id, ((chrom, strand), start, end) in genes.items():
+            out_handle.write(gtf_line(chrom, "gene", start, end, strand, 'gene_id "{}";'.format(gene_id)))
+            for transcript_id, ((_, _, parent), t_start, t_end) in transcripts.items():
+                if parent != gene_id:
+                    continue
+                attributes = 'gene_id "{}"; transcript_id "{}";'.format(gene_id, transcript_id)
+                out_handle.write(gtf_line(chrom, "transcript", t_start, t_end, strand, attributes))
+                for exon in exons:
+                    if exon[5] == transcript_id:
+                        out_handle.write(gtf_line(exon[0], "exon", exon[1], exon[2], exon[3], attributes))
+
+
+@pytest.fixture
+def annotation(tmp_path):
+    gtf = str(tmp_path / "genes.gtf")
+    write_gtf(gtf, EXONS)
+    db = str(tmp_path / "genes.db")
+    gffutils.create_db(gtf, db, disable_infer_genes=True, disable_infer_transcripts=True)
+    return gtf, db
+
+
+@pytest.mark.parametrize("source", ["gtf", "db"])
+def test_derive_introns_matches_create_introns(annotation, source):
+    gtf, db = annotation
+    expected = sorted((intron.attributes["transcript_id"][0], intron.attributes["gene_id"][0], intron.chrom,
+                       intron.start, intron.end, intron.strand)
+                      for intron in gffutils.FeatureDB(db).create_introns())
+    transcripts, exons = gtf_reader.read_structure(gtf if source == "gtf" else db)
+    assert sorted(get_introns.derive_introns(transcripts, exons)) == expected
+
+
+@pytest.mark.parametrize("source", ["gtf", "db"])
+def test_direct_engine_output(annotation, tmp_path, source):
+    gtf, db = annotation
+    out = str(tmp_path / "introns.bed")
+    get_introns.write_final_introns(get_introns.get_final_introns_direct(gtf if source == "gtf" else db, 3), out)
+    with open(out) as in_handle:
+        assert in_handle.read() == EXPECTED_BED
+
+
+@pytest.mark.skipif(shutil.which("bedtools") is None, reason="needs bedtools")
+def test_direct_matches_gffutils_engine(annotation, tmp_path):
+    gtf, db = annotation
+    outputs = dict()
+    for engine, args in (("gffutils", ["-d", db, "-e", "gffutils"]), ("direct", ["-g", gtf])):
+        outputs[engine] = str(tmp_path / "{}.bed".format(engine))
+        subprocess.run([sys.executable, SCRIPT] + args + ["-o", outputs[engine]], check=True)
+    with open(outputs["gffutils"]) as gffutils_handle, open(outputs["direct"]) as direct_handle:
+        gffutils_bed = gffutils_handle.read()
+        assert direct_handle.read() == gffutils_bed
+    assert gffutils_bed == EXPECTED_BED
+
+
+# Changes to EXONS for a new annotation release: (added exons, removed transcripts)
+RELEASES = {
+    # A new gene away from the others
+    "add": ([("chr1", 2000, 2100, "+", "gE", "tE1"), ("chr1", 2300, 2400, "+", "gE", "tE1")], []),
+    # A new gene whose exon covers the flank of an intron of gA
+    "add_overlapping": ([("chr1", 440, 455, "-", "gF", "tF1")], []),
+    # The intron shared by gC and gD keeps only gC
+    "remove": ([], ["tD1"]),
+    # Without the single exon transcript the gB intron is no longer inside an exon
+    "change": ([], ["tB2"]),
+    # A changed gene gets a second intron
+    "change_exons": ([("chr2", 600, 700, "-", "gC", "tC3")], []),
+}
+RELEASES["all"] = tuple(sum((RELEASES[name][part] for name in RELEASES), []) for part in range(2))
+
+
+def release_exons(name):
+    added, removed = RELEASES[name]
+    return [exon for exon in EXONS if exon[5] not in removed] + added
+
+
+@pytest.mark.parametrize("release", sorted(RELEASES))
+def test_incremental_matches_full_run(annotation, tmp_path, release):
+    old_gtf, _ = annotation
+    old_bed = str(tmp_path / "old.bed")
+    get_introns.write_final_introns(get_introns.get_final_introns_direct(old_gtf, 3), old_bed)
+    new_gtf = str(tmp_path / "new.gtf")
+    write_gtf(new_gtf, release_exons(release))
+
+    full = get_introns.get_final_introns_direct(new_gtf, 3)
+    assert get_introns.get_final_introns_incremental(new_gtf, 3, old_bed, old_gtf) == full
+    assert full != get_introns.read_final_introns(old_bed)
+
+
+def test_incremental_cli(annotation, tmp_path):
+    old_gtf, old_db = annotation
+    old_bed = str(tmp_path / "old.bed")
+    subprocess.run([sys.executable, SCRIPT, "-g", old_gtf, "-o", old_bed], check=True)
+    new_gtf = str(tmp_path / "new.gtf")
+    write_gtf(new_gtf, release_exons("all"))
+
+    outputs = dict()
+    for name, args in (("full", []), ("gtf", ["--previous-bed", old_bed, "--previous-annotation", old_gtf]),
+                       ("db", ["--previous-bed", old_bed, "--previous-annotation", old_db])):
+        outputs[name] = str(tmp_path / "{}.bed".format(name))
+        subprocess.run([sys.executable, SCRIPT, "-g", new_gtf, "-o", outputs[name]] + args, check=True)
+    with open(outputs["full"]) as in_handle:
+        full_bed = in_handle.read()
+    for name in ("gtf", "db"):
+        with open(outputs[name]) as in_handle:
+            assert in_handle.read() == full_bed, name
@@ -0,0 +1,48 @@
+import functools
+import gzip
+import sqlite3
+
+import pytest
+
+import gtf_to_db
+
+GTF = """##description: test annotation
+##provider: test
+chr1\ttest\tgene\t100\t900\t.\t+\t.\tgene_id "g1"; gene_type "protein_coding"; level 2;
+chr1\ttest\ttranscript\t100\t900\t.\t+\t.\tgene_id "g1"; transcript_id "t1"; tag "basic"; tag "CCDS";
+chr1\ttest\texon\t100\t200\t.\t+\t.\tgene_id "g1"; transcript_id "t1"; exon_number 1; exon_id "e1";
+chr1\ttest\tCDS\t150\t200\t.\t+\t0\tgene_id "g1"; transcript_id "t1"; exon_number 1;
+chr1\ttest\tstart_codon\t150\t152\t.\t+\t0\tgene_id "g1"; transcript_id "t1";
+chr1\ttest\texon\t700\t900\t.\t+\t.\tgene_id "g1"; transcript_id "t1"; exon_number 2; exon_id "e2";
+chr1\ttest\ttranscript\t100\t500\t.\t+\t.\tgene_id "g1"; transcript_id "t2"; transcript_type "retained_intron";
+chr1\ttest\texon\t100\t500\t.\t+\t.\tgene_id "g1"; transcript_id "t2"; exon_number 1;
+chr2\ttest\tgene\t50\t400\t.\t-\t.\tgene_id "g2"; gene_name "B; C";
+chr2\ttest\ttranscript\t50\t400\t.\t-\t.\tgene_id "g2"; transcript_id "t3";
+chr2\ttest\texon\t300\t400\t.\t-\t.\tgene_id "g2"; transcript_id "t3";
+chr2\ttest\texon\t50\t120\t.\t-\t.\tgene_id "g2"; transcript_id "t3";
+"""
+
+QUERIES = ("SELECT * FROM features ORDER BY id", "SELECT * FROM relations ORDER BY parent, child, level",
+           "SELECT * FROM meta", "SELECT * FROM autoincrements ORDER BY base", "SELECT * FROM directives")
+
+
+def read_tables(db):
+    with sqlite3.connect(db) as conn:
+        return [conn.execute(query).fetchall() for query in QUERIES]
+
+
+@pytest.mark.parametrize("gzipped", [False, True])
+@pytest.mark.parametrize("processes", [1, 2])
+def test_bulk_loader_matches_create_db(tmp_path, monkeypatch, gzipped, processes):
+    gtf = str(tmp_path / ("genes.gtf.gz" if gzipped else "genes.gtf"))
+    with (gzip.open if gzipped else open)(gtf, "wt") as out_handle:
+        out_handle.write(GTF)
+    # Chunks of a few lines, so the features are parsed in several tasks
+    monkeypatch.setattr(gtf_to_db, "plan_tasks", functools.partial(gtf_to_db.plan_tasks, chunk_bytes=256))
+
+    reference, fast = str(tmp_path / "gffutils.db"), str(tmp_path / "fast.db")
+    gtf_to_db.gffutils_create_db(gtf, reference)
+    gtf_to_db.bulk_create_db(gtf, fast, processes)
+    features, relations = read_tables(reference)[:2]
+    assert len(features) == len(GTF.splitlines()) - 2 and relations
+    assert read_tables(fast) == read_tables(reference)
@@ -0,0 +1,16 @@
+import logging
+
+from intron_table import IntronTable
+
+
+def test_from_bed_keeps_repeated_introns_once(tmp_path, caplog):
+    bed = tmp_path / "introns.bed"
+    bed.write_text("chr1\t100\t200\ta\t0\t+\n"
+                   "chr2\t50\t80\tb\t0\t*\n"
+                   "chr1\t100\t200\tc\t0\t+\n"
+                   "chr1\t100\t200\td\t0\t-\n"
+                   "chr2\t50\t80\te\t0\t.\n")
+    with caplog.at_level(logging.WARNING):
+        table = IntronTable.from_bed(str(bed))
+    assert table.ids() == ["chr1|100|200|+", "chr2|50|80|.", "chr1|100|200|-"]
+    assert "1 introns with unknown strand '*'" in caplog.text
@@ -0,0 +1,501 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pysam
+import pytest
+
+import checkpoint
+import get_msi
+import msi_cache
+import msi_engine
+import msi_server
+from intron_panel import IntronPanel
+from intron_table import IntronTable, read_genome_sizes
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "get_msi.py")
+
+CHROM_SIZE = 1000
+
+INTRONS = [("chr1", 100, 200, "+"),
+           ("chr1", 300, 400, "-"),
+           ("chr1", 600, 700, "+")]
+
+# (name, zero based start, cigar)
+READS = [
+    ("spliced_i1", 90, "13M87N20M"),        # blocks cover both i1 windows, span covers the exon window
+    ("a1_inside", 95, "10M"),
+    ("a1_exact", 97, "6M"),                 # block is exactly the a1 window
+    ("a1_short", 98, "6M"),                 # misses the first window base
+    ("del_a1_edge", 95, "3M10D3M"),         # deletion stays inside the block
+    ("del_a2_edge", 195, "3M2D5M"),
+    ("clip_a2", 190, "5S15M"),              # soft clip does not move the block
+    ("spliced_i2", 280, "15M100N15M"),      # first block stops short of the i2 a1 window
+    ("a1_end_exact", 290, "13M"),           # block ends exactly at the window end
+    ("a1_end_short", 290, "12M"),
+    ("ins_a1", 296, "3M2I5M"),              # insertion does not consume the reference
+    ("exon_edge_short", 596, "4M100N2M"),   # span ends one base before the exon window end
+    ("full_i3", 590, "120M"),
+    ("exon_exact", 597, "3M100N3M"),        # span is exactly the exon window
+]
+
+# bedtools intersect -split -f 1 -c for a1/a2, intersect -f 1 -c for exon, coverage -split for covfrac
+EXPECTED = {"a1": [4, 2, 1],
+            "a2": [3, 1, 1],
+            "exon": [1, 1, 2],
+            "covfrac": [0.21, 0.09, 1.0]}
+
+
+@pytest.fixture
+def fixture_files(tmp_path):
+    bed = tmp_path / "introns.bed"
+    bed.write_text("".join("{}\t{}\t{}\tintron{}\t0\t{}\n".format(chrom, start, end, k, strand)
+                           for k, (chrom, start, end, strand) in enumerate(INTRONS)))
+    gsizes = tmp_path / "genome.sizes"
+    gsizes.write_text("chr1\t{}\n".format(CHROM_SIZE))
+
+    bam = str(tmp_path / "reads.bam")
+    write_bam(bam, READS)
+    return str(bed), str(gsizes), bam
+
+
+def write_bam(bam, reads, chrom_sizes=(("chr1", CHROM_SIZE),)):
+    """
+    :param reads: (name, start, cigar) on the first chromosome or (name, start, cigar, chrom)
+    """
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+              "SQ": [{"SN": chrom, "LN": size} for chrom, size in chrom_sizes]}
+    chrom_codes = {chrom: code for code, (chrom, _) in enumerate(chrom_sizes)}
+    reads = [read + (chrom_sizes[0][0],) if len(read) == 3 else read for read in reads]
+    with pysam.AlignmentFile(bam, "wb", header=header) as out_bam:
+        for name, start, cigar, chrom in sorted(reads, key=lambda read: (chrom_codes[read[3]], read[1])):
+            read = pysam.AlignedSegment(out_bam.header)
+            read.query_name = name
+            read.reference_id = chrom_codes[chrom]
+            read.reference_start = start
+            read.cigarstring = cigar
+            read.query_sequence = "A" * read.query_length
+            read.mapping_quality = 60
+            out_bam.write(read)
+    pysam.index(bam)
+
+
+def load_table(bed, gsizes):
+    return IntronTable.from_bed(bed).sort(read_genome_sizes(gsizes))
+
+
+def assert_counts(counts, expected):
+    for column in ("a1", "a2", "exon"):
+        assert counts[column].tolist() == expected[column], column
+    assert np.allclose(counts["covfrac"], expected["covfrac"])
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_sweep_counts(fixture_files, threads):
+    bed, gsizes, bam = fixture_files
+    table = load_table(bed, gsizes)
+    assert_counts(msi_engine.count_introns(bam, table, threads=threads), EXPECTED)
+
+
+def test_sweep_stream_counts(fixture_files):
+    bed, gsizes, bam = fixture_files
+    table = load_table(bed, gsizes)
+    counts = msi_engine.new_counts(len(table))
+    with pysam.AlignmentFile(bam) as in_bam:
+        for finished in msi_engine.stream_counts(msi_engine.iter_alignments(in_bam.fetch(until_eof=True)), table):
+            msi_engine.store_counts(counts, finished)
+    assert_counts(counts, EXPECTED)
+
+
+@pytest.mark.skipif(shutil.which("bedtools") is None, reason="needs bedtools")
+def test_sweep_matches_bedtools(fixture_files):
+    bed, gsizes, bam = fixture_files
+    table = load_table(bed, gsizes)
+    bedtools_counts = get_msi.get_msi_bedtools(table, get_msi.get_windows_bedtools(table, gsizes), bam, gsizes)
+    sweep_counts = get_msi.get_msi_sweep(table, None, bam, gsizes)
+    for column in ("a1", "a2", "exon", "covfrac"):
+        assert sweep_counts[column].tolist() == bedtools_counts[column].tolist(), column
+    assert_counts(bedtools_counts, EXPECTED)
+
+
+def cache_entries(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if name.endswith(".evidence.npz"))
+
+
+def test_cache_counts(fixture_files, tmp_path):
+    bed, gsizes, bam = fixture_files
+    table = load_table(bed, gsizes)
+    cache_dir = str(tmp_path / "cache")
+    # Miss, then hit
+    for _ in range(2):
+        assert_counts(msi_cache.count_introns_cached(bam, table, cache_dir), EXPECTED)
+        assert len(cache_entries(cache_dir)) == 1
+
+    # A second bam with a cap below two entries evicts the least recently used one, the first bam
+    other_bam = str(tmp_path / "other.bam")
+    write_bam(other_bam, READS[::2])
+    other_counts = msi_cache.count_introns_cached(other_bam, table, cache_dir, max_bytes=1)
+    for column in ("a1", "a2", "exon", "covfrac"):
+        assert other_counts[column].tolist() == msi_engine.count_introns(other_bam, table)[column].tolist(), column
+    assert len(cache_entries(cache_dir)) == 1
+    # The evicted bam is a miss again with the same counts
+    assert_counts(msi_cache.count_introns_cached(bam, table, cache_dir), EXPECTED)
+
+
+def test_cache_entry_evicted_during_hit(fixture_files, tmp_path, monkeypatch):
+    bed, gsizes, bam = fixture_files
+    table = load_table(bed, gsizes)
+    cache_dir = str(tmp_path / "cache")
+    msi_cache.count_introns_cached(bam, table, cache_dir)
+
+    # Another run evicts the entry right after this run opened it
+    def evicted(path):
+        os.remove(path)
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(msi_cache.os, "utime", evicted)
+    assert_counts(msi_cache.count_introns_cached(bam, table, cache_dir), EXPECTED)
+    monkeypatch.undo()
+
+    # Gone before the lookup, it is collected again
+    assert cache_entries(cache_dir) == []
+    assert_counts(msi_cache.count_introns_cached(bam, table, cache_dir), EXPECTED)
+    assert len(cache_entries(cache_dir)) == 1
+
+
+# Every fixture read five times under different names, so a subsample keeps some of each
+SAMPLE_READS = [("{}_{}".format(name, k), start, cigar) for name, start, cigar in READS for k in range(5)]
+
+
+@pytest.fixture
+def sample_bam(tmp_path):
+    bam = str(tmp_path / "sample.bam")
+    write_bam(bam, SAMPLE_READS)
+    return bam
+
+
+def test_keep_read():
+    # Fixed picks, the subsample of a seed must not change between runs, processes or releases
+    names = ["read{}".format(k) for k in range(12)]
+    threshold = int(0.5 * 2 ** 64)
+    assert [name for name in names if msi_engine.keep_read(name, threshold, 0)] == \
+        ["read0", "read2", "read5", "read8", "read9", "read11"]
+    assert [name for name in names if msi_engine.keep_read(name, threshold, 1)] == \
+        ["read1", "read2", "read3", "read5", "read9", "read11"]
+    # Nested subsamples
+    for name in names:
+        if msi_engine.keep_read(name, int(0.25 * 2 ** 64), 0):
+            assert msi_engine.keep_read(name, threshold, 0)
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_sample_counts_reproducible(fixture_files, sample_bam, threads):
+    bed, gsizes, _ = fixture_files
+    table = load_table(bed, gsizes)
+    full = msi_engine.count_introns(sample_bam, table)
+    counts = [msi_engine.count_introns(sample_bam, table, threads=threads, sample=(0.4, 3)) for _ in range(2)]
+    counts.append(msi_engine.count_introns(sample_bam, table, sample=(0.4, 3)))
+    for column in ("a1", "a2", "exon", "covfrac"):
+        assert counts[0][column].tolist() == counts[1][column].tolist() == counts[2][column].tolist(), column
+    assert (counts[0]["a1"] + counts[0]["a2"] + counts[0]["exon"]).sum() < \
+        (full["a1"] + full["a2"] + full["exon"]).sum()
+
+
+def test_fraction_one_is_full_count(fixture_files, sample_bam):
+    bed, gsizes, _ = fixture_files
+    table = load_table(bed, gsizes)
+    full = msi_engine.count_introns(sample_bam, table)
+    counts = get_msi.get_msi_sweep(table, None, sample_bam, gsizes, fraction=1)
+    for column in ("a1", "a2", "exon", "covfrac"):
+        assert counts[column].tolist() == full[column].tolist(), column
+    assert counts["a1"].tolist() == [5 * count for count in EXPECTED["a1"]]
+    assert counts["msi"].tolist() == get_msi.calc_msi(full["a1"], full["a2"], full["exon"]).tolist()
+
+
+def test_msi_interval():
+    # prop.test(4, 10, correct = FALSE)$conf.int in R
+    low, high = get_msi.calc_msi_interval(np.array([2, 0]), np.array([2, 0]), np.array([3, 0]))
+    np.testing.assert_allclose([low[0], high[0]], [16.818032970623614, 68.73262302663417], rtol=1e-12)
+    assert (low[1], high[1]) == (0, 0)
+
+
+def test_sample_interval_contains_msi(fixture_files, sample_bam):
+    bed, gsizes, _ = fixture_files
+    table = load_table(bed, gsizes)
+    counts = get_msi.get_msi_sweep(table, None, sample_bam, gsizes, fraction=0.4, seed=3, confidence=0.9)
+    sampled = msi_engine.count_introns(sample_bam, table, sample=(0.4, 3))
+    assert counts["msi"].tolist() == get_msi.calc_msi(sampled["a1"], sampled["a2"], sampled["exon"]).tolist()
+    assert np.all(counts["msi_low"] <= counts["msi"]) and np.all(counts["msi"] <= counts["msi_high"])
+    assert np.all(counts["msi_low"] < counts["msi_high"])
+    # Counts are scaled to the whole bam
+    assert counts["a1"].tolist() == np.rint(sampled["a1"] / 0.4).astype(int).tolist()
+
+
+def test_convergence(fixture_files, sample_bam, tmp_path):
+    bed, gsizes, _ = fixture_files
+    table = load_table(bed, gsizes)
+    out = str(tmp_path / "convergence.tsv")
+    get_msi.write_convergence(table, sample_bam, [1, 0.4], 3, 0.95, 1, out)
+    with open(out) as in_handle:
+        lines = [line.rstrip("\n").split("\t") for line in in_handle]
+    assert lines[0] == get_msi.CONVERGENCE_HEADER.rstrip("\n").split("\t")
+    assert [row[0] for row in lines[1:]] == ["0.4", "1"]
+    # The reference against itself
+    assert lines[2] == ["1", str(len(SAMPLE_READS)), "3", "1.0000", "0.0000", "1.0000"]
+    sampled = msi_engine.count_introns(sample_bam, table, sample=(0.4, 3))
+    has_reads = (sampled["a1"] + sampled["a2"] + sampled["exon"]) > 0
+    assert lines[1][1:3] == [str(round(len(SAMPLE_READS) * 0.4)), str(has_reads.sum())]
+
+
+@pytest.mark.parametrize("finished", [0, 1, 2])
+def test_checkpoint_resume(fixture_files, tmp_path, monkeypatch, interrupt_checkpoint, finished):
+    bed, gsizes, bam = fixture_files
+    table = load_table(bed, gsizes)
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    # One shard per intron
+    assert len(msi_engine.plan_shards(table, 1)) == 3
+    interrupt_checkpoint(finished)
+    with pytest.raises(RuntimeError, match="interrupted"):
+        get_msi.get_msi_sweep(table, None, bam, gsizes, checkpoint_dir=checkpoint_dir, checkpoint_size=1)
+    monkeypatch.undo()
+
+    counted = list()
+    original = msi_engine.count_shard
+
+    def count_shard(bam_path, shard, sample=None):
+        counted.append(list(shard[3]))
+        return original(bam_path, shard, sample)
+
+    monkeypatch.setattr(msi_engine, "count_shard", count_shard)
+    counts = get_msi.get_msi_sweep(table, None, bam, gsizes, checkpoint_dir=checkpoint_dir, checkpoint_size=1)
+    # Only the shards missing from the checkpoint are counted again, the result is the one of a run through
+    assert counted == [[row] for row in range(finished, 3)]
+    uninterrupted = msi_engine.count_introns(bam, table)
+    for column in ("a1", "a2", "exon", "covfrac"):
+        assert counts[column].tolist() == uninterrupted[column].tolist(), column
+    assert_counts(counts, EXPECTED)
+
+    options = {"fraction": None, "read_budget": None, "seed": 0, "checkpoint_size": 1}
+    get_msi.remove_checkpoints(checkpoint_dir, table, [bam], options)
+    assert not os.path.exists(checkpoint_dir)
+
+
+def test_checkpoint_of_other_inputs(fixture_files, tmp_path, monkeypatch, interrupt_checkpoint):
+    bed, gsizes, bam = fixture_files
+    table = load_table(bed, gsizes)
+    checkpoint_dir = str(tmp_path / "checkpoint")
+    interrupt_checkpoint(1)
+    with pytest.raises(RuntimeError, match="interrupted"):
+        get_msi.get_msi_sweep(table, None, bam, gsizes, checkpoint_dir=checkpoint_dir, checkpoint_size=1)
+    monkeypatch.undo()
+    directory = get_msi.bam_checkpoint(checkpoint_dir, bam)
+    manifest = checkpoint.read_manifest(directory)
+
+    # Other introns, another subsample, another shard size or a rewritten bam never reuse its shards
+    other_table = table.take(np.array([0, 2]))
+    runs = [(other_table, {}), (table, {"fraction": 0.5}), (table, {"checkpoint_size": 2})]
+    for run_table, options in runs:
+        options = dict({"checkpoint_dir": checkpoint_dir, "checkpoint_size": 1}, **options)
+        with pytest.raises(ValueError, match="another run"):
+            get_msi.get_msi_sweep(run_table, None, bam, gsizes, **options)
+    write_bam(bam, READS[::2])
+    with pytest.raises(ValueError, match="another run"):
+        get_msi.get_msi_sweep(table, None, bam, gsizes, checkpoint_dir=checkpoint_dir, checkpoint_size=1)
+    # Nor remove them
+    get_msi.remove_checkpoints(checkpoint_dir, table, [bam], {"fraction": None, "read_budget": None, "seed": 0,
+                                                              "checkpoint_size": 1})
+    assert checkpoint.read_manifest(directory) == manifest
+    assert sorted(os.listdir(directory)) == [checkpoint.MANIFEST, checkpoint.shard_name(0)]
+
+
+@pytest.fixture
+def panel_file(fixture_files, tmp_path):
+    bed, gsizes, _ = fixture_files
+    panel = str(tmp_path / "introns.panel")
+    IntronPanel.build(bed, gsizes).save(panel)
+    return panel
+
+
+@pytest.mark.parametrize("engine", ["sweep", "bedtools"])
+def test_panel_matches_bed(fixture_files, panel_file, tmp_path, engine):
+    if engine == "bedtools" and shutil.which("bedtools") is None:
+        pytest.skip("needs bedtools")
+    bed, gsizes, bam = fixture_files
+    with IntronPanel.open(panel_file) as panel:
+        table = load_table(bed, gsizes)
+        assert panel.table.ids() == table.ids()
+    outputs = list()
+    for introns in (["--bed", bed, "--genomesizes", gsizes], ["--panel", panel_file]):
+        outputs.append(str(tmp_path / "msi_{}.xls".format(len(outputs))))
+        subprocess.run([sys.executable, SCRIPT, "--bam", bam, "--engine", engine, "--out", outputs[-1]] + introns,
+                       check=True)
+    with open(outputs[0]) as bed_handle, open(outputs[1]) as panel_handle:
+        assert panel_handle.read() == bed_handle.read()
+
+
+def test_server_panels(fixture_files, panel_file, tmp_path):
+    bed, gsizes, bam = fixture_files
+    expected = str(tmp_path / "msi.xls")
+    get_msi.write_msi(load_table(bed, gsizes), msi_engine.count_introns(bam, load_table(bed, gsizes)), expected)
+    with open(expected) as in_handle:
+        expected = in_handle.read()
+
+    panels = {"from_bed": (msi_server.load_panel(bed, gsizes), gsizes),
+              "from_panel": (msi_server.load_panel(panel_file), None)}
+    server = msi_server.MSIServer(("127.0.0.1", 0), panels, 1, 1, 2, {"cache_dir": None, "cache_max_gb": None})
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    def post(body):
+        request = urllib.request.Request(url + "/msi", data=json.dumps(body).encode(), method="POST")
+        with urllib.request.urlopen(request) as response:
+            return response.read().decode()
+
+    try:
+        with urllib.request.urlopen(url + "/panels") as response:
+            assert json.load(response) == {"from_bed": 3, "from_panel": 3}
+        for body in ({"panel": "from_bed"}, {"panel": "from_panel"}, {"bed": bed, "genomesizes": gsizes},
+                     {"panelfile": panel_file}):
+            assert post(dict(body, bam=bam)) == expected, body
+        with pytest.raises(urllib.error.HTTPError) as error:
+            post({"panelfile": bed, "bam": bam})
+        assert error.value.code == 400
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def reference_counts(table, reads):
+    """
+    Counts straight from the bedtools definitions, one read and one intron at a time: A1/A2 reads with a
+    block (split at N) holding the whole boundary window, Exon reads whose span holds the whole exon window,
+    CovFrac the share of intron bases under any block
+    :param reads: (name, start, cigar, chrom)
+    """
+    alignments = list()
+    for _, start, cigar, chrom in reads:
+        blocks, pos, block_start = list(), start, start
+        for length, op in re.findall(r"(\d+)([MIDNSHP=X])", cigar):
+            if op in "MD=X":
+                pos += int(length)
+            elif op == "N":
+                blocks.append((block_start, pos))
+                pos += int(length)
+                block_start = pos
+        blocks.append((block_start, pos))
+        alignments.append((chrom, start, pos, [block for block in blocks if block[1] > block[0]]))
+
+    counts = {"a1": [], "a2": [], "exon": [], "covfrac": []}
+    for chrom, start, end, _ in table.records():
+        on_chrom = [alignment for alignment in alignments if alignment[0] == chrom]
+        for column, (low, high) in (("a1", (start - 3, start + 3)), ("a2", (end - 3, end + 3))):
+            counts[column].append(sum(any(block[0] <= low and high <= block[1] for block in blocks)
+                                      for _, _, _, blocks in on_chrom))
+        counts["exon"].append(sum(span_start <= start - 3 and end + 3 <= span_end
+                                  for _, span_start, span_end, _ in on_chrom))
+        covered = set()
+        for _, _, _, blocks in on_chrom:
+            for block_start, block_end in blocks:
+                covered.update(range(max(block_start, start), min(block_end, end)))
+        counts["covfrac"].append(msi_engine.coverage_fraction(len(covered), end - start))
+    return {column: np.array(values) for column, values in counts.items()}
+
+
+def test_reference_counts_match_bedtools(fixture_files):
+    # The reference gives the bedtools counts of the hand made fixture
+    bed, gsizes, _ = fixture_files
+    reference = reference_counts(load_table(bed, gsizes), [read + ("chr1",) for read in READS])
+    assert_counts(reference, EXPECTED)
+
+
+# Reads span at most about 700 bases and stay on their chromosome
+RANDOM_CHROMS = (("chr1", 3000), ("chr2", 1000), ("chr3", 2000))
+
+
+@pytest.fixture
+def random_files(tmp_path):
+    rng = np.random.default_rng(11)
+    introns, reads = list(), list()
+    for chrom, size in RANDOM_CHROMS:
+        for _ in range(size // 60):
+            start = int(rng.integers(5, size - 40))
+            introns.append((chrom, start, min(size - 5, start + int(rng.integers(8, 300))), rng.choice(["+", "-"])))
+        for k in range(size // 4):
+            ops = ["{}S".format(rng.integers(1, 6))] if rng.random() < 0.1 else []
+            for block in range(int(rng.integers(1, 4))):
+                if block:
+                    ops.append("{}N".format(rng.integers(5, 250)))
+                ops.append("{}M".format(rng.integers(2, 40)))
+                if rng.random() < 0.2:
+                    ops.append("{}{}".format(rng.integers(1, 4), rng.choice(["D", "I"])))
+                    ops.append("{}M".format(rng.integers(1, 20)))
+            reads.append(("{}_{}".format(chrom, k), int(rng.integers(0, size - 800)),
+                          "".join(ops), chrom))
+    bed = tmp_path / "introns.bed"
+    bed.write_text("".join("{}\t{}\t{}\tintron{}\t0\t{}\n".format(chrom, start, end, k, strand)
+                           for k, (chrom, start, end, strand) in enumerate(introns)))
+    gsizes = tmp_path / "genome.sizes"
+    gsizes.write_text("".join("{}\t{}\n".format(chrom, size) for chrom, size in RANDOM_CHROMS))
+    bam = str(tmp_path / "reads.bam")
+    write_bam(bam, reads, RANDOM_CHROMS)
+    return str(bed), str(gsizes), bam, reads
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_sweep_matches_reference(random_files, threads):
+    bed, gsizes, bam, reads = random_files
+    table = load_table(bed, gsizes)
+    reference = reference_counts(table, reads)
+    assert reference["a1"].sum() and reference["a2"].sum() and reference["exon"].sum()
+    # Enough introns for several shards per process
+    assert len(msi_engine.plan_shards(table, max(1, len(table) // (threads * 4)))) > 3
+    counts = msi_engine.count_introns(bam, table, threads=threads)
+    for column in ("a1", "a2", "exon", "covfrac"):
+        assert counts[column].tolist() == reference[column].tolist(), column
+
+
+def test_sweep_cli_and_stdin(random_files, tmp_path):
+    bed, gsizes, bam, reads = random_files
+    table = load_table(bed, gsizes)
+    expected = str(tmp_path / "expected.xls")
+    get_msi.write_msi(table, reference_counts(table, reads), expected)
+    with open(expected) as in_handle:
+        expected = in_handle.read()
+
+    out = str(tmp_path / "msi.xls")
+    subprocess.run([sys.executable, SCRIPT, "--bed", bed, "--genomesizes", gsizes, "--bam", bam, "--engine", "sweep",
+                    "--out", out], check=True)
+    with open(out) as in_handle:
+        assert in_handle.read() == expected
+
+    # Streamed rows follow the stream, the same lines
+    streamed = str(tmp_path / "streamed.xls")
+    with open(bam, "rb") as in_handle:
+        subprocess.run([sys.executable, SCRIPT, "--bed", bed, "--genomesizes", gsizes, "--bam", "-", "--engine",
+                        "sweep", "--out", streamed], stdin=in_handle, check=True)
+    with open(streamed) as in_handle:
+        lines = in_handle.read().splitlines()
+    expected = expected.splitlines()
+    assert lines[0] == expected[0]
+    assert sorted(lines[1:]) == sorted(expected[1:])
+
+
+@pytest.mark.skipif(shutil.which("bedtools") is None, reason="needs bedtools")
+def test_cli_engines_match(random_files, tmp_path):
+    bed, gsizes, bam, _ = random_files
+    outputs = list()
+    for engine in ("bedtools", "sweep"):
+        outputs.append(str(tmp_path / "{}.xls".format(engine)))
+        subprocess.run([sys.executable, SCRIPT, "--bed", bed, "--genomesizes", gsizes, "--bam", bam, "--engine",
+                        engine, "--out", outputs[-1]], check=True)
+    with open(outputs[0]) as bedtools_handle, open(outputs[1]) as sweep_handle:
+        assert sweep_handle.read() == bedtools_handle.read()
@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pytest
+
+import get_intron_type
+import pwm_scorer
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+# Windows scored by gimmemotifs 0.18.4 through get_intron_type.get_motif_scores (Scanner.scan with nreport=1,
+# threshold 0, then rescaled). forward and reverse hold the GT_AG_U12 consensus on one strand, tie on both,
+# n and reverse_n replace one consensus base with N, clipped windows are shorter than the motif.
+DONOR_WINDOWS = [
+    ("random_1", "TTTCCTCATGCAA"),
+    ("random_2", "TTCAAAACCATGT"),
+    ("forward", "ACACTTTGGGACC"),
+    ("reverse", "GGTCCCAAAGTGT"),
+    ("n", "ACACNTTGGGACC"),
+    ("reverse_n", "GGTCCCAANGTGT"),
+    ("all_n", "NNNNNNNNNNNNN"),
+    ("lower_case", "ccgtaatgtaggc"),
+    ("clipped", "GAAATAGTAAA"),
+]
+
+DONOR_SCORES = {
+    "AT_AC_U12": [35.56956114706441, 38.698899364816384, 46.65992704523725, 46.65992704523725, 39.781170928084265,
+                  39.78117092808426, 0.0, 46.66659946311436, 0.0],
+    "GT_AG_U12": [34.46778211337023, 39.95305759023813, 100.0, 100.0, 89.92198530743146, 89.92198530743144, 0.0,
+                  40.64291078249073, 0.0],
+    "GT_AG_U2": [34.6455004217602, 46.50410604962523, 40.96906120021606, 40.96906120021606, 40.96906120021606,
+                 40.96906120021606, 0.0, 39.48484616457873, 0.0],
+    "GC_AG_U2": [33.02264488762018, 46.12155658549362, 32.58876983160358, 32.58876983160358, 29.41927583520413,
+                 29.41927583520412, 0.0, 35.850093259268704, 0.0],
+}
+
+BRANCH_WINDOWS = [
+    ("random_1", "CCATTTTACGGAGGATACCAAATTCCTCCT"),
+    ("random_2", "TATTCAGGACCTAACCTGAGGTAAACCAGG"),
+    ("forward", "TCTAACACTTTGGGACTCCGCCCCCTTATA"),
+    ("reverse", "AAATCCCAAAGTGTTGCTGTTGCACCTAGC"),
+    ("tie", "AACACTTTGGGATCCCAAAGTGTTCAAGTT"),
+    ("n", "AACANTTTGGGACAACGGCAGCTGCAATGG"),
+    ("reverse_n", "AAATAGGCAATGACGGATTCCCAAANTGTT"),
+    ("all_n", "NNNNNNNNNNNNNNNNNNNNNNNNNNNNNN"),
+    ("lower_case", "atatattaaaaagtgttttaagatacattg"),
+    ("clipped", "AGGCCCGTTC"),
+]
+
+BRANCH_SCORES = {
+    "AT_AC_U12": [51.113623572179485, 51.49815596840552, 55.66005935645833, 49.03416173310946, 47.45180030763577,
+                  49.340649728474304, 49.617143692285794, 0.0, 47.94383586470018, 0.0],
+    "GT_AG_U12": [51.31573787484701, 47.11236845012707, 100.0, 100.0, 100.0, 76.08723806571645, 76.08723806571645, 0.0,
+                  81.90197191013608, 0.0],
+}
+
+CASES = [("don.pwm", DONOR_WINDOWS, DONOR_SCORES), ("branch.pwm", BRANCH_WINDOWS, BRANCH_SCORES)]
+
+
+def assert_scores(scores, expected):
+    assert sorted(scores) == sorted(expected)
+    for motif_id, motif_scores in expected.items():
+        # Last digit differences of the libm log are tolerated
+        np.testing.assert_allclose(scores[motif_id], motif_scores, rtol=1e-12, atol=1e-12, err_msg=motif_id)
+
+
+@pytest.mark.parametrize("pwm_name, windows, expected", CASES)
+def test_score_codes_matches_gimmemotifs(pwm_name, windows, expected):
+    motifs = pwm_scorer.read_pwms(os.path.join(DATA, pwm_name))
+    seqs = [seq for _, seq in windows]
+    assert_scores(pwm_scorer.score_codes(pwm_scorer.encode(seqs), motifs), expected)
+
+    # The genome_fasta path: zero padded byte windows and their lengths
+    lengths = np.array([len(seq) for seq in seqs])
+    windows_bytes = np.zeros((len(seqs), lengths.max()), dtype=np.uint8)
+    for row, seq in enumerate(seqs):
+        windows_bytes[row, :len(seq)] = np.frombuffer(seq.encode(), dtype=np.uint8)
+    assert_scores(pwm_scorer.score_codes(pwm_scorer.encode_windows(windows_bytes, lengths), motifs), expected)
+
+
+@pytest.mark.parametrize("pwm_name, windows, expected", CASES)
+def test_recorded_scores_match_installed_gimmemotifs(tmp_path, pwm_name, windows, expected):
+    pytest.importorskip("gimmemotifs")
+    fa = tmp_path / "windows.fa"
+    fa.write_text("".join(">{}\n{}\n".format(row, seq) for row, (_, seq) in enumerate(windows)))
+
+    class Sequences(object):
+        seqfn = str(fa)
+
+    pwm_file = os.path.join(DATA, pwm_name)
+    scores = dict()
+    for row, motif_id, score in get_intron_type.get_motif_scores(Sequences, get_intron_type.get_motif(pwm_file)):
+        scores.setdefault(motif_id, np.full(len(windows), np.nan))[row] = score
+    assert_scores(scores, expected)
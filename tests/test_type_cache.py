@@ -0,0 +1,112 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+import get_intron_type
+import pwm_scorer
+import type_cache
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+COLUMNS = get_intron_type.MOTIF_COLUMNS
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ A clock that ticks one second per call, so every lookup and store has its own last_used """
+    now = [1000.0]
+
+    def time():
+        now[0] += 1
+        return now[0]
+
+    monkeypatch.setattr(type_cache.time, "time", time)
+
+
+def make_calls(n, offset=0):
+    keys = np.array([type_cache.hashlib.blake2b(str(k + offset).encode(), digest_size=type_cache.KEY_SIZE).digest()
+                     for k in range(n)], dtype="S{}".format(type_cache.KEY_SIZE))
+    scores = {column: np.arange(n, dtype=np.float64) + offset + k / 10 for k, column in enumerate(COLUMNS)}
+    types = (np.array(["U2"] * n, dtype=object), np.array(["GT_AG_U2"] * n, dtype=object),
+             np.array(["Low"] * n, dtype=object))
+    return keys, scores, types
+
+
+def test_hit_and_miss(tmp_path):
+    keys, scores, types = make_calls(4)
+    scores["GT_AG_U12_b"][1] = np.nan
+    path = str(tmp_path / "types.sqlite")
+    with type_cache.TypeCache(path, COLUMNS) as cache:
+        assert cache.lookup(keys) == dict()
+        assert (cache.hits, cache.misses) == (0, 4)
+        cache.store(keys[:3], {column: values[:3] for column, values in scores.items()},
+                    tuple(field[:3] for field in types))
+
+    # Calls outlive the connection
+    with type_cache.TypeCache(path, COLUMNS) as cache:
+        found = cache.lookup(keys)
+        assert sorted(found) == sorted(bytes(key) for key in keys[:3])
+        for row, key in enumerate(keys[:3].tolist()):
+            call_scores, intron_type, intron_subtype, confidence = found[key]
+            np.testing.assert_array_equal(call_scores, [scores[column][row] for column in COLUMNS])
+            assert (intron_type, intron_subtype, confidence) == ("U2", "GT_AG_U2", "Low")
+        assert np.isnan(found[keys[1]][0][COLUMNS.index("GT_AG_U12_b")])
+        assert (cache.hits, cache.misses) == (3, 1)
+        assert cache.hit_rate() == 0.75
+
+
+def test_keys_change_with_pwms_and_windows(tmp_path):
+    donorpwm, branchpwm = os.path.join(DATA, "don.pwm"), os.path.join(DATA, "branch.pwm")
+    digest = type_cache.pwm_digest(donorpwm, branchpwm)
+    assert type_cache.pwm_digest(donorpwm, branchpwm) == digest
+
+    # One changed probability in a pwm gives another digest
+    changed = str(tmp_path / "don.pwm")
+    shutil.copy(donorpwm, changed)
+    with open(changed) as in_handle:
+        lines = in_handle.readlines()
+    row = next(k for k, line in enumerate(lines) if line[0].isdigit())
+    fields = lines[row].split()
+    fields[0] = str(float(fields[0]) + 1e-4)
+    lines[row] = "\t".join(fields) + "\n"
+    with open(changed, "w") as out_handle:
+        out_handle.writelines(lines)
+    assert type_cache.pwm_digest(changed, branchpwm) != digest
+    assert type_cache.pwm_digest(branchpwm, donorpwm) != digest
+
+    lengths = np.array([13, 13])
+    donor = pwm_scorer.encode_windows(np.frombuffer(b"ACGTACGTACGTAACGTACGTACGTC", dtype=np.uint8).reshape(2, 13),
+                                      lengths)
+    windows = [(donor, lengths)]
+    keys = type_cache.call_keys(digest, windows)
+    # Different windows, different keys, a window and its clipped version as well
+    assert keys[0] != keys[1]
+    assert type_cache.call_keys(digest, [(donor, np.array([13, 12]))])[1] != keys[1]
+    assert type_cache.call_keys(type_cache.pwm_digest(changed, branchpwm), windows)[0] != keys[0]
+
+
+def test_evict_least_recently_used(tmp_path, clock):
+    keys, scores, types = make_calls(2000)
+    with type_cache.TypeCache(str(tmp_path / "types.sqlite"), COLUMNS) as cache:
+        for begin in range(0, 2000, 200):
+            rows = slice(begin, begin + 200)
+            cache.store(keys[rows], {column: values[rows] for column, values in scores.items()},
+                        tuple(field[rows] for field in types))
+        # The oldest calls are used again
+        recent = keys[:100]
+        assert len(cache.lookup(recent)) == 100
+
+        size = cache.size()
+        assert cache.evict(size) == 0
+        dropped = cache.evict(size // 2)
+        assert dropped > 0 and cache.size() <= size // 2
+        kept = set(cache.lookup(keys))
+        assert len(kept) == 2000 - dropped
+        # The calls stored first but used last survive, the ones stored right after them go first
+        assert kept >= set(recent.tolist())
+        assert kept == set(recent.tolist()) | set(keys[2000 - (len(kept) - 100):].tolist())
+
+        assert cache.evict(0) == len(kept)
+        assert cache.lookup(keys) == dict()
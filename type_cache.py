@@ -0,0 +1,151 @@
+# ---------------------- type cache ------------------------------------------
+# Persistent cache of intron type calls for get_intron_type.py. A call only
+# depends on the donor and branch sequences and the pwm files, so it is
+# stored under a hash of those: the six motif scores plus type, subtype and
+# confidence. Retyping a new intron set (another annotation release, a custom
+# annotation) only scores sequences never seen before. Entries are evicted
+# least recently used first when the cache grows past a size bound.
+# ----------------------------------------------------------------------------
+import hashlib
+import logging
+import sqlite3
+import time
+
+import numpy as np
+
+# Bump when the scoring or the classification rules change
+CACHE_VERSION = 2
+
+KEY_SIZE = 20
+# Keys per IN (...) query, well below the sqlite variable limit
+QUERY_CHUNK = 500
+
+
+def pwm_digest(*pwm_files):
+    """
+    Digest of the pwm files content and the cache version
+    """
+    digest = hashlib.blake2b("version={}".format(CACHE_VERSION).encode(), digest_size=KEY_SIZE)
+    for pwm_file in pwm_files:
+        with open(pwm_file, "rb") as in_handle:
+            digest.update(hashlib.blake2b(in_handle.read()).digest())
+    return digest.digest()
+
+
+def call_keys(digest, windows):
+    """
+    Cache key of every intron
+    :param digest: pwm_digest of the motifs used
+    :param windows: list of (codes, lengths) per window type, pwm_scorer encoded windows and
+                    their lengths, -1 where there is no sequence
+    :return: array of KEY_SIZE byte keys
+    """
+    keys = list()
+    for row in range(len(windows[0][1]) if windows else 0):
+        key = hashlib.blake2b(digest, digest_size=KEY_SIZE)
+        for codes, lengths in windows:
+            key.update(codes[row, :max(int(lengths[row]), 0)].tobytes())
+            key.update(b"|")
+        keys.append(key.digest())
+    return np.array(keys, dtype="S{}".format(KEY_SIZE))
+
+
+class TypeCache(object):
+    """
+    sqlite backed store of type calls, one row per key
+    """
+
+    def __init__(self, path, columns):
+        """
+        :param path: sqlite file, created when missing
+        :param columns: names of the score columns, in the order they are stored
+        """
+        self.path = path
+        self.columns = tuple(columns)
+        self.hits = self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS calls (key BLOB PRIMARY KEY, {scores}, type TEXT, "
+                          "subtype TEXT, confidence TEXT, last_used REAL)".format(
+                              scores=", ".join("{} REAL".format(column) for column in self.columns)))
+        self.conn.execute("CREATE INDEX IF NOT EXISTS calls_last_used ON calls (last_used)")
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, keys):
+        """
+        Fetch the cached calls of the given keys and mark them used
+        :param keys: array of keys
+        :return: dict of key to (scores tuple in column order, type, subtype, confidence)
+        """
+        found = dict()
+        keys = [bytes(key) for key in keys]
+        for begin in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[begin:begin + QUERY_CHUNK]
+            query = "SELECT key, {scores}, type, subtype, confidence FROM calls WHERE key IN ({marks})".format(
+                scores=", ".join(self.columns), marks=", ".join("?" * len(chunk)))
+            for row in self.conn.execute(query, chunk):
+                scores = tuple(np.nan if score is None else score for score in row[1:len(self.columns) + 1])
+                found[bytes(row[0])] = (scores,) + tuple(row[len(self.columns) + 1:])
+        now = time.time()
+        self.conn.executemany("UPDATE calls SET last_used = ? WHERE key = ?", ((now, key) for key in found))
+        self.conn.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def store(self, keys, scores, types):
+        """
+        Add calls to the cache
+        :param keys: array of keys
+        :param scores: dict of column to score array aligned with the keys
+        :param types: type, subtype and confidence arrays aligned with the keys
+        """
+        now = time.time()
+        columns = [[None if np.isnan(score) else score for score in scores[column].tolist()]
+                   for column in self.columns]
+        rows = zip([bytes(key) for key in keys], *(columns + [list(field) for field in types]
+                                                    + [[now] * len(keys)]))
+        self.conn.executemany("INSERT OR REPLACE INTO calls VALUES ({})".format(
+            ", ".join("?" * (len(self.columns) + 5))), rows)
+        self.conn.commit()
+
+    def size(self):
+        """ Bytes used by the cache file """
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def evict(self, max_bytes):
+        """
+        Drop the least recently used calls until the cache fits in max_bytes
+        """
+        dropped, size = 0, self.size()
+        while size > max_bytes:
+            total = self.conn.execute("SELECT COUNT(*) FROM calls").fetchone()[0]
+            if not total:
+                break
+            # Rows are about the same size, drop a matching fraction plus some slack
+            drop = min(total, int(total * (1 - 0.9 * max_bytes / size)) + 1)
+            self.conn.execute("DELETE FROM calls WHERE key IN "
+                              "(SELECT key FROM calls ORDER BY last_used LIMIT ?)", (drop,))
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+            dropped, size = dropped + drop, self.size()
+        if dropped:
+            logging.info("Evicted {n} cached type calls, cache is now {size} bytes".format(n=dropped, size=size))
+        return dropped
+
+    def hit_rate(self):
+        """ Fraction of looked up keys that were cached """
+        looked_up = self.hits + self.misses
+        return self.hits / looked_up if looked_up else 0.0